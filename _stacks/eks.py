@@ -1,4 +1,5 @@
 import json
+import math
 import aws_cdk
 from aws_cdk import Stack
 from constructs import Construct
@@ -6,30 +7,313 @@ from aws_cdk import aws_ec2
 from aws_cdk import aws_iam
 from aws_cdk import aws_eks
 from aws_cdk import aws_dynamodb
+from aws_cdk import aws_elasticache
+
+
+prometheus_scrape_annotations = {
+    'prometheus.io/scrape': 'true',
+    'prometheus.io/port': '5000',
+    'prometheus.io/path': '/metrics'
+}
+
+# --------------------------------------------------------------
+# Podの停止(ローリングアップデート・スケールイン・ノードの削除)
+#   1. preStop: drainファイルを作って /readyz を503にし、ServiceとALBのターゲットから外れるまで待つ
+#      (この間も処理中・新規のリクエストには応答する)
+#   2. SIGTERM: gunicornが新規の受付を止め、処理中のリクエストを graceful_timeout(25秒)まで待って終了する
+#   terminationGracePeriodSecondsは1と2の合計より長くする
+# --------------------------------------------------------------
+drain_seconds = 15
+termination_grace_period_seconds = 45
+
+# frontend/backendのコンテナに共通のprobeとpreStop
+container_lifecycle = {
+    # liveness: プロセスが応答できるか(依存先の障害では再起動しない)
+    'livenessProbe': {
+        'httpGet': {
+            'path': '/livez',
+            'port': 5000
+        },
+        'periodSeconds': 10,
+        'timeoutSeconds': 2,
+        'failureThreshold': 3
+    },
+    # readiness: 依存先(backendはDynamoDB、frontendはbackend)に接続できるか。停止中は503
+    'readinessProbe': {
+        'httpGet': {
+            'path': '/readyz',
+            'port': 5000
+        },
+        'periodSeconds': 2,
+        'timeoutSeconds': 3,
+        'failureThreshold': 3
+    },
+    'lifecycle': {
+        'preStop': {
+            'exec': {
+                'command': ['/bin/sh', '-c', f'touch /tmp/draining && sleep {drain_seconds}']
+            }
+        }
+    }
+}
+
+# 新しいPodがreadyになってから古いPodを止める(ロールアウト中にレプリカ数を減らさない)
+rolling_update_strategy = {
+    'type': 'RollingUpdate',
+    'rollingUpdate': {
+        'maxSurge': '25%',
+        'maxUnavailable': 0
+    }
+}
+
+
+def zone_spread_constraints(app_label, when_unsatisfiable):
+    # PodをAZ(topology.kubernetes.io/zone)ごとに均等に配置する(差は1まで)
+    return [
+        {
+            'maxSkew': 1,
+            'topologyKey': 'topology.kubernetes.io/zone',
+            'whenUnsatisfiable': when_unsatisfiable,
+            'labelSelector': {'matchLabels': app_label}
+        }
+    ]
+
+
+def gunicorn_workers(resources):
+    # gunicorn.conf.pyと同じく、CPU limitからworker数を決める: ceil(limit) * 2 + 1
+    cpu = resources['limits']['cpu']
+    cores = int(cpu[:-1]) / 1000 if cpu.endswith('m') else float(cpu)
+    return math.ceil(cores) * 2 + 1
+
+
+# --------------------------------------------------------------
+# GET /events(frontend)・GET /messages/events(backend)の上限
+#   gthread workerではストリーム1本につき1スレッドを使うので、スレッド数はストリーム数 + リクエスト用にする
+#   - frontend: 1 workerでfrontend_event_streams本のブラウザの接続を受ける
+#   - backend: frontendはworkerごとに1本だけ読むので、frontendが最大までスケールしたときの本数を
+#     最小の台数のbackendのworkerで受けられるようにする。ServiceとgunicornはPod・workerに
+#     接続を均等には振り分けないので、event_stream_headroom倍の余裕を持たせる。
+# --------------------------------------------------------------
+frontend_event_streams = 12
+event_stream_headroom = 2
+request_threads = 4
+
+
+def backend_event_streams(frontend, backend):
+    streams = frontend['max_replicas'] * gunicorn_workers(frontend['resources'])
+    workers = backend['min_replicas'] * gunicorn_workers(backend['resources'])
+    return math.ceil(streams / workers) * event_stream_headroom
 
 
 default_property = {
     'vpc_cidr': '10.10.0.0/16',
     'cluster_name': 'ekshandson',
     'dynamodb_table_name': 'messages',
-    'dynamodb_partition_name': 'uuid'
+    'dynamodb_partition_name': 'uuid',
+    # 作成日時の順に一覧するGSI(パーティションキーはcreated_bucket、ソートキーはcreated_sort)
+    'dynamodb_created_index_name': 'created-index',
+    'dynamodb_created_buckets': 4  # 既存のアイテムがある場合は減らさないこと
+}
+
+# --------------------------------------------------------------
+# コンピュートプロファイル
+#   cdk deploy -c compute_profile=graviton のように選ぶ(既定は性能プロファイルのcompute_profile)
+#   - kubernetes_version: EKSのバージョン。cluster_autoscaler_image_tagはこれとマイナーバージョンを揃える
+#   - node_groups: マネージドノードグループ(インスタンスタイプ・アーキテクチャ・オンデマンド/スポット・台数)
+#     スポットは複数のインスタンスタイプを指定して、中断されにくくする
+#     arm64(Graviton)のノードグループを使う場合は、frontend/backendのイメージをarm64でもビルドする
+#   - zone_spread: frontend/backendのPodをAZに分散させる制約(topologySpreadConstraintsのwhenUnsatisfiable)
+#   ノード数はmin_size〜max_sizeの範囲でcluster-autoscalerが増減する
+# --------------------------------------------------------------
+compute_profiles = {
+    # ワークショップ用: x86のオンデマンド1台から
+    'workshop': {
+        'kubernetes_version': '1.21',
+        'cluster_autoscaler_image_tag': 'v1.21.3',
+        'node_groups': [
+            {
+                'name': 'NodeGroup',
+                'instance_types': ['t3.small'],
+                'arch': 'x86_64',
+                'capacity': 'on-demand',
+                'min_size': 1,
+                'desired_size': 1,
+                'max_size': 3
+            }
+        ],
+        # ノードが1台のときもPodを起動できるようにする
+        'zone_spread': 'ScheduleAnyway'
+    },
+    # 本番向け(x86): オンデマンドで最低限の台数を確保し、負荷に応じてスポットで増やす
+    'production': {
+        'kubernetes_version': '1.21',
+        'cluster_autoscaler_image_tag': 'v1.21.3',
+        'node_groups': [
+            {
+                'name': 'NodeGroup',
+                'instance_types': ['t3.medium'],
+                'arch': 'x86_64',
+                'capacity': 'on-demand',
+                'min_size': 2,
+                'desired_size': 2,
+                'max_size': 4
+            },
+            {
+                'name': 'SpotNodeGroup',
+                'instance_types': ['t3.medium', 't3a.medium', 'm5.large', 'm5a.large'],
+                'arch': 'x86_64',
+                'capacity': 'spot',
+                'min_size': 0,
+                'desired_size': 0,
+                'max_size': 6
+            }
+        ],
+        'zone_spread': 'DoNotSchedule'
+    },
+    # 本番向け(Graviton): productionと同じ構成をarm64で。同じ性能あたりの料金が安い
+    'graviton': {
+        'kubernetes_version': '1.21',
+        'cluster_autoscaler_image_tag': 'v1.21.3',
+        'node_groups': [
+            {
+                'name': 'NodeGroup',
+                'instance_types': ['t4g.medium'],
+                'arch': 'arm64',
+                'capacity': 'on-demand',
+                'min_size': 2,
+                'desired_size': 2,
+                'max_size': 4
+            },
+            {
+                'name': 'SpotNodeGroup',
+                'instance_types': ['t4g.medium', 'm6g.large', 'c6g.large'],
+                'arch': 'arm64',
+                'capacity': 'spot',
+                'min_size': 0,
+                'desired_size': 0,
+                'max_size': 6
+            }
+        ],
+        'zone_spread': 'DoNotSchedule'
+    }
+}
+
+# --------------------------------------------------------------
+# 性能プロファイル
+#   cdk deploy -c performance_profile=production のように選ぶ(既定はworkshop)
+#   - compute_profile: 既定のコンピュートプロファイル(ノードグループ)
+#   - frontend/backend: HPAのレプリカ数・目標CPU使用率と、コンテナのrequests/limits
+#     (gunicornのworker数はCPU limitから決まる: ceil(limit) * 2 + 1)
+#   - dynamodb_billing: provisioned(目標使用率で自動スケーリング) または on-demand(PAY_PER_REQUEST)
+#   - shared_cache: backendのPod間で共有するキャッシュ(ElastiCache for Redis)。Noneならプロセス内キャッシュ
+#     (cdk deploy -c shared_cache=true/false でプロファイルによらず作る・作らないを選べる。
+#      作る場合の大きさはプロファイルの設定、Noneのプロファイルではshared_cache_defaultsを使う)
+# --------------------------------------------------------------
+shared_cache_defaults = {
+    'node_type': 'cache.t3.micro',
+    'replicas': 0
+}
+
+performance_profiles = {
+    # ワークショップ用: 最小の構成で起動し、負荷に応じてPodとDynamoDBの容量を増やす
+    'workshop': {
+        'compute_profile': 'workshop',
+        'frontend': {
+            'min_replicas': 1,
+            'max_replicas': 3,
+            'target_cpu_utilization': 70,
+            'resources': {
+                'requests': {'cpu': '100m', 'memory': '192Mi'},
+                'limits': {'cpu': '500m', 'memory': '384Mi'}
+            }
+        },
+        'backend': {
+            'min_replicas': 1,
+            'max_replicas': 3,
+            'target_cpu_utilization': 70,
+            'resources': {
+                'requests': {'cpu': '100m', 'memory': '256Mi'},
+                'limits': {'cpu': '500m', 'memory': '512Mi'}
+            }
+        },
+        'dynamodb_billing': 'provisioned',
+        'dynamodb_min_capacity': 1,
+        'dynamodb_max_capacity': 20,
+        'dynamodb_target_utilization': 70,
+        # ElastiCacheは作らない(backendが1台なら共有する相手がいない。-c shared_cache=true で作る)
+        'shared_cache': None
+    },
+    # 本番向け: 2台以上で冗長化し、DynamoDBはオンデマンド(急な負荷でもスロットリングしにくい)
+    'production': {
+        'compute_profile': 'production',
+        'frontend': {
+            'min_replicas': 2,
+            'max_replicas': 10,
+            'target_cpu_utilization': 60,
+            'resources': {
+                'requests': {'cpu': '250m', 'memory': '256Mi'},
+                'limits': {'cpu': '1', 'memory': '512Mi'}
+            }
+        },
+        'backend': {
+            'min_replicas': 2,
+            'max_replicas': 10,
+            'target_cpu_utilization': 60,
+            'resources': {
+                'requests': {'cpu': '250m', 'memory': '384Mi'},
+                'limits': {'cpu': '1', 'memory': '768Mi'}
+            }
+        },
+        'dynamodb_billing': 'on-demand',
+        # レプリカ1台で別AZに自動フェイルオーバーする
+        'shared_cache': {
+            'node_type': 'cache.t3.small',
+            'replicas': 1
+        }
+    }
 }
 
 
 class EksStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, env: aws_cdk.Environment, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, env: aws_cdk.Environment,
+                 performance_profile: str = None, compute_profile: str = None, shared_cache: bool = None,
+                 **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        profile_name = performance_profile or self.node.try_get_context('performance_profile') or 'workshop'
+        if profile_name not in performance_profiles:
+            raise ValueError(f'unknown performance_profile: {profile_name} '
+                             f'(choose from {", ".join(performance_profiles)})')
+        profile = performance_profiles[profile_name]
+        compute_name = compute_profile or self.node.try_get_context('compute_profile') or profile['compute_profile']
+        if compute_name not in compute_profiles:
+            raise ValueError(f'unknown compute_profile: {compute_name} '
+                             f'(choose from {", ".join(compute_profiles)})')
+        compute = compute_profiles[compute_name]
+
         vpc = self.create_vpc(vpc_cidr=default_property.get('vpc_cidr'))
-        cluster = self.create_eks(vpc=vpc, cluster_name=default_property.get('cluster_name'))
+        cluster = self.create_eks(vpc=vpc, cluster_name=default_property.get('cluster_name'), compute=compute)
         self.create_cloudwatch_logs(cluster=cluster)  # cloudwatchもclusterの中に追加したほうがよい
-        self.deploy_frontend(cluster=cluster)
+        self.deploy_frontend(cluster=cluster, scaling=profile['frontend'], zone_spread=compute['zone_spread'])
         table = self.create_dynamodb(
             table_name=default_property.get('dynamodb_table_name'),
-            partition_name=default_property.get('dynamodb_partition_name')
+            partition_name=default_property.get('dynamodb_partition_name'),
+            profile=profile
         )
-        self.deploy_backend(cluster=cluster, table=table)
+        cache_settings = profile['shared_cache']
+        if shared_cache is None:
+            shared_cache = self.node.try_get_context('shared_cache')
+        if isinstance(shared_cache, str):  # -c で渡した値は文字列になる
+            shared_cache = shared_cache.lower() in ('1', 'true', 'yes')
+        if shared_cache is not None:
+            cache_settings = (cache_settings or shared_cache_defaults) if shared_cache else None
+        cache = None
+        if cache_settings:
+            cache = self.create_cache(vpc=vpc, cluster=cluster, settings=cache_settings)
+        self.deploy_backend(cluster=cluster, table=table, scaling=profile['backend'], cache=cache,
+                            zone_spread=compute['zone_spread'],
+                            event_streams=backend_event_streams(profile['frontend'], profile['backend']))
 
     def create_vpc(self, vpc_cidr):
         # --------------------------------------------------------------
@@ -59,7 +343,7 @@ class EksStack(Stack):
         )
         return _vpc
 
-    def create_eks(self, vpc, cluster_name):
+    def create_eks(self, vpc, cluster_name, compute):
         # --------------------------------------------------------------
         # EKS Cluster
         #   Owner role for EKS Cluster
@@ -76,14 +360,27 @@ class EksStack(Stack):
             'EksAppCluster',
             # cluster_name='ekshandson',
             cluster_name=cluster_name,
-            version=aws_eks.KubernetesVersion.V1_21,
-            default_capacity_type=aws_eks.DefaultCapacityType.NODEGROUP,  # default NODEGROUP
-            default_capacity=1,  # 3 OR 2
-            default_capacity_instance=aws_ec2.InstanceType('t3.small'),
+            version=aws_eks.KubernetesVersion.of(compute['kubernetes_version']),
+            default_capacity=0,  # ノードグループはコンピュートプロファイルから追加する
             vpc=vpc,
             masters_role=_owner_role
         )
 
+        # マネージドノードグループはEKS-Applicationサブネット(2つのAZ)に作られる
+        for node_group in compute['node_groups']:
+            _cluster.add_nodegroup_capacity(
+                node_group['name'],
+                instance_types=[aws_ec2.InstanceType(t) for t in node_group['instance_types']],
+                ami_type=aws_eks.NodegroupAmiType.AL2_ARM_64 if node_group['arch'] == 'arm64'
+                else aws_eks.NodegroupAmiType.AL2_X86_64,
+                capacity_type=aws_eks.CapacityType.SPOT if node_group['capacity'] == 'spot'
+                else aws_eks.CapacityType.ON_DEMAND,
+                min_size=node_group['min_size'],
+                desired_size=node_group['desired_size'],
+                max_size=node_group['max_size'],
+                labels={'node-group': node_group['name']}
+            )
+
         # CI/CDでClusterを作成する際、IAM Userでkubectlを実行する際に追加する。
         # kubectl commandを実行できるIAM Userを追加
         # _cluster.aws_auth.add_user_mapping(
@@ -93,15 +390,23 @@ class EksStack(Stack):
 
         # ALBを使用する際、namespace='kube-system'にAWS LoadBalancer Controllerをインストールする
         self.install_aws_load_balancer_controller(cluster=_cluster)
+        # HPAがPodのCPU使用率を取得するためにmetrics-serverをインストールする
+        self.install_metrics_server(cluster=_cluster)
+        # Podが起動できないときにノードを増やし、使われていないノードを減らす
+        self.install_cluster_autoscaler(cluster=_cluster, image_tag=compute['cluster_autoscaler_image_tag'])
 
         return _cluster
 
-    def create_dynamodb(self, table_name, partition_name):
+    def create_dynamodb(self, table_name, partition_name, profile):
         # --------------------------------------------------------------
         #
         # DynamoDB
-        #
+        #   provisioned: 容量の下限から始め、使用率が目標を超えたら上限まで自動で増やす
+        #   on-demand:   リクエスト単位の課金(容量の設定は不要)
         # --------------------------------------------------------------
+        provisioned = profile['dynamodb_billing'] == 'provisioned'
+        capacity = {'read_capacity': profile['dynamodb_min_capacity'],
+                    'write_capacity': profile['dynamodb_min_capacity']} if provisioned else {}
         _table = aws_dynamodb.Table(
             self,
             id='DynamoDbTable',
@@ -109,12 +414,79 @@ class EksStack(Stack):
             partition_key=aws_dynamodb.Attribute(
                 name=partition_name,
                 type=aws_dynamodb.AttributeType.STRING),
-            read_capacity=1,
-            write_capacity=1,
-            removal_policy=aws_cdk.RemovalPolicy.DESTROY  # 削除
+            billing_mode=aws_dynamodb.BillingMode.PROVISIONED if provisioned
+            else aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=aws_cdk.RemovalPolicy.DESTROY,  # 削除
+            **capacity
+        )
+        # 新しい順のN件をScanではなくQueryで読む。
+        # created_bucketで書き込みを複数のパーティションに分散し、backendが全バケットをQueryしてマージする
+        _table.add_global_secondary_index(
+            index_name=default_property.get('dynamodb_created_index_name'),
+            partition_key=aws_dynamodb.Attribute(
+                name='created_bucket',
+                type=aws_dynamodb.AttributeType.STRING),
+            sort_key=aws_dynamodb.Attribute(
+                name='created_sort',
+                type=aws_dynamodb.AttributeType.STRING),
+            projection_type=aws_dynamodb.ProjectionType.ALL,
+            **capacity
         )
+
+        if provisioned:
+            scaling = {'min_capacity': profile['dynamodb_min_capacity'],
+                       'max_capacity': profile['dynamodb_max_capacity']}
+            target = profile['dynamodb_target_utilization']
+            index_name = default_property.get('dynamodb_created_index_name')
+            for scalable in (
+                _table.auto_scale_read_capacity(**scaling),
+                _table.auto_scale_write_capacity(**scaling),
+                _table.auto_scale_global_secondary_index_read_capacity(index_name, **scaling),
+                _table.auto_scale_global_secondary_index_write_capacity(index_name, **scaling)
+            ):
+                scalable.scale_on_utilization(target_utilization_percent=target)
         return _table
 
+    def create_cache(self, vpc, cluster, settings):
+        # --------------------------------------------------------------
+        # ElastiCache for Redis
+        #   - DataStoreサブネット(PRIVATE_ISOLATED)に配置する
+        #   - EKSのクラスターセキュリティグループ(ノード・Pod)からの6379/tcpだけを許可する
+        # --------------------------------------------------------------
+        subnet_group = aws_elasticache.CfnSubnetGroup(
+            self,
+            'CacheSubnetGroup',
+            description='backend shared cache',
+            subnet_ids=vpc.select_subnets(subnet_group_name='DataStore').subnet_ids
+        )
+        security_group = aws_ec2.SecurityGroup(
+            self,
+            'CacheSecurityGroup',
+            vpc=vpc,
+            description='backend shared cache',
+            allow_all_outbound=False
+        )
+        security_group.add_ingress_rule(
+            peer=cluster.cluster_security_group,
+            connection=aws_ec2.Port.tcp(6379),
+            description='from EKS pods'
+        )
+        replicas = settings['replicas']
+        _cache = aws_elasticache.CfnReplicationGroup(
+            self,
+            'CacheReplicationGroup',
+            replication_group_description='backend shared cache',
+            engine='redis',
+            cache_node_type=settings['node_type'],
+            num_cache_clusters=1 + replicas,
+            automatic_failover_enabled=replicas > 0,
+            multi_az_enabled=replicas > 0,
+            cache_subnet_group_name=subnet_group.ref,
+            security_group_ids=[security_group.security_group_id],
+            at_rest_encryption_enabled=True
+        )
+        return _cache
+
     def create_cloudwatch_logs(self, cluster):
         # --------------------------------------------------------------
         # Cloudwatch Logs - fluent bit
@@ -217,7 +589,132 @@ class EksStack(Stack):
             }
         )
 
-    def deploy_frontend(self, cluster):
+    def install_metrics_server(self, cluster):
+        # ---------------------------------------------------------------------------
+        # metrics-server
+        #   - namespace: kube-system
+        #   - HPA(kubectl top)が使うPod・NodeのCPU/メモリ使用量を提供する
+        # ---------------------------------------------------------------------------
+        cluster.add_helm_chart(
+            'MetricsServer',
+            chart='metrics-server',
+            release='metrics-server',
+            repository='https://kubernetes-sigs.github.io/metrics-server/',
+            version='3.8.2',
+            namespace='kube-system',
+            create_namespace=False
+        )
+
+    def install_cluster_autoscaler(self, cluster, image_tag):
+        # ---------------------------------------------------------------------------
+        # cluster-autoscaler
+        #   - IRSA: Service Account(kube-system)にAuto Scalingグループを操作するIAM Roleを付ける
+        #   - マネージドノードグループのAuto Scalingグループはタグ(k8s.io/cluster-autoscaler/enabled)で自動検出する
+        # ---------------------------------------------------------------------------
+        autoscaler_service_account = cluster.add_service_account(
+            'ClusterAutoscalerServiceAccount',
+            name='cluster-autoscaler',
+            namespace='kube-system'
+        )
+        cluster_autoscaler_policy_statements = [
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "autoscaling:DescribeAutoScalingGroups",
+                    "autoscaling:DescribeAutoScalingInstances",
+                    "autoscaling:DescribeLaunchConfigurations",
+                    "autoscaling:DescribeTags",
+                    "ec2:DescribeInstanceTypes",
+                    "ec2:DescribeLaunchTemplateVersions",
+                    "eks:DescribeNodegroup"
+                ],
+                "Resource": ["*"]
+            },
+            {
+                # ノード数の変更はcluster-autoscaler用のタグが付いたAuto Scalingグループだけに限る
+                "Effect": "Allow",
+                "Action": [
+                    "autoscaling:SetDesiredCapacity",
+                    "autoscaling:TerminateInstanceInAutoScalingGroup"
+                ],
+                "Resource": ["*"],
+                "Condition": {
+                    "StringEquals": {
+                        "aws:ResourceTag/k8s.io/cluster-autoscaler/enabled": "true"
+                    }
+                }
+            }
+        ]
+        for statement in cluster_autoscaler_policy_statements:
+            autoscaler_service_account.add_to_principal_policy(
+                aws_iam.PolicyStatement.from_json(statement)
+            )
+
+        cluster_autoscaler = cluster.add_helm_chart(
+            'ClusterAutoscaler',
+            chart='cluster-autoscaler',
+            release='cluster-autoscaler',
+            repository='https://kubernetes.github.io/autoscaler',
+            version='9.16.2',
+            namespace='kube-system',
+            create_namespace=False,
+            values={
+                'autoDiscovery': {'clusterName': cluster.cluster_name},
+                'awsRegion': self.region,
+                'image': {'tag': image_tag},  # Kubernetesとマイナーバージョンを揃える
+                'rbac': {
+                    'serviceAccount': {
+                        'name': autoscaler_service_account.service_account_name,
+                        'create': False
+                    }
+                },
+                'extraArgs': {
+                    # 同じ構成のノードグループ(AZ違いなど)の台数を揃え、無駄の少ないノードグループから増やす
+                    'balance-similar-node-groups': True,
+                    'expander': 'least-waste',
+                    'skip-nodes-with-system-pods': False
+                }
+            }
+        )
+        cluster_autoscaler.node.add_dependency(autoscaler_service_account)
+
+    def deploy_autoscaler(self, cluster, construct_id, name, namespace, scaling):
+        # ---------------------------------------------------------------------------
+        # HorizontalPodAutoscaler
+        #   CPU使用率(requestsに対する割合)が目標を超えたらレプリカを増やす
+        # ---------------------------------------------------------------------------
+        hpa_manifest = {
+            'apiVersion': 'autoscaling/v2beta2',  # Kubernetes 1.21
+            'kind': 'HorizontalPodAutoscaler',
+            'metadata': {
+                'name': name,
+                'namespace': namespace
+            },
+            'spec': {
+                'scaleTargetRef': {
+                    'apiVersion': 'apps/v1',
+                    'kind': 'Deployment',
+                    'name': name
+                },
+                'minReplicas': scaling['min_replicas'],
+                'maxReplicas': scaling['max_replicas'],
+                'metrics': [
+                    {
+                        'type': 'Resource',
+                        'resource': {
+                            'name': 'cpu',
+                            'target': {
+                                'type': 'Utilization',
+                                'averageUtilization': scaling['target_cpu_utilization']
+                            }
+                        }
+                    }
+                ]
+            }
+        }
+        return cluster.add_manifest(construct_id, hpa_manifest)
+
+    def deploy_frontend(self, cluster, scaling, zone_spread):
         # ---------------------------------------------------------------------------
         # frontend
         #   - Namespace
@@ -244,6 +741,11 @@ class EksStack(Stack):
             'kind': 'Namespace',
             'metadata': {
                 'name': frontend_namespace_name,
+                # AWS LoadBalancer ControllerがPodにreadiness gateを付け、
+                # ALBのヘルスチェックが通るまでPodをreadyにしない(ロールアウトが先に進まない)
+                'labels': {
+                    'elbv2.k8s.aws/pod-readiness-gate-inject': 'enabled'
+                }
             },
         }
         frontend_namespace = cluster.add_manifest('FrontendNamespace', frontend_namespace_manifest)
@@ -259,24 +761,44 @@ class EksStack(Stack):
             },
             'spec': {
                 'selector': {'matchLabels': frontend_app_label},
-                'replicas': 1,  # 2 or 3 and more
+                # replicasはHPAが決める(指定するとデプロイのたびにHPAの値が上書きされる)
+                'strategy': rolling_update_strategy,
                 'template': {
-                    'metadata': {'labels': frontend_app_label},
+                    'metadata': {
+                        'labels': frontend_app_label,
+                        # Prometheusに /metrics をscrapeさせる
+                        'annotations': prometheus_scrape_annotations
+                    },
                     'spec': {
+                        'topologySpreadConstraints': zone_spread_constraints(frontend_app_label, zone_spread),
+                        'terminationGracePeriodSeconds': termination_grace_period_seconds,
                         'containers': [
                             {
                                 'name': frontend_app_name,
                                 'image': f'{frontend_repo}:latest',
                                 'imagePullPolicy': 'Always',
+                                # gunicorn(multi-worker/multi-thread)で起動する。worker数はCPU limitから決まる
+                                'command': ['gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
                                 'ports': [
                                     {
                                         'containerPort': 5000
                                     }
                                 ],
+                                **container_lifecycle,
+                                'resources': scaling['resources'],
                                 'env': [
                                     {
                                         'name': 'BACKEND_URL',
                                         'value': backend_url
+                                    },
+                                    {
+                                        'name': 'GUNICORN_THREADS',
+                                        'value': str(frontend_event_streams + request_threads)
+                                    },
+                                    {
+                                        # ブラウザごとの /events は1本につき1スレッドを使う(残りは描画用)
+                                        'name': 'EVENTS_MAX_STREAMS',
+                                        'value': str(frontend_event_streams)
                                     }
                                 ]
                             }
@@ -287,6 +809,9 @@ class EksStack(Stack):
         }
         frontend_deployment = cluster.add_manifest('FrontendDeployment', frontend_deployment_manifest)
         frontend_deployment.node.add_dependency(frontend_namespace)
+        frontend_hpa = self.deploy_autoscaler(cluster, 'FrontendAutoscaler', frontend_deployment_name,
+                                              frontend_namespace_name, scaling)
+        frontend_hpa.node.add_dependency(frontend_deployment)
         # --------------------------------------------------------------
         # frontend Service
         # ----------------------------------------------------------
@@ -325,6 +850,16 @@ class EksStack(Stack):
                     'kubernetes.io/ingress.class': 'alb',  # 追加
                     'alb.ingress.kubernetes.io/scheme': 'internet-facing',
                     'alb.ingress.kubernetes.io/target-type': 'ip',
+                    # ヘルスチェックはfrontendの /readyz (停止中のPodは503になりターゲットから外れる)
+                    'alb.ingress.kubernetes.io/healthcheck-path': '/readyz',
+                    'alb.ingress.kubernetes.io/healthcheck-interval-seconds': '5',
+                    'alb.ingress.kubernetes.io/healthcheck-timeout-seconds': '4',
+                    'alb.ingress.kubernetes.io/healthy-threshold-count': '2',
+                    'alb.ingress.kubernetes.io/unhealthy-threshold-count': '2',
+                    'alb.ingress.kubernetes.io/success-codes': '200',
+                    # 登録解除したターゲットの処理中のリクエストを待つ秒数(既定の300秒ではロールアウトが遅い)。
+                    # preStop(15秒) + gunicornのgraceful_timeout(25秒)より短くする
+                    'alb.ingress.kubernetes.io/target-group-attributes': 'deregistration_delay.timeout_seconds=30',
                     # -----------------------------------------------------------
                     # 証明書を追加する・・・
                     # -----------------------------------------------------------
@@ -361,7 +896,7 @@ class EksStack(Stack):
         frontend_ingress = cluster.add_manifest('FrontendIngress', frontend_ingress_manifest)
         frontend_ingress.node.add_dependency(frontend_service)
 
-    def deploy_backend(self, cluster, table):
+    def deploy_backend(self, cluster, table, scaling, zone_spread, event_streams, cache=None):
         # --------------------------------------------------------------
         # backend
         #   Namespace
@@ -429,7 +964,7 @@ class EksStack(Stack):
                     "dynamodb:PutItem"
                 ],
                 # "Resource": ["arn:aws:dynamodb:*:*:table/messages"]
-                "Resource": [table.table_arn]
+                "Resource": [table.table_arn, f'{table.table_arn}/index/*']
             }
         ]
 
@@ -450,21 +985,33 @@ class EksStack(Stack):
             },
             'spec': {
                 'selector': {'matchLabels': backend_app_label},
-                'replicas': 1,  # 2 or 3 and more
+                # replicasはHPAが決める(指定するとデプロイのたびにHPAの値が上書きされる)
+                'strategy': rolling_update_strategy,
                 'template': {
-                    'metadata': {'labels': backend_app_label},
+                    'metadata': {
+                        'labels': backend_app_label,
+                        # Prometheusに /metrics をscrapeさせる
+                        'annotations': prometheus_scrape_annotations
+                    },
                     'spec': {
                         'serviceAccountName':  backend_service_account.service_account_name,
+                        'topologySpreadConstraints': zone_spread_constraints(backend_app_label, zone_spread),
+                        'terminationGracePeriodSeconds': termination_grace_period_seconds,
                         'containers': [
                             {
                                 'name': backend_app_name,
                                 'image': f'{backend_repo}:latest',
                                 'imagePullPolicy': 'Always',
+                                # gunicorn(multi-worker/multi-thread)で起動する。worker数はCPU limitから決まる
+                                'command': ['gunicorn', '--config', 'gunicorn.conf.py', 'app:app'],
                                 'ports': [
                                     {
                                         'containerPort': 5000
                                     }
                                 ],
+                                # DynamoDBへの接続の準備(warm-up)が終わってからServiceに組み込む
+                                **container_lifecycle,
+                                'resources': scaling['resources'],
                                 'env': [
                                     {
                                         'name': 'AWS_DEFAULT_REGION',
@@ -473,6 +1020,35 @@ class EksStack(Stack):
                                     {
                                         'name': 'DYNAMODB_TABLE_NAME',
                                         'value': table.table_name  # 'message'
+                                    },
+                                    {
+                                        'name': 'DYNAMODB_SCAN_SEGMENTS',  # 全件エクスポート時の並列Scan数
+                                        'value': '4'
+                                    },
+                                    {
+                                        'name': 'DYNAMODB_SCAN_WORKERS',
+                                        'value': '4'
+                                    },
+                                    {
+                                        'name': 'DYNAMODB_CREATED_INDEX',  # 一覧をQueryするGSI
+                                        'value': default_property.get('dynamodb_created_index_name')
+                                    },
+                                    {
+                                        'name': 'MESSAGES_CREATED_BUCKETS',
+                                        'value': str(default_property.get('dynamodb_created_buckets'))
+                                    },
+                                    {
+                                        'name': 'LOG_SAMPLE_RATE',  # 成功したリクエストのログは10%だけ出力する
+                                        'value': '0.1'
+                                    },
+                                    {
+                                        'name': 'GUNICORN_THREADS',
+                                        'value': str(event_streams + request_threads)
+                                    },
+                                    {
+                                        # frontendのworkerごとの /messages/events は1本につき1スレッドを使う
+                                        'name': 'EVENTS_MAX_STREAMS',
+                                        'value': str(event_streams)
                                     }
                                 ]
                             }
@@ -481,8 +1057,24 @@ class EksStack(Stack):
                 }
             }
         }
+        if cache is not None:
+            # get_messageと一覧ページのキャッシュをPod間で共有する(ElastiCache)
+            backend_container = backend_deployment_manifest['spec']['template']['spec']['containers'][0]
+            backend_container['env'].extend([
+                {
+                    'name': 'CACHE_BACKEND',
+                    'value': 'redis'
+                },
+                {
+                    'name': 'CACHE_REDIS_URL',
+                    'value': f'redis://{cache.attr_primary_end_point_address}:{cache.attr_primary_end_point_port}/0'
+                }
+            ])
         backend_deployment = cluster.add_manifest('BackendDeployment', backend_deployment_manifest)
         backend_deployment.node.add_dependency(backend_service_account)
+        backend_hpa = self.deploy_autoscaler(cluster, 'BackendAutoscaler', backend_deployment_name,
+                                             backend_namespace_name, scaling)
+        backend_hpa.node.add_dependency(backend_deployment)
 
         # --------------------------------------------------------------
         # backend Service
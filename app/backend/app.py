@@ -1,88 +1,258 @@
 import os
 import uuid
 
-import boto3
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, abort, stream_with_context
+from werkzeug.exceptions import HTTPException
 
+import applog
+import compression
+import jsonprovider
+import metrics
+import store
+from common import events, health, tracing
 
-region_name = os.getenv('AWS_DEFAULT_REGION', 'ap-northeast-1')
-table_name = os.getenv('DYNAMODB_TABLE_NAME', 'messages')
-
-db = boto3.resource('dynamodb', region_name=region_name)
-table = db.Table(table_name)
 
 app = Flask(__name__)
-app.config['JSON_AS_ASCII'] = False
+if store.json_provider == 'fast':
+    app.json = jsonprovider.FastJSONProvider(app)
+else:
+    app.json = jsonprovider.DecimalJSONProvider(app)
+metrics.init_app(app, request, g)
+applog.setup(level=store.log_level, queue_size=store.log_queue_size)
+applog.init_app(app, request, g, sample_rate=store.log_sample_rate)
+tracing.setup(store.tracing_service_name, exporter=store.tracing_exporter, file_path=store.tracing_file,
+              otlp_endpoint=store.tracing_otlp_endpoint, sample_rate=store.tracing_sample_rate,
+              server_timing=store.server_timing)
+tracing.init_app(app, request, g)
+if store.compress_enabled:
+    compression.init_app(app, request, min_size=store.compress_min_size, level=store.compress_level)
+
+
+def ndjson_lines(pages):
+    # 1ページを1つのchunkにして送る(圧縮する場合もページごとにflushする)
+    for page in pages:
+        if page:
+            yield ''.join(app.json.dumps(item) + '\n' for item in page)
+
+
+def conditional_response(body):
+    # レスポンスの内容のハッシュをETagにし、If-None-Matchが一致すれば304を返す
+    response = jsonify(body)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def get_messages(message_uuids):
+    message_uuids = list(dict.fromkeys(message_uuids))  # BatchGetItemは重複したキーを受け付けない
+    if len(message_uuids) > store.mget_max_ids:
+        abort(413, description='too many ids (max {})'.format(store.mget_max_ids))
+    json = store.get_messages(message_uuids)
+    return jsonify(json), 207 if 'unprocessed' in json else 200
+
+
+@app.route('/messages/events', methods=['GET'])
+def message_events():
+    # 新しく作成されたメッセージをserver-sent eventsで送る(Last-Event-ID以降のイベントは送り直す)
+    subscription = store.message_events.subscribe(request.headers.get('Last-Event-ID'))
+    if subscription is None:
+        abort(503, description='too many event streams')
+    stream = events.iter_stream(subscription, store.events_heartbeat_seconds, store.events_stream_seconds,
+                                health.is_draining)
+    response = Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.route('/messages/_mget', methods=['POST'])
+def mget_messages():
+    posted = request.get_json(silent=True)
+    ids = posted.get('ids') if isinstance(posted, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(u, str) and u for u in ids):
+        abort(400, description='request body must be {"ids": ["<uuid>", ...]}')
+    return get_messages(ids)
 
 
 @app.route('/messages', methods=['GET'])
 def get_all_messages():
-    db_response = table.scan()
-    message_item = db_response['Items']
-    return jsonify(message_item)
+    if 'ids' in request.args:
+        return get_messages([u for u in request.args['ids'].split(',') if u])
+
+    if request.args.get('format') == 'ndjson':
+        # テーブル全件のエクスポート: chunkedでNDJSONを逐次送信する
+        pages = store.scan_all_pages()
+        return Response(stream_with_context(ndjson_lines(pages)), mimetype='application/x-ndjson')
+
+    try:
+        limit = store.parse_limit(request.args.get('limit'))
+    except store.InvalidLimit:
+        abort(400, description='limit must be an integer between 1 and {}'.format(store.max_page_limit))
+    cursor = request.args.get('cursor')
+    try:
+        page = store.list_page(limit, cursor)
+    except store.InvalidCursor:
+        abort(400, description='invalid cursor')
+    return conditional_response(page)
 
 
 @app.route('/messages/<message_uuid>', methods=['GET'])
 def get_message(message_uuid):
-    db_response = table.get_item(
-        Key={
-            'uuid': message_uuid
-        }
-    )
-    print(db_response)
-    message_item = db_response['Item']
-    return jsonify(message_item)
+    message_item = store.get_message(message_uuid)
+    if message_item is None:
+        abort(404, description='{} not found.'.format(message_uuid))
+    return conditional_response(message_item)
 
 
 @app.route('/messages', methods=['POST'])
 def create_message():
     message_uuid = str(uuid.uuid4())
-    posted = request.get_json()
+    posted = request.get_json(silent=True)
+    if not isinstance(posted, dict):
+        abort(400, description='request body must be a JSON object')
     posted['uuid'] = message_uuid
-    print(posted)
-    db_response = table.put_item(
-        Item=posted
-    )
-    print(db_response)
+    posted.update(store.created_attributes(message_uuid))
+    store.create_message(posted)
     json = {
         'message': '{} created.'.format(message_uuid)
     }
     return jsonify(json)
 
 
+def read_batch_body():
+    # JSON配列 または NDJSON(1行1メッセージ)を受け付ける
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        return store.parse_ndjson(request.get_data(as_text=True))
+    posted = request.get_json(silent=True)
+    if not isinstance(posted, list):
+        abort(400, description='request body must be a JSON array or NDJSON')
+    return posted
+
+
+@app.route('/messages/batch', methods=['POST'])
+def create_messages():
+    try:
+        items, results, supplied = store.prepare_batch(read_batch_body())
+    except store.TooManyItems:
+        abort(413, description='too many items (max {})'.format(store.batch_max_items))
+    failed = store.put_messages(items, supplied)
+    json, status = store.batch_result(results, failed)
+    return jsonify(json), status
+
+
+def expected_version(body):
+    try:
+        return store.pop_expected_version(body)
+    except store.InvalidVersion:
+        abort(400, description='version must be a non-negative integer')
+
+
+def conflict_response(e):
+    json = {
+        'message': 'version conflict',
+        'version': e.current_version
+    }
+    return jsonify(json), 409
+
+
 @app.route('/messages/<message_uuid>', methods=['PUT'])
 def update_message(message_uuid):
-    put = request.get_json()
+    put = request.get_json(silent=True)
+    if not isinstance(put, dict):
+        abort(400, description='request body must be a JSON object')
     put['uuid'] = message_uuid
-    print(put)
-    db_response = table.put_item(
-        Item=put
-    )
-    print(db_response)
+    version = expected_version(put)
+    try:
+        version = store.replace_message(put, version)
+    except store.MessageNotFound:
+        abort(404, description='{} not found.'.format(message_uuid))
+    except store.VersionConflict as e:
+        return conflict_response(e)
+    json = {
+        'message': '{} updated.'.format(message_uuid),
+        'version': version
+    }
+    return jsonify(json)
+
+
+@app.route('/messages/<message_uuid>', methods=['PATCH'])
+def patch_message(message_uuid):
+    # 指定した属性だけを更新する(値がnullの属性は削除する)
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        abort(400, description='request body must be a JSON object')
+    # uuidと作成日時(created-indexのキー)は変更させない
+    for name in ('uuid',) + store.INDEX_ATTRIBUTES:
+        changes.pop(name, None)
+    version = expected_version(changes)
+    if not changes:
+        abort(400, description='no attributes to update')
+    try:
+        message_item = store.update_message(message_uuid, changes, version)
+    except store.MessageNotFound:
+        abort(404, description='{} not found.'.format(message_uuid))
+    except store.VersionConflict as e:
+        return conflict_response(e)
     json = {
-        'message': '{} updated.'.format(message_uuid)
+        'message': '{} updated.'.format(message_uuid),
+        'version': int(message_item['version'])
     }
     return jsonify(json)
 
 
 @app.route('/messages/<message_uuid>', methods=['DELETE'])
 def delete_message(message_uuid):
-    db_response = table.delete_item(
-        Key={
-            'uuid': message_uuid
-        }
-    )
-    print(db_response)
+    store.delete_message(message_uuid)
     json = {
         'message': '{} deleted'.format(message_uuid)
     }
     return jsonify(json)
 
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(store.cache.stats())
+
+
+@app.route('/events/stats', methods=['GET'])
+def events_stats():
+    return jsonify(store.message_events.stats())
+
+
+@app.errorhandler(HTTPException)
+def handle_http_error(e):
+    json = {
+        'message': e.description
+    }
+    return jsonify(json), e.code
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return metrics.metrics_response()
+
+
+@app.route('/livez', methods=['GET'])
 @app.route('/healthz', methods=['GET'])
 def health_check():
+    # liveness: プロセスが応答できるか(依存先は確認しない)
+    return 'OK'
+
+
+@app.route('/readyz', methods=['GET'])
+def readiness_check():
+    # 停止中(SIGTERM・preStop)は503を返し、新しいリクエストが来ないようにする
+    if health.is_draining():
+        abort(503, description='draining')
+    # DynamoDBへの接続の準備(warm-up)が終わるまでは503を返し、Serviceに組み込まれないようにする
+    if not store.is_ready():
+        store.start_warm_up()
+        abort(503, description='warming up')
+    # DynamoDBに接続できるか(結果は READINESS_CACHE_SECONDS 秒保持する)
+    reason = store.check_dynamodb()
+    if reason:
+        abort(503, description=reason)
     return 'OK'
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # 開発用サーバー。本番はgunicorn(gunicorn.conf.py)で起動する
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG', '0') == '1')
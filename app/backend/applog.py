@@ -0,0 +1,133 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+
+
+# --------------------------------------------------------------
+# 構造化ログ(JSON 1行)
+#   ログはキューに積むだけで、stdoutへの書き込みはQueueListenerのスレッドで行う。
+#   キューが一杯のときはブロックせずに捨てる(捨てた件数は dropped に数える)。
+#   リクエストごとに1行(レイテンシ・request id付き)を出力し、成功したリクエストは
+#   sample_rate の割合だけ出力する(4xx/5xxは常に出力する)。
+# --------------------------------------------------------------
+logger = logging.getLogger('backend')
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.{:03d}Z'.format(int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+JsonFormatter.converter = time.gmtime
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # 呼び出し側ではメッセージの組み立てだけ行い、JSONへの変換はリスナースレッドで行う
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Logging:
+    handler = None
+    listener = None
+    queue_size = 10000
+
+
+def _start_listener():
+    log_queue = queue.Queue(maxsize=_Logging.queue_size)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    _Logging.handler.queue = log_queue
+    _Logging.listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _Logging.listener.start()
+
+
+def _stop_listener():
+    if _Logging.listener is not None:
+        _Logging.listener.stop()
+
+
+def setup(level='INFO', queue_size=10000):
+    if _Logging.handler is not None:
+        return
+    _Logging.queue_size = queue_size
+    _Logging.handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    root = logging.getLogger()
+    root.handlers = [_Logging.handler]
+    root.setLevel(level)
+    _start_listener()
+    # gunicorn(preload_app)はアプリ読み込み後にforkするが、スレッドは子プロセスに引き継がれないので作り直す
+    os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(_stop_listener)
+
+
+def dropped():
+    return _Logging.handler.dropped if _Logging.handler else 0
+
+
+def init_app(app, request, g, sample_rate=1.0):
+    # リクエストごとに1行出力する(request/g はFlask/Quartそれぞれのものを渡す)
+
+    @app.before_request
+    def start_request():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.log_started = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        started = g.pop('log_started', None)
+        if started is None:
+            return response
+        response.headers['X-Request-ID'] = g.request_id
+        status = response.status_code
+        if status < 400 and random.random() >= sample_rate:
+            return response
+        level = logging.ERROR if status >= 500 else logging.WARNING if status >= 400 else logging.INFO
+        fields = {
+            'request_id': g.request_id,
+            'method': request.method,
+            'path': request.path,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'status': status,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+        # トレース(tracing.py)と突き合わせられるようにtrace idを出力する
+        if g.get('trace_span') is not None:
+            fields['trace_id'] = g.trace_span.trace.trace_id
+        logger.log(level, 'request', extra={'fields': fields})
+        return response
@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import functools
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, Response, g, request, jsonify, abort
+from werkzeug.exceptions import HTTPException
+
+import applog
+import compression
+import jsonprovider
+import metrics
+import store
+from common import events, health, tracing
+
+
+# --------------------------------------------------------------
+# backendのASGI版(Quart)。APIはapp.py(WSGI版)と同じ。
+#   boto3の呼び出しはブロッキングなので、有界のスレッドプールに逃がして並行に実行する。
+#   1 workerで多数のリクエストを同時に処理できる。
+# --------------------------------------------------------------
+dynamodb_concurrency = int(os.getenv('ASYNC_DYNAMODB_CONCURRENCY', str(store.max_pool_connections)))
+dynamodb_executor = ThreadPoolExecutor(max_workers=dynamodb_concurrency, thread_name_prefix='dynamodb')
+
+app = Quart(__name__)
+if store.json_provider == 'fast':
+    app.json = jsonprovider.FastJSONProvider(app)
+else:
+    app.json = jsonprovider.DecimalJSONProvider(app)
+metrics.init_app(app, request, g)
+applog.setup(level=store.log_level, queue_size=store.log_queue_size)
+applog.init_app(app, request, g, sample_rate=store.log_sample_rate)
+tracing.setup(store.tracing_service_name, exporter=store.tracing_exporter, file_path=store.tracing_file,
+              otlp_endpoint=store.tracing_otlp_endpoint, sample_rate=store.tracing_sample_rate,
+              server_timing=store.server_timing)
+tracing.init_async_app(app, request, g)
+if store.compress_enabled:
+    compression.init_async_app(app, request, min_size=store.compress_min_size, level=store.compress_level)
+
+
+async def run(func, *args):
+    # contextvars(トレースの現在のspan)をスレッドプールで実行する関数に引き継ぐ
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(dynamodb_executor, functools.partial(context.run, func, *args))
+
+
+async def ndjson_lines(pages):
+    # Scanのページ読み出しもスレッドプールで行い、1ページずつ送信する
+    done = object()
+    try:
+        while True:
+            page = await run(next, pages, done)
+            if page is done:
+                return
+            if page:
+                yield ''.join(app.json.dumps(item) + '\n' for item in page)
+    finally:
+        pages.close()
+
+
+async def conditional_response(body):
+    # レスポンスの内容のハッシュをETagにし、If-None-Matchが一致すれば304を返す
+    response = jsonify(body)
+    await response.add_etag()
+    return await response.make_conditional(request)
+
+
+async def get_messages(message_uuids):
+    message_uuids = list(dict.fromkeys(message_uuids))  # BatchGetItemは重複したキーを受け付けない
+    if len(message_uuids) > store.mget_max_ids:
+        abort(413, description='too many ids (max {})'.format(store.mget_max_ids))
+    json = await run(store.get_messages, message_uuids)
+    return jsonify(json), 207 if 'unprocessed' in json else 200
+
+
+@app.route('/messages/events', methods=['GET'])
+async def message_events():
+    # 新しく作成されたメッセージをserver-sent eventsで送る(Last-Event-ID以降のイベントは送り直す)
+    subscription = store.message_events.subscribe(request.headers.get('Last-Event-ID'),
+                                                  loop=asyncio.get_running_loop())
+    if subscription is None:
+        abort(503, description='too many event streams')
+    stream = events.aiter_stream(subscription, store.events_heartbeat_seconds, store.events_stream_seconds,
+                                 health.is_draining)
+    response = Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.timeout = None  # ストリームの長さはEVENTS_STREAM_SECONDSで決める
+    return response
+
+
+@app.route('/messages/_mget', methods=['POST'])
+async def mget_messages():
+    posted = await request.get_json(silent=True)
+    ids = posted.get('ids') if isinstance(posted, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(u, str) and u for u in ids):
+        abort(400, description='request body must be {"ids": ["<uuid>", ...]}')
+    return await get_messages(ids)
+
+
+@app.route('/messages', methods=['GET'])
+async def get_all_messages():
+    if 'ids' in request.args:
+        return await get_messages([u for u in request.args['ids'].split(',') if u])
+
+    if request.args.get('format') == 'ndjson':
+        # テーブル全件のエクスポート: chunkedでNDJSONを逐次送信する
+        return Response(ndjson_lines(store.scan_all_pages()), mimetype='application/x-ndjson')
+
+    try:
+        limit = store.parse_limit(request.args.get('limit'))
+    except store.InvalidLimit:
+        abort(400, description='limit must be an integer between 1 and {}'.format(store.max_page_limit))
+    cursor = request.args.get('cursor')
+    try:
+        page = await run(store.list_page, limit, cursor)
+    except store.InvalidCursor:
+        abort(400, description='invalid cursor')
+    return await conditional_response(page)
+
+
+@app.route('/messages/<message_uuid>', methods=['GET'])
+async def get_message(message_uuid):
+    message_item = await run(store.get_message, message_uuid)
+    if message_item is None:
+        abort(404, description='{} not found.'.format(message_uuid))
+    return await conditional_response(message_item)
+
+
+@app.route('/messages', methods=['POST'])
+async def create_message():
+    message_uuid = str(uuid.uuid4())
+    posted = await request.get_json(silent=True)
+    if not isinstance(posted, dict):
+        abort(400, description='request body must be a JSON object')
+    posted['uuid'] = message_uuid
+    posted.update(store.created_attributes(message_uuid))
+    await run(store.create_message, posted)
+    json = {
+        'message': '{} created.'.format(message_uuid)
+    }
+    return jsonify(json)
+
+
+async def read_batch_body():
+    # JSON配列 または NDJSON(1行1メッセージ)を受け付ける
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        return store.parse_ndjson(await request.get_data(as_text=True))
+    posted = await request.get_json(silent=True)
+    if not isinstance(posted, list):
+        abort(400, description='request body must be a JSON array or NDJSON')
+    return posted
+
+
+@app.route('/messages/batch', methods=['POST'])
+async def create_messages():
+    try:
+        items, results, supplied = store.prepare_batch(await read_batch_body())
+    except store.TooManyItems:
+        abort(413, description='too many items (max {})'.format(store.batch_max_items))
+    failed = await run(store.put_messages, items, supplied)
+    json, status = store.batch_result(results, failed)
+    return jsonify(json), status
+
+
+def expected_version(body):
+    try:
+        return store.pop_expected_version(body)
+    except store.InvalidVersion:
+        abort(400, description='version must be a non-negative integer')
+
+
+def conflict_response(e):
+    json = {
+        'message': 'version conflict',
+        'version': e.current_version
+    }
+    return jsonify(json), 409
+
+
+@app.route('/messages/<message_uuid>', methods=['PUT'])
+async def update_message(message_uuid):
+    put = await request.get_json(silent=True)
+    if not isinstance(put, dict):
+        abort(400, description='request body must be a JSON object')
+    put['uuid'] = message_uuid
+    version = expected_version(put)
+    try:
+        version = await run(store.replace_message, put, version)
+    except store.MessageNotFound:
+        abort(404, description='{} not found.'.format(message_uuid))
+    except store.VersionConflict as e:
+        return conflict_response(e)
+    json = {
+        'message': '{} updated.'.format(message_uuid),
+        'version': version
+    }
+    return jsonify(json)
+
+
+@app.route('/messages/<message_uuid>', methods=['PATCH'])
+async def patch_message(message_uuid):
+    # 指定した属性だけを更新する(値がnullの属性は削除する)
+    changes = await request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        abort(400, description='request body must be a JSON object')
+    # uuidと作成日時(created-indexのキー)は変更させない
+    for name in ('uuid',) + store.INDEX_ATTRIBUTES:
+        changes.pop(name, None)
+    version = expected_version(changes)
+    if not changes:
+        abort(400, description='no attributes to update')
+    try:
+        message_item = await run(store.update_message, message_uuid, changes, version)
+    except store.MessageNotFound:
+        abort(404, description='{} not found.'.format(message_uuid))
+    except store.VersionConflict as e:
+        return conflict_response(e)
+    json = {
+        'message': '{} updated.'.format(message_uuid),
+        'version': int(message_item['version'])
+    }
+    return jsonify(json)
+
+
+@app.route('/messages/<message_uuid>', methods=['DELETE'])
+async def delete_message(message_uuid):
+    await run(store.delete_message, message_uuid)
+    json = {
+        'message': '{} deleted'.format(message_uuid)
+    }
+    return jsonify(json)
+
+
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    return jsonify(store.cache.stats())
+
+
+@app.route('/events/stats', methods=['GET'])
+async def events_stats():
+    return jsonify(store.message_events.stats())
+
+
+@app.errorhandler(HTTPException)
+async def handle_http_error(e):
+    json = {
+        'message': e.description
+    }
+    return jsonify(json), e.code
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    return metrics.metrics_response()
+
+
+@app.route('/livez', methods=['GET'])
+@app.route('/healthz', methods=['GET'])
+async def health_check():
+    # liveness: プロセスが応答できるか(依存先は確認しない)
+    return 'OK'
+
+
+@app.route('/readyz', methods=['GET'])
+async def readiness_check():
+    # 停止中(SIGTERM・preStop)は503を返し、新しいリクエストが来ないようにする
+    if health.is_draining():
+        abort(503, description='draining')
+    # DynamoDBへの接続の準備(warm-up)が終わるまでは503を返し、Serviceに組み込まれないようにする
+    if not store.is_ready():
+        store.start_warm_up()
+        abort(503, description='warming up')
+    # DynamoDBに接続できるか(結果は READINESS_CACHE_SECONDS 秒保持する)
+    reason = await run(store.check_dynamodb)
+    if reason:
+        abort(503, description=reason)
+    return 'OK'
+
+
+if __name__ == '__main__':
+    # 開発用サーバー。本番はgunicorn + uvicorn workerで起動する
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG', '0') == '1')
@@ -0,0 +1,51 @@
+# created-indexを追加する前に作られたアイテムに、作成日時の属性(created_at/created_bucket/created_sort)を書き込む。
+# 作成日時は分からないので、実行した時刻を使う(一覧では既存のアイテムが新しいアイテムより後ろに並ぶよう、
+# --created-at で古い時刻(epoch ミリ秒)を指定できる)。
+#
+#   python backfill_created.py
+#   python backfill_created.py --created-at 0
+#
+# 既に属性があるアイテムは条件付き書き込みで変更しない(何度実行してもよい)。
+import argparse
+
+from botocore.exceptions import ClientError
+
+import store
+
+
+def backfill(created_at=None):
+    updated = 0
+    for page in store.scan_all_pages():
+        for item in page:
+            if 'created_sort' in item:
+                continue
+            attributes = store.created_attributes(item['uuid'], created_at)
+            try:
+                store.get_table().update_item(
+                    Key={
+                        'uuid': item['uuid']
+                    },
+                    UpdateExpression='SET #at = :at, #bucket = :bucket, #sort = :sort',
+                    ConditionExpression='attribute_exists(#uuid) AND attribute_not_exists(#sort)',
+                    ExpressionAttributeNames={'#uuid': 'uuid', '#at': 'created_at', '#bucket': 'created_bucket',
+                                              '#sort': 'created_sort'},
+                    ExpressionAttributeValues={':at': attributes['created_at'], ':bucket': attributes['created_bucket'],
+                                               ':sort': attributes['created_sort']}
+                )
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    raise
+                continue
+            updated += 1
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='backfill created_at attributes for created-index')
+    parser.add_argument('--created-at', type=int, help='epoch milliseconds (default: now)')
+    args = parser.parse_args()
+    print('{} items updated.'.format(backfill(args.created_at)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+import decimal
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # CACHE_BACKEND=redis の場合だけ必要
+    redis = None
+
+
+logger = logging.getLogger('backend.cache')
+
+
+class SingleFlight:
+    # 同じキーの読み込みが同時に要求されたら、最初の1つだけが読み込み、残りはその結果を待つ(プロセス内)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'value': None, 'error': None}
+            else:
+                self.coalesced += 1
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['value']
+        try:
+            call['value'] = func()
+            return call['value']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+class TTLCache:
+    # プロセス内のLRU+TTLキャッシュ。
+    # max_entriesを超えると最も使われていないエントリから捨て、ttl秒を過ぎたエントリは読み出し時に捨てる。
+    # 一覧ページのように「書き込みがあったらまとめて無効にしたい」ものは、
+    # generation()をキーに含めておき、bump_generation()で世代を進めて無効化する。
+    # 世代のカウンタは共有メモリに置く。gunicorn(preload_app)ではfork前に作られるので全workerで共有され、
+    # どのworkerで書き込んでも、他のworkerが保持しているエントリ(アイテム・一覧ページ)は
+    # それより前の世代のものとして読み出し時に捨てられる(書き込みのたびにworkerのキャッシュ全体が無効になる)。
+
+    def __init__(self, max_entries=1024, ttl=10.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = multiprocessing.Value('q', 0)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        generation = self.generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, entry_generation, value = entry
+            if expires_at < time.monotonic() or entry_generation < generation:
+                del self._entries[key]
+                if entry_generation < generation:
+                    self.invalidations += 1
+                else:
+                    self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        # generation: 値を読み込み始めたときの世代(読み込み中に書き込みがあれば、次の読み出しで捨てる)
+        if generation is None:
+            generation = self.generation()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_many(self, entries):
+        for key, value in entries.items():
+            self.set(key, value)
+
+    def get_or_load(self, key, loader):
+        # キャッシュに無ければloaderで読み込んで保存する(Noneは保存しない)。同じキーの読み込みは1回にまとめる
+        value = self.get(key)
+        if value is None:
+            value = self._flight.do(key, lambda: self._load(key, loader))
+        return value
+
+    def _load(self, key, loader):
+        generation = self.generation()
+        value = loader()
+        if value is not None:
+            self.set(key, value, generation)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def generation(self):
+        # 8バイトの読み出しはアトミックなのでロックを取らない
+        return self._generation.get_obj().value
+
+    def bump_generation(self):
+        with self._generation.get_lock():
+            self._generation.value += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'backend': 'memory',
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'generation': self.generation(),
+                'coalesced': self._flight.coalesced
+            }
+
+
+class NullCache:
+    # キャッシュ無効時に使う。常にミスする
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def get_many(self, keys):
+        return {}
+
+    def set_many(self, entries):
+        pass
+
+    def get_or_load(self, key, loader):
+        return loader()
+
+    def delete(self, key):
+        pass
+
+    def generation(self):
+        return 0
+
+    def bump_generation(self):
+        pass
+
+    def stats(self):
+        return {'enabled': False}
+
+
+def encode_value(value):
+    # DynamoDBのアイテム(Decimal・set)をJSONにする。
+    # 整数でないDecimalは{"__decimal__": "1.5"}、setは{"__set__": [...]}で表す(精度と型を保つ)
+    def default(o):
+        if isinstance(o, decimal.Decimal):
+            return int(o) if o == o.to_integral_value() else {'__decimal__': str(o)}
+        if isinstance(o, (set, frozenset)):
+            return {'__set__': sorted(o, key=str)}
+        raise TypeError(f'{type(o).__name__} is not cacheable')
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_value(raw):
+    # 数値はDynamoDBから読んだときと同じくDecimalに戻す
+    def object_hook(o):
+        if len(o) == 1 and '__set__' in o:
+            return set(o['__set__'])
+        if len(o) == 1 and '__decimal__' in o:
+            return decimal.Decimal(o['__decimal__'])
+        return o
+    return json.loads(raw, parse_int=decimal.Decimal, parse_float=decimal.Decimal, object_hook=object_hook)
+
+
+class RedisCache:
+    # 複数のbackend Podで共有するキャッシュ(Redis / ElastiCache)。TTLCacheと同じインターフェース。
+    #   - 値はJSONで保存し、ttl秒で期限切れにする
+    #   - 一覧の世代はRedisのカウンタ(INCR)なので、どのPodで書き込んでも全Podの一覧ページが無効になる
+    #   - キャッシュに無いキーの読み込みは、プロセス内ではSingleFlightで、Pod間ではロック(SET NX)で1回にまとめる。
+    #     ロックを取れなかったPodはlock_timeout秒まで値が書かれるのを待ち、それでも無ければ自分で読み込む
+    #   - 読み込みの間に世代が進んだ(どこかで書き込みがあった)場合、読み込んだ値は保存しない(TTLCacheと同じ)
+    #   - Redisに接続できない場合はキャッシュが無いものとして動く(リクエストは失敗させない)
+
+    def __init__(self, client, ttl=10.0, prefix='messages', lock_timeout=1.0, poll_interval=0.01):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.lock_waits = 0
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND=redis requires the redis package')
+        # 接続は最初のコマンドで作られる(preload_appでもfork後のworkerごとに接続する)
+        client = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2, health_check_interval=30)
+        return cls(client, **kwargs)
+
+    def _key(self, key):
+        return self.prefix + ':' + json.dumps(key, separators=(',', ':'))
+
+    def _count(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def _error(self, operation, e):
+        self._count('errors')
+        logger.warning('redis %s failed: %s', operation, e)
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self._key(key))
+        except Exception as e:
+            self._error('get', e)
+            return None
+        if raw is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return decode_value(raw)
+
+    def set(self, key, value):
+        try:
+            self.client.set(self._key(key), encode_value(value), px=int(self.ttl * 1000))
+        except TypeError:
+            pass
+        except Exception as e:
+            self._error('set', e)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            raws = self.client.mget([self._key(key) for key in keys])
+        except Exception as e:
+            self._error('mget', e)
+            return {}
+        found = {key: decode_value(raw) for key, raw in zip(keys, raws) if raw is not None}
+        self._count('hits', len(found))
+        self._count('misses', len(keys) - len(found))
+        return found
+
+    def set_many(self, entries):
+        if not entries:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for key, value in entries.items():
+                pipe.set(self._key(key), encode_value(value), px=int(self.ttl * 1000))
+            pipe.execute()
+        except TypeError:
+            pass
+        except Exception as e:
+            self._error('set_many', e)
+
+    def get_or_load(self, key, loader):
+        value = self.get(key)
+        if value is None:
+            value = self._flight.do(key, lambda: self._load(key, loader))
+        return value
+
+    def _load(self, key, loader):
+        lock_key = self._key(key) + ':lock'
+        token = uuid.uuid4().hex
+        try:
+            locked = bool(self.client.set(lock_key, token, nx=True, px=int(self.lock_timeout * 1000)))
+            contended = not locked
+        except Exception as e:
+            self._error('lock', e)
+            locked = contended = False
+        if contended:
+            # 他のPodが読み込み中: 値が書かれるのを待つ
+            self._count('lock_waits')
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                value = self.get(key)
+                if value is not None:
+                    return value
+        # 読み込み中に(どのPodでも)書き込みがあれば、読んだ値は古いかもしれないので保存しない
+        generation = self.generation()
+        value = loader()
+        if value is not None and self.generation() == generation:
+            self.set(key, value)
+        if locked:
+            try:
+                if self.client.get(lock_key) == token.encode('ascii'):
+                    self.client.delete(lock_key)
+            except Exception as e:
+                self._error('unlock', e)
+        return value
+
+    def delete(self, key):
+        try:
+            self.client.delete(self._key(key))
+        except Exception as e:
+            self._error('delete', e)
+
+    def generation(self):
+        try:
+            generation = self.client.get(self.prefix + ':generation')
+        except Exception as e:
+            self._error('generation', e)
+            # 世代が分からない間は一覧ページをキャッシュしても使い回されないようにする
+            return 'unavailable-' + uuid.uuid4().hex
+        return int(generation or 0)
+
+    def bump_generation(self):
+        try:
+            self.client.incr(self.prefix + ':generation')
+        except Exception as e:
+            self._error('bump_generation', e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'backend': 'redis',
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'lock_waits': self.lock_waits,
+                'coalesced': self._flight.coalesced
+            }
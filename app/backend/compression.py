@@ -0,0 +1,89 @@
+import zlib
+
+
+# --------------------------------------------------------------
+# レスポンス圧縮(gzip/deflate)
+#   Accept-Encodingで受け付けるエンコーディングを選び、min_sizeバイト以上のJSON/NDJSONを圧縮する。
+#   ストリーミングのレスポンス(NDJSONエクスポート)は逐次圧縮し、chunk(Scanの1ページ)ごとにZ_SYNC_FLUSHで
+#   送り出す(flushしないと圧縮器が出力を溜め込み、最後まで何も届かない)。
+#   圧縮したレスポンスのETagは弱いETag(W/"...")にする(If-None-Matchは弱い比較なので304はそのまま返る)。
+# --------------------------------------------------------------
+ENCODINGS = ('gzip', 'deflate')
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/html')
+
+
+def compressor(encoding, level):
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def compress(data, encoding, level):
+    c = compressor(encoding, level)
+    return c.compress(data) + c.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    c = compressor(encoding, level)
+    for chunk in chunks:
+        yield c.compress(chunk.encode() if isinstance(chunk, str) else chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+    yield c.flush()
+
+
+async def compress_async_stream(body, encoding, level):
+    c = compressor(encoding, level)
+    async with body as chunks:
+        async for chunk in chunks:
+            yield c.compress(chunk.encode() if isinstance(chunk, str) else chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+    yield c.flush()
+
+
+def negotiate(request, response, min_size):
+    # 圧縮するエンコーディングを返す。圧縮しない場合はNone
+    if response.status_code not in (200, 207) or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return None
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        return None
+    # Content-Lengthが無いのはストリーミングのレスポンス
+    if response.content_length is not None and response.content_length < min_size:
+        return None
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+def mark_encoded(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def init_app(app, request, min_size=1024, level=1):
+
+    @app.after_request
+    def compress_response(response):
+        encoding = negotiate(request, response, min_size)
+        if encoding is None:
+            return response
+        if response.content_length is None:
+            response.response = compress_stream(response.response, encoding, level)
+        else:
+            response.set_data(compress(response.get_data(), encoding, level))
+        mark_encoded(response, encoding)
+        return response
+
+
+def init_async_app(app, request, min_size=1024, level=1):
+    # Quart版: レスポンスのbodyの読み書きが非同期になる
+
+    @app.after_request
+    async def compress_response(response):
+        encoding = negotiate(request, response, min_size)
+        if encoding is None:
+            return response
+        if response.content_length is None:
+            response.response = response.iterable_body_class(
+                compress_async_stream(response.response, encoding, level))
+        else:
+            response.set_data(compress(await response.get_data(), encoding, level))
+        mark_encoded(response, encoding)
+        return response
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import jsonprovider
+
+try:
+    import redis
+except ImportError:  # EVENTS_BACKEND=redis の場合だけ必要
+    redis = None
+
+
+# --------------------------------------------------------------
+# 新しいメッセージの通知(pub/sub)
+#   プロセス内のpub/sub(EventHub)とSSEのレスポンスは common/events.py
+#   SocketEventBus: 同じPodのworker間にUnixドメインソケットでイベントを配り、受け取ったイベントをEventHubに渡す
+#   RedisEventBus: Redisのpub/subでPod・worker間にイベントを配り、受け取ったイベントをEventHubに渡す
+# --------------------------------------------------------------
+logger = logging.getLogger('backend.events')
+
+
+def to_events(items):
+    # メッセージのアイテムを(id, data)のリストにする(JSONへの変換は購読者の数によらず1回)
+    return [(item['created_sort'], json.dumps(item, default=jsonprovider.default, ensure_ascii=False,
+                                              separators=(',', ':')))
+            for item in items if item.get('created_sort')]
+
+
+def remove_sockets(directory):
+    # 前回起動時のworkerのソケットを消す(gunicornのmasterのon_startingで呼ぶ)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        if name.endswith('.sock'):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+class SocketEventBus:
+    # EVENTS_BACKEND=memory: 同じPod(gunicornのmaster)のworker間でイベントを配る。
+    # workerごとにUnixドメインソケット(datagram)を <directory>/<pid>.sock に作り、publish()は自分のEventHubに
+    # 配ってから、ディレクトリにある他のworkerのソケットに送る。受信スレッドが受け取ってEventHubに渡す。
+    # ソケットはstart()(gunicornのpost_worker_init)か最初のpublish()/subscribe()で、fork後のworkerで作る。
+    # 終了したworkerのソケット(接続できない)は削除する。ソケットを作れなければこのプロセスの購読者にだけ配る。
+
+    def __init__(self, directory, hub, max_datagram=60000, send_timeout=0.2):
+        self.directory = directory
+        self.hub = hub
+        self.max_datagram = max_datagram
+        self.send_timeout = send_timeout
+        self.errors = 0
+        self._pid = None
+        self._path = None
+        self._sender = None
+        self._lock = threading.Lock()
+
+    def _error(self, operation, e):
+        with self._lock:
+            self.errors += 1
+        logger.warning('events socket %s failed: %s', operation, e)
+
+    def publish(self, events):
+        if not events:
+            return
+        self.hub.dispatch(events)
+        if not self.start():
+            return
+        try:
+            peers = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                     if name.endswith('.sock')]
+        except OSError as e:
+            self._error('listdir', e)
+            return
+        datagrams = list(self._encode(events))
+        for path in peers:
+            if path == self._path:
+                continue
+            for datagram in datagrams:
+                try:
+                    self._sender.sendto(datagram, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # 終了したworkerのソケット
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    break
+                except OSError as e:
+                    # 受信側が詰まっているなど: そのworkerの購読者には届かない
+                    self._error('send', e)
+                    break
+
+    def _encode(self, events):
+        # 1つのdatagramに収まるように分けてJSONにする
+        chunk, size = [], 0
+        for event in events:
+            encoded = json.dumps(event)
+            if chunk and size + len(encoded) + 1 > self.max_datagram:
+                yield ('[' + ','.join(chunk) + ']').encode()
+                chunk, size = [], 0
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        if chunk:
+            yield ('[' + ','.join(chunk) + ']').encode()
+
+    def subscribe(self, last_event_id=None, loop=None):
+        self.start()
+        return self.hub.subscribe(last_event_id, loop=loop)
+
+    def start(self):
+        # このプロセスのソケットを作って受信スレッドを起動する(fork後は作り直す)。作れなければFalse
+        with self._lock:
+            if self._pid == os.getpid():
+                return self._sender is not None
+            self._pid = os.getpid()
+            self._path = os.path.join(self.directory, f'{self._pid}.sock')
+            self._sender = None
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if os.path.exists(self._path):
+                    os.remove(self._path)
+                receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                receiver.bind(self._path)
+                sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sender.settimeout(self.send_timeout)
+            except (AttributeError, OSError) as e:  # AttributeError: AF_UNIXが無い(Windows)
+                self.errors += 1
+                logger.warning('events socket bind failed: %s', e)
+                return False
+            self._sender = sender
+            threading.Thread(target=self._listen, args=(receiver,), name='events', daemon=True).start()
+            return True
+
+    def _listen(self, receiver):
+        while True:
+            try:
+                datagram = receiver.recv(1 << 18)
+                self.hub.dispatch([tuple(event) for event in json.loads(datagram)])
+            except Exception as e:
+                self._error('receive', e)
+
+    def stats(self):
+        return dict(self.hub.stats(), backend='memory', errors=self.errors)
+
+
+class RedisEventBus:
+    # publish()はRedisのチャンネルに送り、リスナーのスレッドが受け取ってEventHubに渡す(自分が送ったものも含む)。
+    # リスナーはstart()(gunicornのpost_worker_init)か最初のpublish()/subscribe()で、fork後のworkerで起動する。
+    # Redisに送れなかったイベントは、このプロセスの購読者にだけ配る。
+
+    def __init__(self, client, channel, hub, poll_interval=1.0, backoff_max=5.0):
+        self.client = client
+        self.channel = channel
+        self.hub = hub
+        self.poll_interval = poll_interval
+        self.backoff_max = backoff_max
+        self.errors = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url, channel, hub):
+        if redis is None:
+            raise RuntimeError('EVENTS_BACKEND=redis requires the redis package')
+        client = redis.Redis.from_url(url, socket_timeout=2.0, socket_connect_timeout=0.2, health_check_interval=30)
+        return cls(client, channel, hub)
+
+    def publish(self, events):
+        if not events:
+            return
+        self.start()
+        try:
+            self.client.publish(self.channel, json.dumps(events))
+        except Exception as e:
+            self.errors += 1
+            logger.warning('redis publish failed: %s', e)
+            self.hub.dispatch(events)
+
+    def subscribe(self, last_event_id=None, loop=None):
+        self.start()
+        return self.hub.subscribe(last_event_id, loop=loop)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='events', daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        attempt = 0
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                while True:
+                    message = pubsub.get_message(timeout=self.poll_interval)
+                    attempt = 0
+                    if message and message['type'] == 'message':
+                        self.hub.dispatch([tuple(event) for event in json.loads(message['data'])])
+            except Exception as e:
+                self.errors += 1
+                logger.warning('redis subscribe failed: %s', e)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            attempt += 1
+            time.sleep(min(self.backoff_max, 0.1 * 2 ** attempt))
+
+    def stats(self):
+        return dict(self.hub.stats(), backend='redis', errors=self.errors)
@@ -0,0 +1,30 @@
+# 本番用のgunicorn設定
+#   gunicorn --config gunicorn.conf.py app:app
+# 共通の設定は common/gunicorn_conf.py(gunicornはカレントディレクトリをsys.pathに加えてから読み込む)。
+# ASGI版(backend/asgi.py)は GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker で起動する。
+from common import gunicorn_conf
+# 共通の設定(worker数・タイムアウト・メトリクスファイルとdrainファイルの後始末)
+from common.gunicorn_conf import (  # noqa: F401
+    bind, workers, worker_class, threads, preload_app, timeout, graceful_timeout, keepalive, errorlog, loglevel,
+    child_exit
+)
+
+# アクセスログはアプリの構造化ログ(applog.py)でリクエストごとに1行出力するので無効にする
+accesslog = None
+
+
+def on_starting(server):
+    gunicorn_conf.on_starting(server)
+    # 前回起動時のworkerのソケット(EVENTS_BACKEND=memoryでworker間にイベントを配る)を消す
+    import events
+    import store
+    events.remove_sockets(store.events_socket_dir)
+
+
+def post_worker_init(worker):
+    gunicorn_conf.post_worker_init(worker)
+    # workerごとにDynamoDBへの接続をバックグラウンドで準備する(終わるまで /readyz は503)
+    import store
+    store.start_warm_up()
+    # 他のworker・Podからのイベントを起動直後から受け取る(再接続したクライアントに送り直せるように)
+    store.message_events.start()
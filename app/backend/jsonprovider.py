@@ -0,0 +1,68 @@
+import decimal
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjsonが無い環境では標準のjsonモジュールで変換する
+    orjson = None
+
+
+# --------------------------------------------------------------
+# JSONの変換(Flask/Quart共通)
+#   boto3はDynamoDBの数値をDecimalで返す。Flask標準のproviderはDecimalを文字列にし、
+#   変換も遅いので、整数はint・それ以外はfloatとしてJSONの数値にする。
+#   orjsonがあればdumps/loads/responseをorjsonで行う(キーはFlask標準と同じくソートする)。
+#   リクエストのJSONの小数はDecimalとして読む(boto3はfloatを書き込めずTypeErrorになる)。
+# --------------------------------------------------------------
+def default(o):
+    if isinstance(o, decimal.Decimal):
+        return int(o) if o == o.to_integral_value() else float(o)
+    if isinstance(o, (set, frozenset)):  # DynamoDBのString Set / Number Set
+        return sorted(o)
+    return DefaultJSONProvider.default(o)
+
+
+def decimal_floats(o):
+    # orjsonはparse_floatを指定できないので、読み込んだ後でfloatをDecimalにする
+    if isinstance(o, float):
+        return decimal.Decimal(repr(o))
+    if isinstance(o, dict):
+        return {key: decimal_floats(value) for key, value in o.items()}
+    if isinstance(o, list):
+        return [decimal_floats(value) for value in o]
+    return o
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+
+class DecimalJSONProvider(DefaultJSONProvider):
+    # JSON_PROVIDER=default: 変換はFlask標準のまま、小数だけDecimalとして読む
+
+    def loads(self, s, **kwargs):
+        kwargs.setdefault('parse_float', decimal.Decimal)
+        return super().loads(s, **kwargs)
+
+
+class FastJSONProvider(DecimalJSONProvider):
+    ensure_ascii = False
+    default = staticmethod(default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return decimal_floats(orjson.loads(s))
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug:  # debug時はFlask標準と同じく整形して返す
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=default, option=ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -0,0 +1,47 @@
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from common import tracing
+# HTTPリクエストのメトリクスと /metrics は共通(app.pyから metrics.init_app / metrics.metrics_response で使う)
+from common.metrics import init_app, metrics_response, registry  # noqa: F401
+
+
+# --------------------------------------------------------------
+# backendのPrometheusメトリクス(common/metrics.py の registry に登録する)
+# --------------------------------------------------------------
+DYNAMODB_LATENCY = Histogram(
+    'dynamodb_operation_duration_seconds', 'DynamoDB operation latency', ['operation'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5), registry=registry
+)
+DYNAMODB_CAPACITY = Counter(
+    'dynamodb_consumed_capacity_units_total', 'DynamoDB consumed capacity units', ['operation', 'table'],
+    registry=registry
+)
+DYNAMODB_WARMUP = Gauge(
+    'dynamodb_warmup_duration_seconds', 'Seconds spent warming up the DynamoDB client', multiprocess_mode='liveall',
+    registry=registry
+)
+
+
+def observe_dynamodb(operation, func, **kwargs):
+    # ReturnConsumedCapacityを付けてDynamoDBを呼び出し、所要時間と消費キャパシティを記録する
+    # (トレースでは dynamodb.<operation> のspan、Server-Timingでは dynamodb に数える)
+    with tracing.span(f'dynamodb.{operation}', kind=tracing.CLIENT, timing='dynamodb',
+                      **{'db.system': 'dynamodb', 'db.operation': operation}) as span:
+        started = time.perf_counter()
+        try:
+            db_response = func(ReturnConsumedCapacity='TOTAL', **kwargs)
+        finally:
+            DYNAMODB_LATENCY.labels(operation).observe(time.perf_counter() - started)
+        consumed = db_response.get('ConsumedCapacity') or []
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        for capacity in consumed:
+            DYNAMODB_CAPACITY.labels(operation, capacity.get('TableName', '')).inc(capacity.get('CapacityUnits', 0))
+            span.set('aws.dynamodb.consumed_capacity', capacity.get('CapacityUnits', 0))
+        return db_response
+
+
+def record_warm_up(seconds):
+    DYNAMODB_WARMUP.set(seconds)
@@ -0,0 +1,805 @@
+import base64
+import binascii
+import decimal
+import heapq
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from cache import TTLCache, NullCache, RedisCache
+from common.events import EventHub
+from common.health import CachedCheck
+from common.tracing import propagate
+from events import RedisEventBus, SocketEventBus, to_events
+from metrics import observe_dynamodb, record_warm_up
+
+
+logger = logging.getLogger('backend.store')
+
+
+# --------------------------------------------------------------
+# messagesテーブルへのアクセス(キャッシュを含む)
+#   WSGI版(app.py)とASGI版(asgi.py)で共有する
+# --------------------------------------------------------------
+region_name = os.getenv('AWS_DEFAULT_REGION', 'ap-northeast-1')
+table_name = os.getenv('DYNAMODB_TABLE_NAME', 'messages')
+# DynamoDB Localなどに接続する場合に指定する
+endpoint_url = os.getenv('DYNAMODB_ENDPOINT_URL') or None
+# boto3のHTTPコネクションプールの大きさ(同時に実行するDynamoDB呼び出し数に合わせる)
+max_pool_connections = int(os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', '50'))
+# 全件読み出し(エクスポート)時の並列Scanのセグメント数とスレッド数
+scan_segments = int(os.getenv('DYNAMODB_SCAN_SEGMENTS', '1'))
+scan_workers = int(os.getenv('DYNAMODB_SCAN_WORKERS', str(scan_segments)))
+page_limit = int(os.getenv('MESSAGES_PAGE_LIMIT', '20'))
+# 一覧(GET /messages)の読み方: query(created-indexを新しい順にQuery) または scan(以前の全件Scan)
+list_mode = os.getenv('MESSAGES_LIST_MODE', 'query')
+created_index = os.getenv('DYNAMODB_CREATED_INDEX', 'created-index')
+# created-indexのパーティション(バケット)数。書き込みを分散する。既存のアイテムがある場合は減らさないこと
+created_buckets = int(os.getenv('MESSAGES_CREATED_BUCKETS', '4'))
+max_page_limit = int(os.getenv('MESSAGES_MAX_PAGE_LIMIT', '100'))
+# POST /messages/batch: 1リクエストの最大件数と、UnprocessedItemsの再送回数・待ち時間(秒)
+batch_max_items = int(os.getenv('MESSAGES_BATCH_MAX_ITEMS', '1000'))
+batch_max_attempts = int(os.getenv('MESSAGES_BATCH_MAX_ATTEMPTS', '5'))
+batch_backoff_base = float(os.getenv('MESSAGES_BATCH_BACKOFF_BASE', '0.05'))
+batch_backoff_max = float(os.getenv('MESSAGES_BATCH_BACKOFF_MAX', '1.0'))
+# PUT(version指定なし): 読んでから書くまでに他の書き込みがあった場合に、読み直して書き直す最大回数
+put_max_attempts = int(os.getenv('MESSAGES_PUT_MAX_ATTEMPTS', '5'))
+# GET /messages?ids=... / POST /messages/_mget: 1リクエストで取得できる最大件数
+mget_max_ids = int(os.getenv('MESSAGES_MGET_MAX_IDS', '1000'))
+# ログ: レベル、成功したリクエストのログを出力する割合、ログキューの大きさ
+log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+log_sample_rate = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+log_queue_size = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# トレース: 書き出し先(none / file / otlp)、書き出すトレースの割合(traceparentで引き継いだものは呼び出し元に従う)
+tracing_exporter = os.getenv('TRACING_EXPORTER', 'none')
+tracing_file = os.getenv('TRACING_FILE', '/tmp/traces.jsonl')
+tracing_otlp_endpoint = os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+tracing_sample_rate = float(os.getenv('TRACING_SAMPLE_RATE', '1.0'))
+tracing_service_name = os.getenv('TRACING_SERVICE_NAME', 'backend')
+# レスポンスにServer-Timingヘッダー(dynamodb・totalの所要時間)を付ける
+server_timing = os.getenv('SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes')
+# JSONの変換: fast(orjsonがあれば使い、DecimalはJSONの数値にする) または default(Flask標準)
+json_provider = os.getenv('JSON_PROVIDER', 'fast')
+# レスポンス圧縮(gzip/deflate): この大きさ(バイト)未満のレスポンスは圧縮しない
+compress_enabled = os.getenv('COMPRESS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+compress_min_size = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+compress_level = int(os.getenv('COMPRESS_LEVEL', '1'))  # 1: CPUをあまり使わずに大半のサイズを削れる
+# get_messageの結果と一覧ページをプロセス内にキャッシュする
+cache_enabled = os.getenv('CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+cache_max_entries = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+cache_ttl_seconds = float(os.getenv('CACHE_TTL_SECONDS', '10'))
+# キャッシュの置き場所: memory(プロセス内) または redis(backendのPod間で共有する。ElastiCache)
+cache_backend = os.getenv('CACHE_BACKEND', 'memory')
+cache_redis_url = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+cache_redis_prefix = os.getenv('CACHE_REDIS_PREFIX', table_name)
+# キャッシュに無いキーを別のPodが読み込み中のとき、値が書かれるのを待つ最大の秒数
+cache_lock_timeout = float(os.getenv('CACHE_LOCK_TIMEOUT', '1.0'))
+# GET /messages/events(新しいメッセージの通知)
+#   memory: 同じPodのworker間でUnixドメインソケット(EVENTS_SOCKET_DIR)を使って配る(空にするとプロセス内だけ)
+#   redis: Pod・worker間で共有する
+events_backend = os.getenv('EVENTS_BACKEND', cache_backend)
+events_socket_dir = os.getenv('EVENTS_SOCKET_DIR', '/tmp/backend-events')
+events_redis_url = os.getenv('EVENTS_REDIS_URL', cache_redis_url)
+events_channel = os.getenv('EVENTS_CHANNEL', f'{table_name}:events')
+# 再接続したクライアントに送り直すために保持するイベント数
+events_buffer_size = int(os.getenv('EVENTS_BUFFER_SIZE', '1000'))
+# 1プロセスで同時に開けるストリーム数(gthread workerでは1本につき1スレッドを使うので、既定はスレッド数 - 2)。
+# frontendはworkerごとに1本読むので、EKSではfrontendの最大のworker数から決める(_stacks/eks.py)
+events_max_streams = int(os.getenv('EVENTS_MAX_STREAMS', str(max(1, int(os.getenv('GUNICORN_THREADS', '4')) - 2))))
+events_heartbeat_seconds = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', '15'))
+# この秒数でストリームを終え、クライアントに再接続させる(Pod間の偏りを直す)
+events_stream_seconds = float(os.getenv('EVENTS_STREAM_SECONDS', '300'))
+# /readyz: DynamoDBへの接続を確認した結果を保持する秒数
+readiness_cache_seconds = float(os.getenv('READINESS_CACHE_SECONDS', '5'))
+
+boto_config = Config(max_pool_connections=max_pool_connections)
+# boto3のresourceはimport時ではなく最初に使うときに作る(get_db()/get_table())。
+# gunicorn(preload_app)ではforkしたworkerの中で作られるので、接続をプロセス間で共有しない
+db = None
+table = None
+_client_lock = threading.RLock()
+_warm = threading.Event()
+_warm_up_thread = None
+
+scan_executor = ThreadPoolExecutor(max_workers=max(1, scan_workers), thread_name_prefix='scan')
+query_executor = ThreadPoolExecutor(max_workers=max(1, created_buckets), thread_name_prefix='query')
+_thread_local = threading.local()
+_SEGMENT_DONE = object()
+
+if not cache_enabled:
+    cache = NullCache()
+elif cache_backend == 'redis':
+    cache = RedisCache.from_url(cache_redis_url, ttl=cache_ttl_seconds, prefix=cache_redis_prefix,
+                                lock_timeout=cache_lock_timeout)
+else:
+    cache = TTLCache(max_entries=cache_max_entries, ttl=cache_ttl_seconds)
+
+message_events = EventHub(buffer_size=events_buffer_size, max_subscribers=events_max_streams)
+if events_backend == 'redis':
+    message_events = RedisEventBus.from_url(events_redis_url, events_channel, message_events)
+elif events_socket_dir:
+    message_events = SocketEventBus(events_socket_dir, message_events)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class InvalidLimit(ValueError):
+    pass
+
+
+class TooManyItems(ValueError):
+    pass
+
+
+class InvalidVersion(ValueError):
+    pass
+
+
+class MessageNotFound(Exception):
+    pass
+
+
+class VersionConflict(Exception):
+
+    def __init__(self, current_version):
+        super().__init__(current_version)
+        self.current_version = current_version
+
+
+def encode_cursor(last_evaluated_key):
+    # LastEvaluatedKey -> クライアントに渡す不透明なカーソル文字列
+    if not last_evaluated_key:
+        return None
+    raw = json.dumps(last_evaluated_key, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    # カーソル文字列 -> ExclusiveStartKey
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        start_key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, binascii.Error):
+        raise InvalidCursor(cursor)
+    if not isinstance(start_key, dict):
+        raise InvalidCursor(cursor)
+    return start_key
+
+
+def parse_limit(raw):
+    # ?limit= の値。指定が無ければ page_limit、整数でないか1〜max_page_limitの範囲外ならInvalidLimit
+    if raw is None:
+        return page_limit
+    try:
+        limit = int(raw)
+    except ValueError:
+        raise InvalidLimit(raw)
+    if not 1 <= limit <= max_page_limit:
+        raise InvalidLimit(raw)
+    return limit
+
+
+def scan_page(limit, cursor=None):
+    # Scanは1ページ(limit件)だけ読み、続きはLastEvaluatedKeyをカーソルとして返す
+    # (テーブルのキーはuuidだけなので、カーソルは {'uuid': <文字列>} に限る)
+    kwargs = {'Limit': limit}
+    if cursor:
+        start_key = decode_cursor(cursor)
+        if list(start_key) != ['uuid'] or not isinstance(start_key['uuid'], str):
+            raise InvalidCursor(cursor)
+        kwargs['ExclusiveStartKey'] = start_key
+    db_response = observe_dynamodb('scan', get_table().scan, **kwargs)
+    return {
+        'items': db_response['Items'],
+        'next_cursor': encode_cursor(db_response.get('LastEvaluatedKey'))
+    }
+
+
+# --------------------------------------------------------------
+# 作成日時の順の一覧(created-index)
+#   アイテムには作成時に次の属性を書き込む
+#     created_at:     作成日時(epoch ミリ秒)
+#     created_bucket: uuidから決まるバケット番号(GSIのパーティションキー。書き込みを分散する)
+#     created_sort:   '<created_atを13桁にゼロ埋め>#<uuid>'(GSIのソートキー。同じ時刻でも一意)
+#   新しい順のN件は、全バケットをそれぞれ新しい順にN件までQueryしてマージする。
+#   読み出す量はページの大きさ×バケット数で決まり、テーブルの大きさによらない。
+#   前のページ(prev_cursor)は、ページの先頭のアイテムより新しいものを古い順にN件読んで作る
+#   (「前へ」のためにこれまでのカーソルを持ち回らない)。
+# --------------------------------------------------------------
+INDEX_ATTRIBUTES = ('created_at', 'created_bucket', 'created_sort')
+
+
+def created_attributes(message_uuid, created_at=None):
+    if created_at is None:
+        created_at = int(time.time() * 1000)
+    return {
+        'created_at': created_at,
+        'created_bucket': str(zlib.crc32(message_uuid.encode('utf-8')) % created_buckets),
+        'created_sort': '{:013d}#{}'.format(created_at, message_uuid)
+    }
+
+
+def query_bucket(bucket, limit, before=None, after=None):
+    # 1つのバケットを新しい順にlimit件まで読む(1MBの制限でページが分かれた場合は続きも読む)。
+    # afterを指定した場合は、それより新しいアイテムを古い順に読む
+    names = {'#bucket': 'created_bucket'}
+    values = {':bucket': bucket}
+    condition = '#bucket = :bucket'
+    if before is not None:
+        names['#sort'] = 'created_sort'
+        values[':before'] = before
+        condition += ' AND #sort < :before'
+    elif after is not None:
+        names['#sort'] = 'created_sort'
+        values[':after'] = after
+        condition += ' AND #sort > :after'
+    kwargs = {
+        'IndexName': created_index,
+        'KeyConditionExpression': condition,
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values,
+        'ScanIndexForward': after is not None
+    }
+    query_table = segment_table() if created_buckets > 1 else get_table()
+    items = []
+    while True:
+        db_response = observe_dynamodb('query', query_table.query, Limit=limit - len(items), **kwargs)
+        items.extend(db_response['Items'])
+        last_evaluated_key = db_response.get('LastEvaluatedKey')
+        if not last_evaluated_key or len(items) >= limit:
+            return items, last_evaluated_key is not None
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def query_buckets(limit, before=None, after=None):
+    # 全バケットを読んでcreated_sortの順(afterなら古い順、それ以外は新しい順)にマージし、
+    # (アイテム, 続きがあるか)を返す
+    buckets = [str(bucket) for bucket in range(created_buckets)]
+    if len(buckets) == 1:
+        results = [query_bucket(buckets[0], limit, before, after)]
+    else:
+        results = list(query_executor.map(
+            propagate(lambda bucket: query_bucket(bucket, limit, before, after)), buckets))
+    merged = list(heapq.merge(*(items for items, _ in results),
+                              key=lambda item: item['created_sort'], reverse=after is None))
+    return merged[:limit], len(merged) > limit or any(more for _, more in results)
+
+
+def query_page(limit, cursor=None):
+    # カーソルは {'created_sort': 前のページの最後のアイテム}(これより古いアイテムから続きを返す)
+    # または {'after': 次のページの最初のアイテム}(これより新しいアイテムを返す。「前へ」)
+    before = after = None
+    if cursor:
+        start_key = decode_cursor(cursor)
+        before, after = start_key.get('created_sort'), start_key.get('after')
+        if not isinstance(before if after is None else after, str) or (before is not None and after is not None):
+            raise InvalidCursor(cursor)
+    if after is not None:
+        items, has_newer = query_buckets(limit, after=after)
+        if not has_newer:
+            # これより新しいアイテムは1ページ分以下: 1ページ目を返す
+            return query_page(limit)
+        items.reverse()
+        has_more = True
+    else:
+        items, has_more = query_buckets(limit, before=before)
+        has_newer = bool(cursor)
+    return {
+        'items': items,
+        'next_cursor': encode_cursor({'created_sort': items[-1]['created_sort']}) if has_more and items else None,
+        'prev_cursor': encode_cursor({'after': items[0]['created_sort']}) if has_newer and items else None
+    }
+
+
+def list_page(limit, cursor=None):
+    # 書き込みがあると世代が進み、それ以前にキャッシュしたページは使われなくなる
+    cache_key = ('page', cache.generation(), limit, cursor)
+    load_page = query_page if list_mode == 'query' else scan_page
+    return cache.get_or_load(cache_key, lambda: load_page(limit, cursor))
+
+
+def get_db():
+    global db
+    if db is None:
+        with _client_lock:
+            if db is None:
+                db = boto3.resource('dynamodb', region_name=region_name, endpoint_url=endpoint_url,
+                                    config=boto_config)
+    return db
+
+
+def get_table():
+    global table
+    if table is None:
+        with _client_lock:
+            if table is None:
+                table = get_db().Table(table_name)
+    return table
+
+
+def warm_up():
+    # DescribeTableを1回呼んで、認証情報の取得・エンドポイントの解決・TLS接続を済ませておく
+    started = time.perf_counter()
+    try:
+        get_table().meta.client.describe_table(TableName=table_name)
+    except Exception:
+        logger.warning('DynamoDB warm-up failed', exc_info=True)
+        return
+    record_warm_up(time.perf_counter() - started)
+    _warm.set()
+
+
+def start_warm_up():
+    # warm-upをバックグラウンドで1回だけ実行する(失敗した場合は次の呼び出しでやり直す)
+    global _warm_up_thread
+    with _client_lock:
+        if _warm.is_set() or (_warm_up_thread is not None and _warm_up_thread.is_alive()):
+            return
+        _warm_up_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+        _warm_up_thread.start()
+
+
+def is_ready():
+    return _warm.is_set()
+
+
+def check_table():
+    # DescribeTable(読み込み容量を消費しない)でテーブルが使える状態かを確認する
+    status = get_table().meta.client.describe_table(TableName=table_name)['Table']['TableStatus']
+    if status not in ('ACTIVE', 'UPDATING'):
+        return f'table {table_name} is {status}'
+    return None
+
+
+check_dynamodb = CachedCheck(check_table, ttl=readiness_cache_seconds)
+
+
+def segment_table():
+    # boto3のresourceはスレッド間で共有できないため、Scan用スレッドごとに作成する
+    if not hasattr(_thread_local, 'table'):
+        session = boto3.session.Session()
+        resource = session.resource('dynamodb', region_name=region_name, endpoint_url=endpoint_url,
+                                    config=boto_config)
+        _thread_local.table = resource.Table(table_name)
+    return _thread_local.table
+
+
+def scan_pages(scan_table, **kwargs):
+    # LastEvaluatedKeyを辿って1ページずつ返す
+    while True:
+        db_response = observe_dynamodb('scan', scan_table.scan, **kwargs)
+        yield db_response['Items']
+        last_evaluated_key = db_response.get('LastEvaluatedKey')
+        if not last_evaluated_key:
+            return
+        kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+
+def parallel_scan(total_segments):
+    # Segment/TotalSegmentsでテーブルを分割し、scan_executorのスレッドで並列にScanする。
+    # 各セグメントの結果はページ単位でキューに入れ、呼び出し側へ到着順に流す。
+    # キューは有界なので、読み出し側が遅い場合はScan側が待つ(メモリ使用量は一定)。
+    pages = queue.Queue(maxsize=total_segments * 2)
+    cancelled = threading.Event()
+
+    def put(page):
+        while not cancelled.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def scan_segment(segment):
+        try:
+            for page in scan_pages(segment_table(), Segment=segment, TotalSegments=total_segments):
+                if cancelled.is_set():
+                    return
+                put(page)
+        except Exception as e:
+            put(e)
+        finally:
+            put(_SEGMENT_DONE)
+
+    for segment in range(total_segments):
+        scan_executor.submit(propagate(scan_segment), segment)
+
+    remaining = total_segments
+    try:
+        while remaining:
+            page = pages.get()
+            if page is _SEGMENT_DONE:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+    finally:
+        # 途中でクライアントが切断した場合なども残りのScanを止める
+        cancelled.set()
+
+
+def scan_all_pages():
+    # 全ページをScanしながら1ページずつ返す(メモリ上には数ページ分しか保持しない)
+    if scan_segments > 1:
+        return parallel_scan(scan_segments)
+    return scan_pages(get_table())
+
+
+def load_message(message_uuid):
+    db_response = observe_dynamodb(
+        'get_item',
+        get_table().get_item,
+        Key={
+            'uuid': message_uuid
+        }
+    )
+    return db_response.get('Item')
+
+
+def get_message(message_uuid):
+    # 存在しなければNoneを返す(存在しないことはキャッシュしない)
+    return cache.get_or_load(('message', message_uuid), lambda: load_message(message_uuid))
+
+
+def put_message(message_item):
+    observe_dynamodb(
+        'put_item',
+        get_table().put_item,
+        Item=message_item
+    )
+    # 世代を進めてから保存する(先に保存すると、世代で無効化するキャッシュでは保存したエントリも捨てられる)
+    cache.bump_generation()
+    cache.set(('message', message_item['uuid']), message_item)
+
+
+def create_message(message_item):
+    # 作成したメッセージを GET /messages/events の購読者に通知する
+    put_message(message_item)
+    message_events.publish(to_events([message_item]))
+
+
+# --------------------------------------------------------------
+# 楽観的排他制御(version属性)
+#   アイテムのversion属性は書き込みごとに1ずつ増える(属性が無いアイテムはversion 0とみなす)。
+#   PUT/PATCHのbodyにversionが含まれていれば、DynamoDB上のversionが一致する場合だけ書き込む。
+#   一致しなければConditionalCheckFailedになり、VersionConflict(409)を返す。
+# --------------------------------------------------------------
+def pop_expected_version(body):
+    if 'version' not in body:
+        return None
+    version = body.pop('version')
+    if isinstance(version, bool) or not isinstance(version, int) or version < 0:
+        raise InvalidVersion(version)
+    return version
+
+
+def version_condition(expected_version, names, values):
+    names['#version'] = 'version'
+    if expected_version == 0:
+        return 'attribute_not_exists(#version)'
+    values[':expected_version'] = expected_version
+    return '#version = :expected_version'
+
+
+def raise_condition_failure(e):
+    # ReturnValuesOnConditionCheckFailure=ALL_OLD で返る現在のアイテムから、404と409を区別する
+    if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+        raise e
+    current = e.response.get('Item')
+    if current is None:
+        raise MessageNotFound() from e
+    version = current.get('version', {}).get('N', '0')
+    raise VersionConflict(int(version)) from e
+
+
+def build_replace(message_item, current, expected_version=None):
+    # PUT: bodyの属性をすべてSETし、置き換える前のアイテム(current)にだけあった属性をREMOVEする
+    # UpdateExpressionを作る。versionは(属性が無ければ0から)1増やす。
+    # bodyにcreated_atが無ければ作成日時(created-indexの位置)は今の値を残し、アイテムが無ければ今の時刻にする。
+    # currentを読んだ時から変わっていない場合だけ書き込む(expected_versionを指定すればそのversionの場合だけ)
+    message_uuid = message_item['uuid']
+    names = {'#version': 'version'}
+    values = {':zero': 0, ':one': 1}
+    actions = ['#version = if_not_exists(#version, :zero) + :one']
+    created_at = message_item.get('created_at')
+    keep = isinstance(created_at, bool) or not isinstance(created_at, int) or created_at < 0
+    created = created_attributes(message_uuid, None if keep else created_at)
+    for name in INDEX_ATTRIBUTES:
+        names[f'#{name}'] = name
+        values[f':{name}'] = created[name]
+        # created_bucketはuuidだけで決まるので、そのまま書いてよい
+        if keep and name != 'created_bucket':
+            actions.append(f'#{name} = if_not_exists(#{name}, :{name})')
+        else:
+            actions.append(f'#{name} = :{name}')
+    attributes = {name: value for name, value in message_item.items()
+                  if name not in ('uuid', 'version') + INDEX_ATTRIBUTES}
+    for i, (name, value) in enumerate(sorted(attributes.items())):
+        names[f'#a{i}'] = name
+        values[f':v{i}'] = value
+        actions.append(f'#a{i} = :v{i}')
+    stale = sorted(name for name in current or {}
+                   if name not in message_item and name not in ('uuid', 'version') + INDEX_ATTRIBUTES)
+    for i, name in enumerate(stale):
+        names[f'#r{i}'] = name
+
+    update_expression = 'SET ' + ', '.join(actions)
+    if stale:
+        update_expression += ' REMOVE ' + ', '.join(f'#r{i}' for i in range(len(stale)))
+    if expected_version is None:
+        expected_version = int(current.get('version', 0)) if current else None
+    if expected_version is None:
+        names['#uuid'] = 'uuid'
+        condition = 'attribute_not_exists(#uuid)'
+    else:
+        condition = version_condition(expected_version, names, values)
+    return {
+        'UpdateExpression': update_expression,
+        'ConditionExpression': condition,
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values
+    }
+
+
+def load_current(message_uuid):
+    # PUTで削除する属性を決めるため、置き換える前のアイテムを強い整合性で読む
+    # (属性名だけを返すProjectionExpressionは無いので、アイテム全体を読む)
+    db_response = observe_dynamodb(
+        'get_item',
+        get_table().get_item,
+        Key={
+            'uuid': message_uuid
+        },
+        ConsistentRead=True
+    )
+    return db_response.get('Item')
+
+
+def replace_message(message_item, expected_version=None):
+    # PUT: アイテム全体を1回のUpdateItemで置き換え、書き込んだversionを返す。
+    # expected_versionを指定すると、そのversionの場合だけ書き込む(違えば409)。
+    # 指定しなければ、読んでから書くまでの間に他の書き込みがあった場合は読み直して書き直す
+    message_uuid = message_item['uuid']
+    for attempt in range(put_max_attempts):
+        current = load_current(message_uuid)
+        try:
+            db_response = observe_dynamodb(
+                'update_item',
+                get_table().update_item,
+                Key={
+                    'uuid': message_uuid
+                },
+                ReturnValues='ALL_NEW',
+                ReturnValuesOnConditionCheckFailure='ALL_OLD',
+                **build_replace(message_item, current, expected_version)
+            )
+            break
+        except ClientError as e:
+            cache.delete(('message', message_uuid))
+            retry = expected_version is None and attempt < put_max_attempts - 1
+            if not retry or e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise_condition_failure(e)
+    written = db_response['Attributes']
+    cache.bump_generation()
+    cache.set(('message', message_uuid), written)
+    return int(written['version'])
+
+
+def build_update(changes, expected_version=None):
+    # 変更する属性だけの UpdateExpression を作る(値がNoneの属性は削除する)。versionは常に1増やす
+    names = {'#uuid': 'uuid', '#version': 'version'}
+    values = {':one': 1}
+    set_actions, remove_actions = [], []
+    for i, (name, value) in enumerate(sorted(changes.items())):
+        names[f'#a{i}'] = name
+        if value is None:
+            remove_actions.append(f'#a{i}')
+        else:
+            values[f':v{i}'] = value
+            set_actions.append(f'#a{i} = :v{i}')
+    clauses = []
+    if set_actions:
+        clauses.append('SET ' + ', '.join(set_actions))
+    if remove_actions:
+        clauses.append('REMOVE ' + ', '.join(remove_actions))
+    clauses.append('ADD #version :one')
+
+    condition = 'attribute_exists(#uuid)'
+    if expected_version is not None:
+        condition += ' AND ' + version_condition(expected_version, names, values)
+    return {
+        'UpdateExpression': ' '.join(clauses),
+        'ConditionExpression': condition,
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values
+    }
+
+
+def update_message(message_uuid, changes, expected_version=None):
+    # PATCH: 変更する属性だけをUpdateItemで書き込み、更新後のアイテムを返す
+    try:
+        db_response = observe_dynamodb(
+            'update_item',
+            get_table().update_item,
+            Key={
+                'uuid': message_uuid
+            },
+            ReturnValues='ALL_NEW',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+            **build_update(changes, expected_version)
+        )
+    except ClientError as e:
+        cache.delete(('message', message_uuid))
+        raise_condition_failure(e)
+    message_item = db_response['Attributes']
+    cache.bump_generation()
+    cache.set(('message', message_uuid), message_item)
+    return message_item
+
+
+def delete_message(message_uuid):
+    observe_dynamodb(
+        'delete_item',
+        get_table().delete_item,
+        Key={
+            'uuid': message_uuid
+        }
+    )
+    cache.bump_generation()
+    cache.delete(('message', message_uuid))
+
+
+def backoff(attempt):
+    # exponential backoff + full jitter
+    time.sleep(random.uniform(0, min(batch_backoff_max, batch_backoff_base * 2 ** attempt)))
+
+
+def batch_put(items):
+    # BatchWriteItemで25件ずつ書き込む。UnprocessedItemsはbackoffしながら再送し、
+    # 最後まで書けなかったアイテムのuuidを返す
+    failed = set()
+    for start in range(0, len(items), 25):
+        write_requests = [{'PutRequest': {'Item': item}} for item in items[start:start + 25]]
+        try:
+            for attempt in range(batch_max_attempts):
+                db_response = observe_dynamodb('batch_write_item', get_db().batch_write_item,
+                                               RequestItems={table_name: write_requests})
+                write_requests = db_response.get('UnprocessedItems', {}).get(table_name, [])
+                if not write_requests:
+                    break
+                backoff(attempt)
+        except ClientError:
+            logger.warning('batch_write_item failed', exc_info=True)
+        failed.update(r['PutRequest']['Item']['uuid'] for r in write_requests)
+    return failed
+
+
+def parse_ndjson(body):
+    # NDJSON(1行1メッセージ)を解析する。解析できない行はNoneにする
+    posted = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            posted.append(json.loads(line, parse_float=decimal.Decimal))
+        except ValueError:
+            posted.append(None)
+    return posted
+
+
+def client_uuid(item):
+    # クライアントが付けたuuid(再送しても同じメッセージを二重に登録しないためのキー)。
+    # 付いていなければNone、UUIDの形式でなければValueError
+    supplied = item.get('uuid')
+    if supplied is None:
+        return None
+    if not isinstance(supplied, str):
+        raise ValueError(supplied)
+    return str(uuid.UUID(supplied))
+
+
+def prepare_batch(posted):
+    # uuidを割り当てて、書き込むアイテム・アイテムごとの結果(index順)・クライアントが付けたuuidを返す。
+    # uuidが付いているアイテムはそのuuidで登録する(形式が不正なもの・同じbatch内で重複したものはinvalid)
+    if len(posted) > batch_max_items:
+        raise TooManyItems(batch_max_items)
+    results = []
+    items = []
+    supplied = set()
+    for index, item in enumerate(posted):
+        try:
+            message_uuid = client_uuid(item) if isinstance(item, dict) else ''
+        except ValueError:
+            message_uuid = ''
+        if message_uuid == '' or message_uuid in supplied:
+            results.append({'index': index, 'status': 'invalid'})
+            continue
+        if message_uuid is None:
+            message_uuid = str(uuid.uuid4())
+        else:
+            supplied.add(message_uuid)
+        item['uuid'] = message_uuid
+        item.update(created_attributes(message_uuid))
+        items.append(item)
+        results.append({'index': index, 'uuid': message_uuid, 'status': 'created'})
+    return items, results, supplied
+
+
+def batch_result(results, failed):
+    # アイテムごとの結果と件数。全件成功なら200、それ以外は207
+    counts = {'created': 0, 'failed': 0, 'invalid': 0}
+    for result in results:
+        if result.get('uuid') in failed:
+            result['status'] = 'failed'
+        counts[result['status']] += 1
+    json = dict(counts, items=results)
+    return json, 200 if counts['created'] == len(results) else 207
+
+
+def put_messages(items, supplied=()):
+    # suppliedはクライアントが付けたuuid。再送されたアイテムかもしれないので先に存在を確認し、
+    # 既にあるものは書き込まずに成功として扱う(BatchWriteItemには条件を付けられないため)。
+    # 存在を確認できなかったアイテムは書き込まずに失敗として返し、クライアントに再送してもらう
+    existing, unprocessed = batch_get(sorted(supplied)) if supplied else ({}, [])
+    failed = set(unprocessed)
+    new_items = [item for item in items if item['uuid'] not in existing and item['uuid'] not in failed]
+    failed.update(batch_put(new_items))
+    created = [item for item in new_items if item['uuid'] not in failed]
+    cache.bump_generation()
+    cache.set_many({('message', item['uuid']): item for item in created})
+    message_events.publish(to_events(created))
+    return failed
+
+
+def batch_get(message_uuids):
+    # BatchGetItemで100件ずつ取得する。UnprocessedKeysはbackoffしながら再要求し、
+    # 取得できたアイテム(uuid -> item)と、最後まで取得できなかったuuidを返す
+    found = {}
+    unprocessed = []
+    for start in range(0, len(message_uuids), 100):
+        keys = [{'uuid': message_uuid} for message_uuid in message_uuids[start:start + 100]]
+        try:
+            for attempt in range(batch_max_attempts):
+                db_response = observe_dynamodb('batch_get_item', get_db().batch_get_item,
+                                               RequestItems={table_name: {'Keys': keys}})
+                for item in db_response.get('Responses', {}).get(table_name, []):
+                    found[item['uuid']] = item
+                keys = db_response.get('UnprocessedKeys', {}).get(table_name, {}).get('Keys', [])
+                if not keys:
+                    break
+                backoff(attempt)
+        except ClientError:
+            logger.warning('batch_get_item failed', exc_info=True)
+        unprocessed.extend(key['uuid'] for key in keys)
+    return found, unprocessed
+
+
+def get_messages(message_uuids):
+    # 指定されたuuid(重複なし)のメッセージを指定順に返す。キャッシュにないものだけDynamoDBから取得する
+    cached = cache.get_many([('message', message_uuid) for message_uuid in message_uuids])
+    found = {key[1]: message_item for key, message_item in cached.items()}
+    fetched, unprocessed = batch_get([u for u in message_uuids if u not in found])
+    cache.set_many({('message', message_uuid): message_item for message_uuid, message_item in fetched.items()})
+    found.update(fetched)
+
+    json = {
+        'items': [found[u] for u in message_uuids if u in found],
+        'missing': [u for u in message_uuids if u not in found and u not in unprocessed]
+    }
+    if unprocessed:
+        json['unprocessed'] = unprocessed
+    return json
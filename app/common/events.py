@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import queue
+import threading
+import time
+
+
+# --------------------------------------------------------------
+# 新しいメッセージのserver-sent events(backend・frontend共通)
+#   EventHub: プロセス内のpub/sub。購読者(SSEの接続)ごとに有界のキューを持ち、
+#             直近のイベントをbuffer_size件保持する(再接続したクライアントにLast-Event-ID以降を送り直す)
+#   イベントは(id, data)。idはメッセージのcreated_sort(作成日時の順に並ぶ)、dataはメッセージのJSON。
+#   送り直せない(バッファから溢れた・購読者のキューが一杯になった)ときは reset イベントを送る。
+# --------------------------------------------------------------
+RESET = 'reset'
+HEARTBEAT = ': keep-alive\n\n'
+
+
+def format_event(event_id, data):
+    return f'id: {event_id}\nevent: message\ndata: {data}\n\n'
+
+
+def format_reset():
+    return 'event: reset\ndata: {}\n\n'
+
+
+class Subscription:
+    # 1つのSSEの接続。EventHubがdeliver()でイベントのリストを積み、get()で取り出す
+
+    def __init__(self, hub, max_queue):
+        self.hub = hub
+        self._queue = queue.Queue(maxsize=max_queue)
+
+    def deliver(self, events):
+        try:
+            self._queue.put_nowait(events)
+        except queue.Full:
+            # 読み出しが追いつかない: 溜まっているイベントを捨てて reset だけを送る
+            self._drop()
+
+    def _drop(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put_nowait(RESET)
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    # ASGI版: イベントループのasyncio.Queueに積む(EventHubは別のスレッドから呼ぶ)
+
+    def __init__(self, hub, max_queue, loop):
+        self.hub = hub
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=max_queue)
+
+    def deliver(self, events):
+        self._loop.call_soon_threadsafe(self._put, events)
+
+    def _put(self, events):
+        try:
+            self._queue.put_nowait(events)
+        except asyncio.QueueFull:
+            self._drop()
+
+    def _drop(self):
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(RESET)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventHub:
+
+    def __init__(self, buffer_size=1000, max_subscribers=8, max_queue=100):
+        self.max_subscribers = max_subscribers
+        self.max_queue = max_queue
+        self._buffer = collections.deque(maxlen=buffer_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.published = 0
+        self.rejected = 0
+
+    def start(self):
+        # プロセス内だけなので何もしない(backendのSocketEventBus・RedisEventBusと同じインターフェース)
+        pass
+
+    def publish(self, events):
+        # このプロセスの購読者に配る(backendのSocketEventBus・RedisEventBusと同じインターフェース)
+        self.dispatch(events)
+
+    def dispatch(self, events):
+        if not events:
+            return
+        with self._lock:
+            self._buffer.extend(events)
+            self.published += len(events)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.deliver(events)
+
+    def reset(self):
+        # 取りこぼしがある(frontendがバックエンドから reset を受け取った): 全員に一覧を読み直させる
+        with self._lock:
+            self._buffer.clear()
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.deliver(RESET)
+
+    def subscribe(self, last_event_id=None, loop=None):
+        # 購読者が上限に達していればNoneを返す(呼び出し側で503を返す)。
+        # loopを渡すとASGI版の購読者(AsyncSubscription)を返す
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                self.rejected += 1
+                return None
+            if loop is None:
+                subscriber = Subscription(self, self.max_queue)
+            else:
+                subscriber = AsyncSubscription(self, self.max_queue, loop)
+            if last_event_id:
+                missed = [event for event in self._buffer if event[0] > last_event_id]
+                # バッファが一杯で、最も古いイベントより前から再開する場合は取りこぼしがある
+                overflowed = (len(self._buffer) == self._buffer.maxlen
+                              and self._buffer[0][0] > last_event_id)
+                if overflowed:
+                    subscriber.deliver(RESET)
+                elif missed:
+                    subscriber.deliver(sorted(missed))
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'subscribers': len(self._subscribers), 'buffered': len(self._buffer),
+                    'published': self.published, 'rejected': self.rejected}
+
+
+def iter_stream(subscription, heartbeat, duration, stopping):
+    # SSEのレスポンス。duration秒経つか停止中(stopping())になったら終え、クライアントに再接続させる
+    # (EventSourceはLast-Event-IDを付けて自動で再接続する)
+    deadline = time.monotonic() + duration
+    try:
+        yield 'retry: 2000\n\n'
+        idle_since = time.monotonic()
+        while time.monotonic() < deadline and not stopping():
+            # 停止中になったことに1秒以内に気づけるように、短い間隔で待つ
+            events = subscription.get(timeout=min(heartbeat, 1.0))
+            if events is None:
+                if time.monotonic() - idle_since >= heartbeat:
+                    idle_since = time.monotonic()
+                    yield HEARTBEAT
+                continue
+            idle_since = time.monotonic()
+            if events == RESET:
+                yield format_reset()
+                return
+            yield ''.join(format_event(event_id, data) for event_id, data in events)
+    finally:
+        subscription.close()
+
+
+async def aiter_stream(subscription, heartbeat, duration, stopping):
+    # ASGI版: 待っている間スレッドを使わない
+    deadline = time.monotonic() + duration
+    try:
+        yield 'retry: 2000\n\n'
+        idle_since = time.monotonic()
+        while time.monotonic() < deadline and not stopping():
+            # 停止中になったことに1秒以内に気づけるように、短い間隔で待つ
+            events = await subscription.get(timeout=min(heartbeat, 1.0))
+            if events is None:
+                if time.monotonic() - idle_since >= heartbeat:
+                    idle_since = time.monotonic()
+                    yield HEARTBEAT
+                continue
+            idle_since = time.monotonic()
+            if events == RESET:
+                yield format_reset()
+                return
+            yield ''.join(format_event(event_id, data) for event_id, data in events)
+    finally:
+        subscription.close()
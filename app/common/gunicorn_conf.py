@@ -0,0 +1,66 @@
+# gunicornの共通の設定(backend・frontendの gunicorn.conf.py から読み込む)
+# worker数はコンテナに割り当てられたCPU(cgroupのCPU quota)から決める。
+# GUNICORN_WORKERS / GUNICORN_THREADS で上書きできる。
+import math
+import os
+
+
+def cpu_limit():
+    # cgroup v2
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    # cgroup v1
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+workers = int(os.getenv('GUNICORN_WORKERS', str(cpu_limit() * 2 + 1)))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+# worker起動前にアプリを読み込み、fork後はCopy-on-Writeで共有する
+preload_app = True
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+# SIGTERMを受けると新規の受付を止め、処理中のリクエストをこの秒数まで待ってから終了する
+# (Podの terminationGracePeriodSeconds より短くする)
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '25'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '75'))
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    # 前回起動時のメトリクスファイルを消す
+    path = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+    # 前回のpreStopで作られたdrainファイルを消す
+    from common import health
+    health.reset_draining()
+
+
+def post_worker_init(worker):
+    # SIGTERMを受けたら /readyz を503にする(uvicorn workerはSIGTERMのハンドラを置き換えるので、preStopのdrainファイルで知らせる)
+    from common import health
+    health.install_signal_handler()
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,86 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+
+# --------------------------------------------------------------
+# liveness/readiness(backend・frontend共通)
+#   - draining: SIGTERMを受けた後、またはpreStopで DRAIN_FILE が作られた後は /readyz を503にして、
+#     Service・ALBのターゲットから外れるまでの間も処理中・新規のリクエストに応答し続ける
+#   - CachedCheck: 依存先の確認結果をttl秒保持する(probeのたびに依存先を呼ばない)
+# --------------------------------------------------------------
+logger = logging.getLogger('common.health')
+
+# preStopフックが作るファイル(gunicornの全workerに伝わるようにファイルで知らせる)
+drain_file = os.getenv('DRAIN_FILE', '/tmp/draining')
+_draining = threading.Event()
+
+
+def start_draining():
+    _draining.set()
+
+
+def is_draining():
+    return _draining.is_set() or os.path.exists(drain_file)
+
+
+def reset_draining():
+    # 起動時に前回のdrainファイルを消す(gunicornのon_starting)
+    _draining.clear()
+    try:
+        os.remove(drain_file)
+    except FileNotFoundError:
+        pass
+
+
+def install_signal_handler():
+    # SIGTERMでdrainingにしてから、元のハンドラを呼ぶ
+    # (gunicornのworkerでは新規の受付を止め、処理中のリクエストを待ってから終了する)
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        start_draining()
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+class CachedCheck:
+    # check()は正常ならNone、異常なら理由の文字列を返す(例外も異常として扱う)。
+    # 結果はttl秒保持する。確認中に呼ばれた場合は前回の結果を返し、依存先を同時に何度も呼ばない。
+
+    def __init__(self, check, ttl):
+        self.check = check
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked_at = None
+
+    def _fresh(self):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.ttl
+
+    def __call__(self):
+        if self._fresh():
+            return self._result
+        # 初回は結果が無いので確認が終わるまで待つ
+        if not self._lock.acquire(blocking=self._checked_at is None):
+            return self._result
+        try:
+            if self._fresh():
+                return self._result
+            try:
+                result = self.check()
+            except Exception as e:
+                logger.warning('readiness check failed: %s', e)
+                result = f'{type(e).__name__}: {e}'
+            self._result = result
+            self._checked_at = time.monotonic()
+            return result
+        finally:
+            self._lock.release()
@@ -0,0 +1,96 @@
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, GCCollector, PlatformCollector,
+    ProcessCollector, generate_latest, multiprocess
+)
+
+
+# --------------------------------------------------------------
+# Prometheusメトリクス(backend・frontend共通)
+#   HTTPリクエストのメトリクスと /metrics のレスポンス。アプリごとのメトリクスは各アプリの metrics.py で
+#   registry に登録する。
+#   gunicornで複数workerを起動する場合は PROMETHEUS_MULTIPROC_DIR を指定し、
+#   /metrics で全workerの値を集計して返す(gunicorn_conf.py参照)
+# --------------------------------------------------------------
+PROBE_PATHS = ('/healthz', '/livez', '/readyz', '/metrics')
+
+
+def process_start_time():
+    # プロセスの起動時刻(/proc/self/statの起動時刻と/proc/uptimeから求める)。
+    # gunicorn(preload_app)のworkerはmasterでimportした値を引き継ぐので、Podの起動からの時間になる
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return time.time()
+    return time.time() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+process_started = process_start_time()
+_first_request_done = False
+
+registry = CollectorRegistry()
+ProcessCollector(registry=registry)
+PlatformCollector(registry=registry)
+GCCollector(registry=registry)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency', ['method', 'route'], registry=registry
+)
+REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests', ['method', 'route', 'status'], registry=registry
+)
+IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'HTTP requests currently being served', multiprocess_mode='livesum',
+    registry=registry
+)
+TIME_TO_FIRST_REQUEST = Gauge(
+    'time_to_first_request_seconds', 'Seconds from process start until the first request (excluding probes) finished',
+    multiprocess_mode='liveall', registry=registry
+)
+
+
+def init_app(app, request, g):
+    # ルートごとのレイテンシ・ステータスコード・処理中のリクエスト数を記録する
+    # (request/g はFlask/Quartそれぞれのものを渡す)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        IN_FLIGHT.inc()
+
+    def record(status_code):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        IN_FLIGHT.dec()
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - started)
+        REQUESTS.labels(request.method, route, str(status_code)).inc()
+
+    @app.after_request
+    def record_request(response):
+        global _first_request_done
+        record(response.status_code)
+        if not _first_request_done and request.path not in PROBE_PATHS:
+            _first_request_done = True
+            TIME_TO_FIRST_REQUEST.set(time.time() - process_started)
+        return response
+
+    @app.teardown_request
+    def record_error(exc=None):
+        # 例外で終了してafter_requestが呼ばれなかった場合
+        record(500)
+
+
+def metrics_response():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+    else:
+        collected = registry
+    return generate_latest(collected), 200, {'Content-Type': CONTENT_TYPE_LATEST}
@@ -0,0 +1,408 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+
+# --------------------------------------------------------------
+# 分散トレーシング(W3C Trace Context)とServer-Timing(backend・frontend共通)
+#   - リクエストごとにSERVERのspanを作り、traceparentヘッダーがあればそのトレースを引き継ぐ
+#   - span()で囲んだ処理(DynamoDB・バックエンドの呼び出し、テンプレートの描画など)を子のspanとして記録する
+#   - timingを指定したspanの所要時間は名前ごとにまとめ、レスポンスのServer-Timingヘッダーで返す
+#     (並列に実行した呼び出しは重なった時間を1回だけ数える。実時間なので total を超えない)
+#   - サンプリングされたトレースのspanはキューに積むだけで、書き出しはバックグラウンドのスレッドで行う。
+#     書き出し先はOTLP/HTTP(JSON)のコレクター、またはファイル(1行にOTLPのJSONを1つ)。
+#     キューが一杯のときはブロックせずに捨てる(捨てた件数は dropped に数える)。
+# --------------------------------------------------------------
+logger = logging.getLogger('common.tracing')
+
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+# /healthz などはトレースしない
+IGNORED_PATHS = ('/healthz', '/livez', '/readyz', '/metrics')
+
+_current = contextvars.ContextVar('span', default=None)
+
+
+class _Tracing:
+    exporter = None
+    sample_rate = 1.0
+    server_timing = True
+
+
+class Trace:
+    # 1つのリクエストの中で記録したspanの区間(Server-Timing用。perf_counterの開始・終了)を名前ごとにまとめる
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def add_timing(self, name, started, ended):
+        with self._lock:
+            self.timings.setdefault(name, []).append((started, ended))
+
+    def durations(self):
+        # 名前ごとの実時間(区間の和集合の長さ)
+        with self._lock:
+            timings = {name: sorted(intervals) for name, intervals in self.timings.items()}
+        durations = {}
+        for name, intervals in timings.items():
+            seconds, covered = 0.0, None
+            for started, ended in intervals:
+                if covered is None or started > covered:
+                    seconds += ended - started
+                    covered = ended
+                elif ended > covered:
+                    seconds += ended - covered
+                    covered = ended
+            durations[name] = seconds
+        return durations
+
+
+class Span:
+
+    def __init__(self, name, trace, parent_id=None, kind=INTERNAL, timing=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.kind = kind
+        self.timing = timing
+        self.attributes = attributes or {}
+        self.error = None
+        self.start_time = time.time_ns()
+        self._started = time.perf_counter()
+        self.duration = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        return '00-{}-{}-{}'.format(self.trace.trace_id, self.span_id, '01' if self.trace.sampled else '00')
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if self.timing:
+            self.trace.add_timing(self.timing, self._started, self._started + self.duration)
+        if self.trace.sampled and _Tracing.exporter is not None:
+            _Tracing.exporter.export(self)
+
+
+def current_span():
+    return _current.get()
+
+
+def start_request_span(name, traceparent=None, attributes=None):
+    # traceparentヘッダーを引き継ぐ(サンプリングするかも呼び出し元の判断に従う)。無ければ新しいトレースを始める
+    match = TRACEPARENT.match(traceparent or '')
+    if match and match.group(1) != '0' * 32:
+        trace = Trace(match.group(1), int(match.group(3), 16) & 1 == 1)
+        parent_id = match.group(2)
+    else:
+        trace = Trace('{:032x}'.format(random.getrandbits(128)), random.random() < _Tracing.sample_rate)
+        parent_id = None
+    span = Span(name, trace, parent_id, kind=SERVER, attributes=attributes)
+    _current.set(span)
+    return span
+
+
+@contextmanager
+def span(name, kind=INTERNAL, timing=None, **attributes):
+    # 現在のspanの子のspanを記録する。リクエストの外(バックグラウンドのスレッドなど)では何も記録しない
+    parent = _current.get()
+    if parent is None:
+        yield Span(name, Trace(None, False), kind=kind, attributes=attributes)
+        return
+    child = Span(name, parent.trace, parent.span_id, kind=kind, timing=timing, attributes=attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def propagate(func):
+    # スレッドプールで実行する関数に現在のspanを引き継ぐ(contextvarsはスレッドをまたいで引き継がれない)
+    parent = _current.get()
+
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+def add_server_timing(header, prefix):
+    # 呼び出し先のレスポンスのServer-Timing(例: dynamodb;dur=1.23, total;dur=4.56)を
+    # 名前に prefix を付けて現在のリクエストのServer-Timingに加える。
+    # 呼び出し先の区間の時刻は分からないので、レスポンスを受け取った時点で終わった区間として扱う
+    parent = _current.get()
+    if parent is None or not header:
+        return
+    received = time.perf_counter()
+    for entry in header.split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    parent.trace.add_timing(prefix + name, received - float(value) / 1000, received)
+                except ValueError:
+                    pass
+
+
+def server_timing(trace, total):
+    # Server-Timingヘッダーの値(ミリ秒)。total はリクエスト全体の所要時間
+    timings = trace.durations()
+    timings['total'] = total
+    return ', '.join('{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in timings.items())
+
+
+# --------------------------------------------------------------
+# spanの書き出し(OTLP/HTTPのJSON)
+# --------------------------------------------------------------
+def attribute_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(span):
+    end_time = span.start_time + int(span.duration * 1e9)
+    encoded = {
+        'traceId': span.trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(span.start_time),
+        'endTimeUnixNano': str(end_time),
+        'attributes': [{'key': key, 'value': attribute_value(value)} for key, value in span.attributes.items()
+                       if value is not None]
+    }
+    if span.parent_id:
+        encoded['parentSpanId'] = span.parent_id
+    if span.error:
+        encoded['status'] = {'code': STATUS_ERROR, 'message': span.error}
+    return encoded
+
+
+def otlp_payload(service_name, spans):
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'flask-eks-workshop'}, 'spans': spans}]
+        }]
+    }
+
+
+class FileWriter:
+    # 1回の書き出しを1行(OTLPのJSON)として追記する(OpenTelemetry Collectorのotlpjsonfile receiverで読める)
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, payload):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(payload, separators=(',', ':')) + '\n')
+
+
+class OtlpHttpWriter:
+    # OpenTelemetry Collectorなどの /v1/traces にPOSTする
+
+    def __init__(self, endpoint, timeout=2.0):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def __call__(self, payload):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        r = urllib.request.Request(self.endpoint, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(r, timeout=self.timeout) as response:
+            response.read()
+
+
+class SpanExporter:
+    # spanはキューに積むだけで、batch_size件たまるか interval 秒ごとにまとめて書き出す。
+    # スレッドは最初のexport()で起動する(gunicornのpreload_appではfork後のworkerで起動される)。
+
+    def __init__(self, writer, service_name, max_queue=2048, batch_size=512, interval=1.0):
+        self.writer = writer
+        self.service_name = service_name
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dropped = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork前に作ったキュー・スレッドは使わない
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                threading.Thread(target=self._run, name='tracing', daemon=True).start()
+                self._pid = os.getpid()
+
+    def export(self, span):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._write(self._next_batch())
+
+    def _write(self, batch):
+        try:
+            self.writer(otlp_payload(self.service_name, [otlp_span(span) for span in batch]))
+        except Exception as e:
+            self.errors += 1
+            logger.warning('failed to export %d spans: %s', len(batch), e)
+
+    def flush(self):
+        # プロセスの終了時にキューに残っているspanを書き出す
+        if self._pid != os.getpid():
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+
+def setup(service_name, exporter='none', file_path='/tmp/traces.jsonl',
+          otlp_endpoint='http://localhost:4318/v1/traces', sample_rate=1.0, server_timing=True):
+    # exporter: none(書き出さない) / file / otlp
+    _Tracing.sample_rate = sample_rate
+    _Tracing.server_timing = server_timing
+    if exporter == 'file':
+        _Tracing.exporter = SpanExporter(FileWriter(file_path), service_name)
+    elif exporter == 'otlp':
+        _Tracing.exporter = SpanExporter(OtlpHttpWriter(otlp_endpoint), service_name)
+    elif exporter != 'none':
+        raise ValueError(f'unknown tracing exporter: {exporter}')
+    if _Tracing.exporter is not None:
+        atexit.register(_Tracing.exporter.flush)
+
+
+def enabled():
+    return _Tracing.exporter is not None or _Tracing.server_timing
+
+
+def dropped():
+    return _Tracing.exporter.dropped if _Tracing.exporter else 0
+
+
+def start_request(request, g):
+    if request.path in IGNORED_PATHS:
+        return
+    g.trace_started = time.perf_counter()
+    g.trace_span = start_request_span(f'{request.method} {request.path}', request.headers.get('traceparent'), {
+        'http.method': request.method,
+        'http.target': request.full_path if request.query_string else request.path
+    })
+
+
+def finish_request(request, g, response):
+    span = g.get('trace_span')
+    if span is None:
+        return response
+    if request.url_rule:
+        span.name = f'{request.method} {request.url_rule.rule}'
+        span.set('http.route', request.url_rule.rule)
+    span.set('http.status_code', response.status_code)
+    if response.status_code >= 500:
+        span.error = f'HTTP {response.status_code}'
+    if _Tracing.server_timing:
+        response.headers['Server-Timing'] = server_timing(span.trace, time.perf_counter() - g.trace_started)
+    span.end()
+    return response
+
+
+def end_request(g, exc=None):
+    # 例外で終了してafter_requestが呼ばれなかった場合もspanを終える
+    span = g.pop('trace_span', None)
+    if span is not None and span.duration is None:
+        span.error = f'{type(exc).__name__}: {exc}' if exc else 'HTTP 500'
+        span.set('http.status_code', 500)
+        span.end()
+    _current.set(None)
+
+
+def init_app(app, request, g):
+    if not enabled():
+        return
+
+    @app.before_request
+    def start_trace():
+        start_request(request, g)
+
+    @app.after_request
+    def finish_trace(response):
+        return finish_request(request, g, response)
+
+    @app.teardown_request
+    def end_trace(exc=None):
+        end_request(g, exc)
+
+
+def init_async_app(app, request, g):
+    # Quart版: 同期の関数はスレッドプールで(別のcontextで)実行されるため、contextvarsを設定するフックは非同期にする
+    if not enabled():
+        return
+
+    @app.before_request
+    async def start_trace():
+        start_request(request, g)
+
+    @app.after_request
+    async def finish_trace(response):
+        return finish_request(request, g, response)
+
+    @app.teardown_request
+    async def end_trace(exc=None):
+        end_request(g, exc)
@@ -1,17 +1,114 @@
+import atexit
+import json
 import os
+from urllib.parse import urljoin
 
-from flask import Flask, render_template, redirect, url_for
+from flask import Flask, Response, g, render_template, redirect, url_for, request, stream_with_context
 from flask_wtf import FlaskForm
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 from wtforms import StringField, SubmitField
 from wtforms.validators import DataRequired, Email
-import requests
+
+import events
+import metrics
+from backend_client import BackendClient
+from common import health, tracing
+from common.events import EventHub, iter_stream
+from fragment_cache import FragmentCache
+from write_behind import WriteBehindQueue
 
 
 # 環境変数からバックエンドサービスのURLを取得
 backend_url = os.getenv('BACKEND_URL', 'http://localhost:5050/messages')
+# 1ページに表示するメッセージ数
+page_size = int(os.getenv('PAGE_SIZE', '20'))
+
+# バックエンドへの接続はプールしてkeep-aliveで使い回す
+backend = BackendClient(
+    pool_size=int(os.getenv('BACKEND_POOL_SIZE', '10')),
+    connect_timeout=float(os.getenv('BACKEND_CONNECT_TIMEOUT', '1.0')),
+    read_timeout=float(os.getenv('BACKEND_READ_TIMEOUT', '5.0')),
+    retries=int(os.getenv('BACKEND_RETRIES', '2')),
+    backoff_factor=float(os.getenv('BACKEND_RETRY_BACKOFF', '0.1')),
+    etag_cache_size=int(os.getenv('BACKEND_ETAG_CACHE_SIZE', '128'))
+)
+
+# /readyz: バックエンドの /readyz を確認し、結果を READINESS_CACHE_SECONDS 秒保持する
+backend_ready_url = os.getenv('BACKEND_READY_URL') or urljoin(backend_url, '/readyz')
+
+
+def check_backend():
+    # Service経由なのでバックエンドのいずれかのPodが応答すればよい(503はBackendClientがリトライする)
+    r = backend.get(backend_ready_url)
+    if r.status_code != 200:
+        return f'backend is not ready ({r.status_code})'
+    return None
+
+
+backend_ready = health.CachedCheck(check_backend, ttl=float(os.getenv('READINESS_CACHE_SECONDS', '5')))
+
+# GET /events: 新しいメッセージをserver-sent eventsで送る。バックエンドへの接続はworkerごとに1本
+#   gthread workerではブラウザの接続1本につき1スレッドを使うので、ページの描画用に2スレッドを残す
+message_events = events.BackendEventFeed(
+    backend,
+    os.getenv('BACKEND_EVENTS_URL') or backend_url + '/events',
+    EventHub(
+        buffer_size=int(os.getenv('EVENTS_BUFFER_SIZE', '1000')),
+        max_subscribers=int(os.getenv('EVENTS_MAX_STREAMS', str(max(1, int(os.getenv('GUNICORN_THREADS', '4')) - 2))))
+    )
+)
+events_heartbeat_seconds = float(os.getenv('EVENTS_HEARTBEAT_SECONDS', '15'))
+events_stream_seconds = float(os.getenv('EVENTS_STREAM_SECONDS', '300'))
+
+# 描画済みのメッセージ一覧をバックエンドのETagごとに保持する数(0でキャッシュしない)
+fragment_cache = FragmentCache(max_entries=int(os.getenv('FRAGMENT_CACHE_SIZE', '256')))
+
+# write-behind: 投稿をキューに積んでバックグラウンドで POST /messages/batch にまとめて送る
+write_behind = None
+if os.getenv('WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes'):
+    write_behind = WriteBehindQueue(
+        backend,
+        backend_url + '/batch',
+        max_size=int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', '1000')),
+        batch_size=int(os.getenv('WRITE_BEHIND_BATCH_SIZE', '100')),
+        flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '0.2'))
+    )
+    atexit.register(write_behind.stop, timeout=float(os.getenv('WRITE_BEHIND_DRAIN_TIMEOUT', '10')))
 
 app = Flask(__name__)
+# テンプレートのコンパイル結果をファイルに保存し、worker・再起動をまたいで使い回す
+app.jinja_options = {
+    **app.jinja_options,
+    'bytecode_cache': FileSystemBytecodeCache(os.getenv('JINJA_BYTECODE_CACHE_DIR') or None)
+}
 app.config['SECRET_KEY'] = 'argqtahqtaatayaat'
+metrics.init_app(app, request, g)
+# トレース: 書き出し先は TRACING_EXPORTER(none / file / otlp)。バックエンドへはtraceparentヘッダーで引き継ぐ
+tracing.setup(
+    os.getenv('TRACING_SERVICE_NAME', 'frontend'),
+    exporter=os.getenv('TRACING_EXPORTER', 'none'),
+    file_path=os.getenv('TRACING_FILE', '/tmp/traces.jsonl'),
+    otlp_endpoint=os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'),
+    sample_rate=float(os.getenv('TRACING_SAMPLE_RATE', '1.0')),
+    server_timing=os.getenv('SERVER_TIMING', 'true').lower() in ('1', 'true', 'yes')
+)
+tracing.init_app(app, request, g)
+
+
+def iter_messages():
+    # バックエンドのNDJSONエクスポートを1行ずつ読みながら返す
+    with backend.get(backend_url, params={'format': 'ndjson'}, stream=True) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def render(template_name, **context):
+    # テンプレートの描画をspanで囲む(Server-Timingでは render に数える)
+    with tracing.span(f'render {template_name}', timing='render'):
+        return render_template(template_name, **context)
 
 
 class MessageForm(FlaskForm):
@@ -19,36 +116,123 @@ class MessageForm(FlaskForm):
     submit = SubmitField()
 
 
+def render_messages(page, cursor):
+    next_url = None
+    if page.get('next_cursor'):
+        next_url = url_for('home_page', cursor=page['next_cursor'])
+    # 前のページはバックエンドが返すprev_cursor(1ページ目ではNone)。
+    # 返さない場合(バックエンドがScanで一覧を読む設定)は1ページ目に戻る
+    prev_url = None
+    if page.get('prev_cursor'):
+        prev_url = url_for('home_page', cursor=page['prev_cursor'])
+    elif cursor and 'prev_cursor' not in page:
+        prev_url = url_for('home_page')
+    return Markup(render('_messages.html', items=page['items'], next_url=next_url, prev_url=prev_url))
+
+
 @app.route('/', methods=['GET'])
 def home_page():
-
-    r = requests.get(backend_url)
-    r.raise_for_status()
-    items = r.json()
+    # cursor: 表示中のページ
+    cursor = request.args.get('cursor', '')
+
+    params = {'limit': page_size}
+    if cursor:
+        params['cursor'] = cursor
+    # 前回と変わっていなければ304が返り、保持しているレスポンスを使う
+    etag, page = backend.get_versioned_json(backend_url, params=params)
+
+    # 一覧の描画結果はデータのバージョン(ETag)とページ位置が同じなら使い回す
+    key = (etag, cursor) if etag else None
+    messages_html = fragment_cache.get(key) if key else None
+    if messages_html is None:
+        metrics.FRAGMENT_CACHE.labels('miss').inc()
+        messages_html = render_messages(page, cursor)
+        if key:
+            fragment_cache.set(key, messages_html)
+    else:
+        metrics.FRAGMENT_CACHE.labels('hit').inc()
 
     form = MessageForm()
 
-    return render_template('home.html', items=items, form=form)
+    return render('home.html', messages_html=messages_html, form=form)
 
 
 @app.route('/', methods=['POST'])
 def post_message():
 
     form = MessageForm()
+    # ページのスクリプトからの投稿(Accept: application/json)は、リダイレクトして一覧を描画し直さずに結果だけ返す。
+    # 投稿したメッセージ(item)はスクリプトが一覧に追加する(/events は別のPodで作成されたものが届かないことがある)
+    wants_json = request.accept_mimetypes.best == 'application/json'
 
     if form.validate_on_submit():
         json = {'message': form.message.data}
-        r = requests.post(backend_url, json=json)
+        message_uuid = write_behind.submit(json) if write_behind is not None else None
+        if message_uuid:
+            if wants_json:
+                return {'message': 'accepted', 'item': dict(json, uuid=message_uuid)}, 202
+            return redirect(url_for('home_page'))
+        if write_behind is not None and not write_behind.stopping():
+            # キューが一杯: 入力を残したままフォームを返し、少し待ってから再送してもらう
+            if wants_json:
+                return {'message': 'queue is full'}, 503, {'Retry-After': '1'}
+            return render('home.html', form=form), 503, {'Retry-After': '1'}
+        # write-behindを使わない場合と、終了処理中(キューを送り切っている間)はバックエンドに同期的に送る
+        r = backend.post(backend_url, json=json)
         r.raise_for_status()
+        if wants_json:
+            # バックエンドは '<uuid> created.' を返す
+            return {'message': 'created', 'item': dict(json, uuid=r.json()['message'].split()[0])}, 201
         return redirect(url_for('home_page'))
 
-    return render_template('home.html', form=form)
+    if wants_json:
+        return {'errors': form.errors}, 400
+    return render('home.html', form=form)
+
 
+@app.route('/events', methods=['GET'])
+def message_events_stream():
+    # EventSourceは切断されるとLast-Event-IDを付けて再接続する。ページを開いた直後は表示中の最新のidを渡す
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscription = message_events.subscribe(last_event_id)
+    if subscription is None:
+        return 'too many event streams', 503, {'Retry-After': '5'}
+    stream = iter_stream(subscription, events_heartbeat_seconds, events_stream_seconds, health.is_draining)
+    response = Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    response.call_on_close(subscription.close)
+    return response
 
+
+@app.route('/export', methods=['GET'])
+def export_messages():
+    lines = (json.dumps(item, ensure_ascii=False) + '\n' for item in iter_messages())
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return metrics.metrics_response()
+
+
+@app.route('/livez', methods=['GET'])
 @app.route('/healthz', methods=['GET'])
 def health_check():
+    # liveness: プロセスが応答できるか(バックエンドは確認しない)
+    return 'OK'
+
+
+@app.route('/readyz', methods=['GET'])
+def readiness_check():
+    # 停止中(SIGTERM・preStop)は503を返し、ALBのターゲットから外れるまでの間に新しいリクエストが来ないようにする
+    if health.is_draining():
+        return 'draining', 503
+    # バックエンドに接続できるか(結果は READINESS_CACHE_SECONDS 秒保持する)
+    reason = backend_ready()
+    if reason:
+        return reason, 503
     return 'OK'
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # 開発用サーバー。本番はgunicorn(gunicorn.conf.py)で起動する
+    app.run(host='0.0.0.0', port=5000, debug=os.getenv('FLASK_DEBUG', '0') == '1')
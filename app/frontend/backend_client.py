@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import observe_backend
+
+
+class BackendClient:
+    # バックエンド呼び出し用のHTTPクライアント。
+    # コネクションプール(HTTPAdapter)は全スレッドで共有し、keep-aliveで接続を使い回す。
+    # requests.Sessionはスレッドセーフではないので、Sessionはスレッドごとに作って同じAdapterをmountする。
+    # リトライはGET/HEADのみ(POSTは接続確立前の失敗だけリトライされる)。
+    # バックエンドにはgzip/deflateで圧縮したレスポンスを要求する(展開はrequestsが行う)。
+    # get_json()はURLごとに最後のレスポンスとETagを覚えておき、If-None-Matchで条件付きGETする。
+
+    def __init__(self, pool_size=10, connect_timeout=1.0, read_timeout=5.0, retries=2, backoff_factor=0.1,
+                 etag_cache_size=128):
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.timeout = (connect_timeout, read_timeout)
+        self._local = threading.local()
+        self.etag_cache_size = etag_cache_size
+        self._etag_cache = OrderedDict()
+        self._etag_lock = threading.Lock()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return observe_backend('GET', url, self.session.get, **kwargs)
+
+    def get_json(self, url, params=None):
+        return self.get_versioned_json(url, params)[1]
+
+    def get_versioned_json(self, url, params=None):
+        # (ETag, データ)を返す。ETagはレスポンスの内容のバージョンとして使える(無ければNone)
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._etag_lock:
+            cached = self._etag_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+
+        r = self.get(url, params=params, headers=headers)
+        if r.status_code == 304 and cached:
+            with self._etag_lock:
+                if key in self._etag_cache:
+                    self._etag_cache.move_to_end(key)
+            return cached
+        r.raise_for_status()
+        data = r.json()
+
+        etag = r.headers.get('ETag')
+        if etag and self.etag_cache_size:
+            with self._etag_lock:
+                self._etag_cache[key] = (etag, data)
+                self._etag_cache.move_to_end(key)
+                while len(self._etag_cache) > self.etag_cache_size:
+                    self._etag_cache.popitem(last=False)
+        return etag, data
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return observe_backend('POST', url, self.session.post, **kwargs)
@@ -0,0 +1,109 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from common.events import RESET
+
+
+# --------------------------------------------------------------
+# 新しいメッセージのserver-sent events(GET /events)
+#   BackendEventFeed: workerごとにバックエンドの GET /messages/events を1本だけ読み、
+#                     受け取ったイベントをプロセス内のEventHubに配る(ブラウザの数だけバックエンドに接続しない)
+#   ブラウザの接続(購読者)ごとのキューとSSEのレスポンスは common/events.py のEventHub・iter_stream。
+#   イベントのid(メッセージのcreated_sort)とdata(メッセージのJSON)はバックエンドから受け取ったまま送る。
+# --------------------------------------------------------------
+logger = logging.getLogger('frontend.events')
+
+
+class BackendEventFeed:
+    # スレッドは最初のsubscribe()で起動し(gunicornのpreload_appではfork後のworkerで起動される)、
+    # ブラウザが idle_seconds 秒つながっていなければバックエンドとの接続を閉じて終了する。
+    # 切断されたらbackoffしながら、最後に受け取ったidをLast-Event-IDにして再接続する。
+    # 待つ時間はランダムにし(full jitter)、backendの再起動や503の後に全workerが同時に再接続しないようにする。
+
+    def __init__(self, client, url, hub, read_timeout=45.0, idle_seconds=60.0, backoff=0.5, backoff_max=10.0):
+        self.client = client
+        self.url = url
+        self.hub = hub
+        self.read_timeout = read_timeout
+        self.idle_seconds = idle_seconds
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.last_event_id = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, last_event_id=None):
+        subscription = self.hub.subscribe(last_event_id)
+        if subscription is not None:
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='events', daemon=True)
+                    self._thread.start()
+        return subscription
+
+    def _idle(self, since):
+        return self.hub.subscriber_count() == 0 and time.monotonic() - since >= self.idle_seconds
+
+    def _run(self):
+        attempt = 0
+        idle_since = time.monotonic()
+        while True:
+            started = time.monotonic()
+            try:
+                for event in self._read():
+                    attempt = 0
+                    if self.hub.subscriber_count():
+                        idle_since = time.monotonic()
+                    elif self._idle(idle_since):
+                        return
+                    if event == RESET:
+                        # 取りこぼしたイベントは送り直せないので、次は今から後のイベントだけを読む
+                        # (Last-Event-IDを付けたままだと再接続のたびに reset を受け取る)
+                        self.last_event_id = None
+                        self.hub.reset()
+                    elif event is not None:
+                        self.last_event_id = event[0]
+                        self.hub.dispatch([event])
+                # すぐに閉じられた(停止中のバックエンドなど)場合も少し待ってから再接続する
+                if time.monotonic() - started < 1.0:
+                    attempt += 1
+            except requests.RequestException as e:
+                logger.warning('backend event stream failed: %s', e)
+                attempt += 1
+            if self.hub.subscriber_count():
+                idle_since = time.monotonic()
+            elif self._idle(idle_since):
+                return
+            if attempt:
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1))))
+
+    def _read(self):
+        # SSEを1イベントずつ返す((id, data)・RESET、コメント(keep-alive)はNone)
+        headers = {'Accept': 'text/event-stream'}
+        if self.last_event_id:
+            headers['Last-Event-ID'] = self.last_event_id
+        with self.client.get(self.url, headers=headers, stream=True,
+                             timeout=(self.client.timeout[0], self.read_timeout)) as r:
+            r.raise_for_status()
+            r.encoding = 'utf-8'
+            event_id, event_type, data = None, 'message', []
+            # chunk_size=None: 届いたchunk(1回のyield)ごとに読む
+            for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+                if line.startswith(':'):
+                    yield None
+                elif line.startswith('id:'):
+                    event_id = line[3:].strip()
+                elif line.startswith('event:'):
+                    event_type = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].lstrip())
+                elif not line:
+                    if event_type == 'reset':
+                        yield RESET
+                    elif data and event_id:
+                        yield event_id, '\n'.join(data)
+                    event_id, event_type, data = None, 'message', []
@@ -0,0 +1,29 @@
+import threading
+from collections import OrderedDict
+
+
+class FragmentCache:
+    # 描画済みのHTML断片を保持するLRUキャッシュ。
+    # キーにバックエンドのデータのバージョン(ETag)を含めるので、データが変われば別のキーになり、
+    # 古い断片はLRUで追い出される。max_entries=0でキャッシュしない。
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,17 @@
+# 本番用のgunicorn設定
+#   gunicorn --config gunicorn.conf.py app:app
+# 共通の設定は common/gunicorn_conf.py(gunicornはカレントディレクトリをsys.pathに加えてから読み込む)。
+import os
+
+# 共通の設定(worker数・タイムアウト・メトリクスファイルとdrainファイルの後始末)
+from common.gunicorn_conf import (  # noqa: F401
+    bind, workers, worker_class, threads, preload_app, timeout, graceful_timeout, keepalive, errorlog, loglevel,
+    on_starting, post_worker_init, child_exit
+)
+
+
+def worker_exit(server, worker):
+    # write-behindのキューに残っているメッセージをバックエンドに送り切ってから終了する
+    import app
+    if app.write_behind is not None:
+        app.write_behind.stop(timeout=float(os.getenv('WRITE_BEHIND_DRAIN_TIMEOUT', '10')))
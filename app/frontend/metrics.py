@@ -0,0 +1,48 @@
+import time
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from common import tracing
+# HTTPリクエストのメトリクスと /metrics は共通(app.pyから metrics.init_app / metrics.metrics_response で使う)
+from common.metrics import init_app, metrics_response, registry  # noqa: F401
+
+
+# --------------------------------------------------------------
+# frontendのPrometheusメトリクス(common/metrics.py の registry に登録する)
+# --------------------------------------------------------------
+BACKEND_LATENCY = Histogram(
+    'backend_request_duration_seconds', 'Latency of requests from the frontend to the backend',
+    ['method', 'path', 'status'], registry=registry
+)
+WRITE_BEHIND_QUEUE = Gauge(
+    'write_behind_queue_messages', 'Messages waiting to be sent to the backend', multiprocess_mode='livesum',
+    registry=registry
+)
+WRITE_BEHIND_MESSAGES = Counter(
+    'write_behind_messages_total', 'Messages handled by the write-behind queue', ['result'], registry=registry
+)
+FRAGMENT_CACHE = Counter(
+    'fragment_cache_requests_total', 'Rendered fragment cache lookups', ['result'], registry=registry
+)
+
+
+def observe_backend(method, url, func, **kwargs):
+    # バックエンドへのリクエストの所要時間(レスポンスヘッダーを受け取るまで)を記録する。
+    # トレースではCLIENTのspanにし、traceparentヘッダーでバックエンドにトレースを引き継ぐ。
+    # Server-Timingでは backend に数え、バックエンドが返したServer-Timingは backend-<名前> として加える
+    path = urlsplit(url).path
+    with tracing.span(f'{method} {path}', kind=tracing.CLIENT, timing='backend',
+                      **{'http.method': method, 'http.url': url}) as span:
+        if span.trace.trace_id:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, traceparent=span.traceparent())
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = func(url, **kwargs)
+            status = str(response.status_code)
+            span.set('http.status_code', response.status_code)
+            tracing.add_server_timing(response.headers.get('Server-Timing'), 'backend-')
+            return response
+        finally:
+            BACKEND_LATENCY.labels(method, path, status).observe(time.perf_counter() - started)
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import requests
+
+from metrics import WRITE_BEHIND_MESSAGES, WRITE_BEHIND_QUEUE
+
+
+logger = logging.getLogger('frontend.write_behind')
+
+
+class WriteBehindQueue:
+    # フォームから投稿されたメッセージを有界のキューに積み、バックグラウンドのスレッドで
+    # POST /messages/batch にまとめて送る(write-behind)。
+    #   - batch_size件たまるか、最初の1件からflush_interval秒経ったら送る
+    #   - submit()は積んだメッセージのuuidを返す。キューが一杯ならNoneを返す(呼び出し側で503を返す)
+    #   - 送信に失敗したメッセージ(5xx・接続エラー・UnprocessedItems)はbackoffしながら再送する。
+    #     uuidはキューに積むときに付けるので、バックエンドが書き込んだ後に応答が失われて再送しても二重に登録されない
+    #   - stop()でキューに残っているメッセージを送り切ってから終了する(gunicornのworker_exit・atexitから呼ぶ)。
+    #     stop()の後のsubmit()はNoneを返す(stopping()がTrueなら呼び出し側で同期的に送る)
+    # スレッドは最初のsubmit()で起動する(gunicornのpreload_appではfork後のworkerで起動される)。
+
+    def __init__(self, client, batch_url, max_size=1000, batch_size=100, flush_interval=0.2,
+                 backoff=0.1, backoff_max=2.0):
+        self.client = client
+        self.batch_url = batch_url
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._drain_deadline = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork前に作ったキュー・スレッドは使わない
+                self._pid = os.getpid()
+                self._queue = queue.Queue(maxsize=self.max_size)
+                self._thread = None
+                self._stopping.clear()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def submit(self, message):
+        self._ensure_started()
+        message = dict(message, uuid=str(uuid.uuid4()))
+        with self._lock:
+            # stop()の後に積んだメッセージは送られないまま失われるので受け付けない
+            if self._stopping.is_set():
+                return None
+            try:
+                self._queue.put_nowait(message)
+            except queue.Full:
+                WRITE_BEHIND_MESSAGES.labels('rejected').inc()
+                return None
+        WRITE_BEHIND_QUEUE.inc()
+        return message['uuid']
+
+    def stopping(self):
+        return self._stopping.is_set() and self._pid == os.getpid()
+
+    def stop(self, timeout=10.0):
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+            if thread is None:
+                return
+            self._drain_deadline = time.monotonic() + timeout
+            self._stopping.set()
+        thread.join(timeout + self.backoff_max)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._send(batch)
+                WRITE_BEHIND_QUEUE.dec(len(batch))
+            elif self._stopping.is_set():
+                return
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = 0 if self._stopping.is_set() else deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, batch):
+        pending = batch
+        attempt = 0
+        while pending:
+            try:
+                r = self.client.post(self.batch_url, json=pending)
+                if r.status_code in (200, 207):
+                    results = r.json()['items']
+                    failed = [pending[item['index']] for item in results if item['status'] == 'failed']
+                    invalid = sum(1 for item in results if item['status'] == 'invalid')
+                    if invalid:
+                        logger.warning('write-behind: backend rejected %d invalid messages', invalid)
+                        WRITE_BEHIND_MESSAGES.labels('invalid').inc(invalid)
+                    WRITE_BEHIND_MESSAGES.labels('flushed').inc(len(pending) - len(failed) - invalid)
+                    pending = failed
+                    if not pending:
+                        return
+                elif r.status_code < 500 and r.status_code != 429:
+                    # 4xxは再送しても成功しない(batch_sizeがバックエンドの上限を超えているなど)
+                    logger.error('write-behind: backend returned %d, dropping messages: %s',
+                                 r.status_code, json.dumps(pending, ensure_ascii=False))
+                    WRITE_BEHIND_MESSAGES.labels('dropped').inc(len(pending))
+                    return
+                else:
+                    logger.warning('write-behind: backend returned %d, retrying %d messages',
+                                   r.status_code, len(pending))
+            except (requests.RequestException, ValueError, KeyError) as e:
+                logger.warning('write-behind: %s, retrying %d messages', e, len(pending))
+
+            attempt += 1
+            if self._stopping.is_set() and time.monotonic() > self._drain_deadline:
+                # 終了の期限を過ぎたら、送れなかったメッセージをログに残して諦める
+                logger.error('write-behind: shutdown deadline exceeded, dropping messages: %s',
+                             json.dumps(pending, ensure_ascii=False))
+                WRITE_BEHIND_MESSAGES.labels('dropped').inc(len(pending))
+                return
+            time.sleep(min(self.backoff_max, self.backoff * 2 ** attempt))
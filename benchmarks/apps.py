@@ -0,0 +1,33 @@
+import importlib.util
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+
+
+def load_app(name, module='app', **environ):
+    # app/<name>/<module>.py をモジュール名 <name>_<module> として読み込む。
+    # frontend/backendは別コンテナ用に同名のモジュールを持つので、
+    # 読み込み後は各ディレクトリ由来のモジュールを sys.modules から外して衝突を避ける。
+    # 共通のパッケージ(app/common)もアプリごとに読み込み直す(コンテナと同じくアプリごとに別の状態を持つ)。
+    for key, value in environ.items():
+        os.environ[key] = str(value)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    app_dir = os.path.join(APP_DIR, name)
+    module_name = f'{name}_{module}'
+    before = set(sys.modules)
+    sys.path[:0] = [app_dir, APP_DIR]
+    try:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(app_dir, f'{module}.py'))
+        loaded = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = loaded
+        spec.loader.exec_module(loaded)
+    finally:
+        sys.path.remove(app_dir)
+        sys.path.remove(APP_DIR)
+        for key in set(sys.modules) - before:
+            path = getattr(sys.modules[key], '__file__', None) or ''
+            if key != module_name and path.startswith(APP_DIR + os.sep):
+                del sys.modules[key]
+    return loaded
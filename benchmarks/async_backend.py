@@ -0,0 +1,86 @@
+# WSGI版(app.py)とASGI版(asgi.py)の同時実行性能の比較
+#
+#   python -m benchmarks.async_backend
+#   python -m benchmarks.async_backend --requests 500 --latency 0.02 --threads 4 --concurrency 64
+#
+# DynamoDBは呼び出しごとに latency 秒待つFakeTableに置き換え、キャッシュは無効にする。
+# 1 worker あたりのスループットを比較する:
+#   wsgi-sync:    1スレッド(同期worker)で順番に処理
+#   wsgi-gthread: --threads 本のスレッドで処理(gthread worker相当)
+#   asgi:         1つのイベントループで --concurrency 件を同時に処理
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeTable
+
+
+def make_fake(latency, count):
+    fake = FakeTable(latency=latency)
+    message_uuids = [str(uuid.uuid4()) for _ in range(count)]
+    fake.load({'uuid': u, 'message': f'message {i}'} for i, u in enumerate(message_uuids))
+    return fake, message_uuids
+
+
+def result(mode, count, elapsed):
+    return {'mode': mode, 'requests': count, 'seconds': round(elapsed, 3),
+            'requests_per_second': round(count / elapsed, 1)}
+
+
+def bench_wsgi(args, threads):
+    backend = load_app('backend', CACHE_ENABLED='false')
+    backend.store.table, message_uuids = make_fake(args.latency, args.requests)
+    client = backend.app.test_client()
+
+    def get(message_uuid):
+        assert client.get(f'/messages/{message_uuid}').status_code == 200
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(get, message_uuids))
+    return time.perf_counter() - started
+
+
+def bench_asgi(args):
+    backend = load_app('backend', module='asgi', CACHE_ENABLED='false',
+                       ASYNC_DYNAMODB_CONCURRENCY=args.concurrency)
+    backend.store.table, message_uuids = make_fake(args.latency, args.requests)
+    client = backend.app.test_client()
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def get(message_uuid):
+            async with semaphore:
+                response = await client.get(f'/messages/{message_uuid}')
+                assert response.status_code == 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(get(u) for u in message_uuids))
+        return time.perf_counter() - started
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WSGI vs ASGI backend benchmark')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per DynamoDB call')
+    parser.add_argument('--threads', type=int, default=4, help='threads of the gthread worker')
+    parser.add_argument('--concurrency', type=int, default=64, help='in-flight requests of the ASGI worker')
+    args = parser.parse_args()
+
+    results = [
+        result('wsgi-sync', args.requests, bench_wsgi(args, 1)),
+        result('wsgi-gthread', args.requests, bench_wsgi(args, args.threads)),
+        result('asgi', args.requests, bench_asgi(args)),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
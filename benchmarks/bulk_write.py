@@ -0,0 +1,54 @@
+# POST /messages/batch と POST /messages の繰り返しのスループット比較
+#
+#   python -m benchmarks.bulk_write
+#   python -m benchmarks.bulk_write --items 2000 --latency 0.005 --unprocessed-rate 0.1
+#
+# DynamoDBはインメモリのFakeDynamoDB(呼び出しごとに遅延を入れる)に置き換える。
+import argparse
+import json
+import time
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeDynamoDB
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bulk write benchmark')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per DynamoDB call')
+    parser.add_argument('--item-latency', type=float, default=0.0001, help='seconds per written item')
+    parser.add_argument('--unprocessed-rate', type=float, default=0.0,
+                        help='fraction of batch items returned as UnprocessedItems')
+    args = parser.parse_args()
+
+    backend = load_app('backend', MESSAGES_BATCH_MAX_ITEMS=args.items)
+    messages = [{'message': f'message {i}'} for i in range(args.items)]
+    results = []
+
+    fake = FakeDynamoDB(latency=args.latency, item_latency=args.item_latency)
+    backend.store.db, backend.store.table = fake, fake.Table(backend.store.table_name)
+    client = backend.app.test_client()
+    started = time.perf_counter()
+    for message in messages:
+        client.post('/messages', json=message)
+    elapsed = time.perf_counter() - started
+    results.append({'mode': 'single', 'items': len(fake.Table(backend.store.table_name).items),
+                    'seconds': round(elapsed, 3), 'items_per_second': round(args.items / elapsed, 1)})
+
+    fake = FakeDynamoDB(latency=args.latency, item_latency=args.item_latency,
+                        unprocessed_rate=args.unprocessed_rate)
+    backend.store.db, backend.store.table = fake, fake.Table(backend.store.table_name)
+    body = ''.join(json.dumps(message) + '\n' for message in messages)
+    started = time.perf_counter()
+    response = client.post('/messages/batch', data=body, content_type='application/x-ndjson')
+    elapsed = time.perf_counter() - started
+    summary = response.get_json()
+    results.append({'mode': 'batch', 'items': len(fake.Table(backend.store.table_name).items),
+                    'created': summary['created'], 'failed': summary['failed'],
+                    'seconds': round(elapsed, 3), 'items_per_second': round(args.items / elapsed, 1)})
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
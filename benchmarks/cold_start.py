@@ -0,0 +1,69 @@
+# backendの起動時間(time-to-first-request)の計測
+#
+#   python -m benchmarks.cold_start
+#   python -m benchmarks.cold_start --runs 10
+#
+# 新しいPythonプロセスでbackendを読み込み、最初のリクエストを返すまでの時間を計測する。
+#   import_ms:            app.pyのimport(boto3のresourceはまだ作られない)
+#   client_ms:            get_table()でboto3のresourceを作る時間(以前はimport時に行っていた)
+#   first_request_ms:     最初のリクエスト(GET /messages/<uuid>)
+#   time_to_first_request_ms: プロセスの起動から最初のリクエストを返すまで
+# DynamoDBへの通信はFakeTableに置き換えるので、warm-up(接続の確立)の時間は含まない。
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+def child():
+    started = time.perf_counter()
+    from benchmarks.apps import load_app
+    from benchmarks.fakes import FakeTable
+
+    backend = load_app('backend', LOG_LEVEL='ERROR', AWS_ACCESS_KEY_ID='x', AWS_SECRET_ACCESS_KEY='x')
+    imported = time.perf_counter()
+    backend.store.get_table()
+    client_created = time.perf_counter()
+
+    table = FakeTable()
+    table.load([{'uuid': 'cold-start', 'message': 'hello'}])
+    backend.store.table = table
+    response = backend.app.test_client().get('/messages/cold-start')
+    assert response.status_code == 200
+    finished = time.perf_counter()
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'client_ms': (client_created - imported) * 1000,
+        'first_request_ms': (finished - client_created) * 1000,
+        'finished_at': time.time()
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cold start benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    samples = []
+    for _ in range(args.runs):
+        spawned = time.time()
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.cold_start', '--child'],
+                                check=True, capture_output=True, text=True).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        sample['time_to_first_request_ms'] = (sample.pop('finished_at') - spawned) * 1000
+        samples.append(sample)
+
+    result = {'runs': args.runs}
+    for key in ('import_ms', 'client_ms', 'first_request_ms', 'time_to_first_request_ms'):
+        result[key] = round(statistics.median(sample[key] for sample in samples), 1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
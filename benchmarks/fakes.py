@@ -0,0 +1,453 @@
+import bisect
+import queue
+import random
+import re
+import threading
+import time
+import zlib
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+
+# store.pyのQueryが使う形のKeyConditionExpressionだけを扱う: '#pk = :pk' [' AND #sk < :sk' | ' AND #sk > :sk']
+KEY_CONDITION = re.compile(r'^(#\w+) = (:\w+)(?: AND (#\w+) ([<>]) (:\w+))?$')
+# store.pyが使う形のConditionExpression(ANDで連結)とUpdateExpressionだけを扱う
+CONDITION = re.compile(r'^(?:(attribute_exists|attribute_not_exists)\((#?\w+)\)|(#?\w+) = (:\w+))$')
+UPDATE_CLAUSE = re.compile(r'\b(SET|REMOVE|ADD)\s+')
+OPERAND = re.compile(r'^(?:if_not_exists\((#?\w+), (:\w+)\)|(:\w+)|(#?\w+))$')
+
+
+def reject_floats(value):
+    # boto3と同じく、floatは書き込めない(Decimalにする)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        for v in value.values():
+            reject_floats(v)
+    elif isinstance(value, (list, set, frozenset)):
+        for v in value:
+            reject_floats(v)
+
+
+def check_condition(expression, item, names, values):
+    # 条件を満たさなければConditionalCheckFailedExceptionにする(itemはNone=アイテムが無い)
+    if not expression:
+        return
+    for term in expression.split(' AND '):
+        match = CONDITION.match(term.strip())
+        if not match:
+            raise ValueError(f'unsupported ConditionExpression: {expression}')
+        function, name, compared, value = match.groups()
+        current = (item or {}).get(names.get(name or compared, name or compared))
+        if function == 'attribute_exists':
+            ok = current is not None
+        elif function == 'attribute_not_exists':
+            ok = current is None
+        else:
+            ok = current is not None and current == values[value]
+        if not ok:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                         'Message': 'The conditional request failed'}}, 'ConditionCheck')
+
+
+def split_actions(clause):
+    # カンマで区切る(if_not_exists(...)の中のカンマでは区切らない)
+    actions, depth, start = [], 0, 0
+    for i, c in enumerate(clause):
+        depth += {'(': 1, ')': -1}.get(c, 0)
+        if c == ',' and depth == 0:
+            actions.append(clause[start:i].strip())
+            start = i + 1
+    actions.append(clause[start:].strip())
+    return [action for action in actions if action]
+
+
+def apply_update(expression, item, names, values):
+    # SET a = :v / a = if_not_exists(b, :v) [+|- :w]、REMOVE a、ADD a :v を適用したアイテムを返す
+    updated = dict(item)
+
+    def operand(text):
+        match = OPERAND.match(text.strip())
+        if not match:
+            raise ValueError(f'unsupported UpdateExpression: {expression}')
+        if match.group(1):
+            current = item.get(names.get(match.group(1), match.group(1)))
+            return current if current is not None else values[match.group(2)]
+        if match.group(3):
+            return values[match.group(3)]
+        return item[names.get(match.group(4), match.group(4))]
+
+    parts = UPDATE_CLAUSE.split(expression.strip())[1:]
+    for keyword, clause in zip(parts[::2], parts[1::2]):
+        for action in split_actions(clause):
+            if keyword == 'SET':
+                name, value = action.split(' = ', 1)
+                terms = re.split(r' ([+-]) ', value)
+                result = operand(terms[0])
+                for sign, term in zip(terms[1::2], terms[2::2]):
+                    result = result + operand(term) if sign == '+' else result - operand(term)
+                updated[names.get(name, name)] = result
+            elif keyword == 'REMOVE':
+                updated.pop(names.get(action, action), None)
+            else:
+                name, value = action.split(' ', 1)
+                name = names.get(name, name)
+                updated[name] = updated.get(name, 0) + values[value.strip()]
+    return updated
+
+
+def condition_failed(e, item, return_values):
+    # ReturnValuesOnConditionCheckFailure=ALL_OLD なら現在のアイテムを低レベルの形式で付ける
+    if return_values == 'ALL_OLD' and item is not None:
+        serializer = TypeSerializer()
+        e.response['Item'] = {name: serializer.serialize(value) for name, value in item.items()}
+    return e
+
+
+class FakeTable:
+    # DynamoDBテーブル(boto3 Table resource)のインメモリ代替。
+    # ベンチマーク用に、1回の呼び出しごとに latency 秒、1件ごとに item_latency 秒の遅延を入れる。
+    # page_size はScan/Query 1ページの件数(実際のDynamoDBの1MB制限の代わり)。
+    # indexes はGSI名 -> (パーティションキー, ソートキー)。キーの属性が無いアイテムはGSIに含まれない。
+    # put_item/update_itemは条件(ConditionExpression)を評価し、満たさなければClientErrorにする。
+
+    def __init__(self, key='uuid', latency=0.0, item_latency=0.0, page_size=100, indexes=None):
+        self.key = key
+        self.indexes = indexes or {'created-index': ('created_bucket', 'created_sort')}
+        self.latency = latency
+        self.item_latency = item_latency
+        self.page_size = page_size
+        self.items = {}
+        self._keys = []
+        self._segments = {}
+        self._index = {name: {} for name in self.indexes}  # GSI名 -> パーティション -> [(ソートキー, キー)]
+        self._lock = threading.Lock()
+
+    def _sleep(self, count=0):
+        delay = self.latency + self.item_latency * count
+        if delay:
+            time.sleep(delay)
+
+    def load(self, items):
+        # 遅延なしでまとめて投入する
+        with self._lock:
+            for item in items:
+                self._put(dict(item))
+
+    def _put(self, item):
+        key = item[self.key]
+        if key not in self.items:
+            bisect.insort(self._keys, key)
+            self._segments.clear()
+        else:
+            self._unindex(self.items[key])
+        self.items[key] = item
+        for name, (partition_key, sort_key) in self.indexes.items():
+            if partition_key in item and sort_key in item:
+                entries = self._index[name].setdefault(item[partition_key], [])
+                bisect.insort(entries, (item[sort_key], key))
+
+    def _unindex(self, item):
+        for name, (partition_key, sort_key) in self.indexes.items():
+            if partition_key in item and sort_key in item:
+                entries = self._index[name][item[partition_key]]
+                del entries[bisect.bisect_left(entries, (item[sort_key], item[self.key]))]
+
+    def _delete(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            self._segments.clear()
+            self._unindex(item)
+
+    def _segment_keys(self, segment, total_segments):
+        # セグメントごとのキー一覧(ソート済み)。書き込みがあるまで使い回す
+        if total_segments not in self._segments:
+            segments = [[] for _ in range(total_segments)]
+            for key in self._keys:
+                segments[zlib.crc32(key.encode('utf-8')) % total_segments].append(key)
+            self._segments[total_segments] = segments
+        return self._segments[total_segments][segment]
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValuesOnConditionCheckFailure=None, **kwargs):
+        reject_floats(Item)
+        with self._lock:
+            current = self.items.get(Item[self.key])
+            try:
+                check_condition(ConditionExpression, current, ExpressionAttributeNames or {},
+                                ExpressionAttributeValues or {})
+            except ClientError as e:
+                raise condition_failed(e, current, ReturnValuesOnConditionCheckFailure)
+            self._put(dict(Item))
+        self._sleep(1)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', ReturnValuesOnConditionCheckFailure=None,
+                    **kwargs):
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        reject_floats(values)
+        with self._lock:
+            current = self.items.get(Key[self.key])
+            try:
+                check_condition(ConditionExpression, current, names, values)
+            except ClientError as e:
+                raise condition_failed(e, current, ReturnValuesOnConditionCheckFailure)
+            item = apply_update(UpdateExpression, current or dict(Key), names, values)
+            if item.get(self.key) != Key[self.key]:
+                raise ValueError('Cannot update attribute {}. This attribute is part of the key'.format(self.key))
+            self._put(item)
+        self._sleep(1)
+        return {'Attributes': dict(item)} if ReturnValues == 'ALL_NEW' else {}
+
+    def get_item(self, Key, **kwargs):
+        with self._lock:
+            item = self.items.get(Key[self.key])
+        self._sleep(1 if item else 0)
+        return {'Item': dict(item)} if item else {}
+
+    def delete_item(self, Key, **kwargs):
+        with self._lock:
+            self._delete(Key[self.key])
+        self._sleep(1)
+        return {}
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, Segment=None, TotalSegments=None, **kwargs):
+        limit = min(Limit or self.page_size, self.page_size)
+        with self._lock:
+            keys = self._segment_keys(Segment, TotalSegments) if TotalSegments else self._keys
+            start = 0
+            if ExclusiveStartKey:
+                start = bisect.bisect_right(keys, ExclusiveStartKey[self.key])
+            page = [dict(self.items[key]) for key in keys[start:start + limit]]
+            more = start + limit < len(keys)
+        self._sleep(len(page))
+        db_response = {'Items': page, 'Count': len(page)}
+        if more:
+            db_response['LastEvaluatedKey'] = {self.key: page[-1][self.key]}
+        return db_response
+
+    def query(self, IndexName, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, **kwargs):
+        partition_key, sort_key = self.indexes[IndexName]
+        match = KEY_CONDITION.match(KeyConditionExpression)
+        if not match or ExpressionAttributeNames[match.group(1)] != partition_key:
+            raise ValueError(f'unsupported KeyConditionExpression: {KeyConditionExpression}')
+        partition = ExpressionAttributeValues[match.group(2)]
+        limit = min(Limit or self.page_size, self.page_size)
+        with self._lock:
+            entries = self._index[IndexName].get(partition, [])
+            # (ソートキー, キー)の昇順のリストから、条件に合う範囲を二分探索で求める
+            lo, hi = 0, len(entries)
+            if match.group(3):
+                bound = ExpressionAttributeValues[match.group(5)]
+                if match.group(4) == '<':
+                    hi = bisect.bisect_left(entries, (bound,))
+                else:
+                    lo = bisect.bisect_right(entries, (bound, chr(0x10ffff)))
+            if ExclusiveStartKey:
+                start = (ExclusiveStartKey[sort_key], ExclusiveStartKey[self.key])
+                if ScanIndexForward:
+                    lo = max(lo, bisect.bisect_right(entries, start))
+                else:
+                    hi = min(hi, bisect.bisect_left(entries, start))
+            selected = entries[lo:min(hi, lo + limit)] if ScanIndexForward else entries[max(lo, hi - limit):hi][::-1]
+            page = [dict(self.items[key]) for _, key in selected]
+            more = hi - lo > limit
+        self._sleep(len(page))
+        db_response = {'Items': page, 'Count': len(page)}
+        if more:
+            last = page[-1]
+            db_response['LastEvaluatedKey'] = {self.key: last[self.key], partition_key: partition,
+                                               sort_key: last[sort_key]}
+        return db_response
+
+
+class FakeDynamoDB:
+    # DynamoDB service resource(boto3.resource('dynamodb'))のインメモリ代替。
+    # batch_write_itemは unprocessed_rate の割合のアイテムをUnprocessedItemsとして返す(再送の確認用)。
+
+    def __init__(self, latency=0.0, item_latency=0.0, page_size=100, unprocessed_rate=0.0):
+        self.latency = latency
+        self.item_latency = item_latency
+        self.page_size = page_size
+        self.unprocessed_rate = unprocessed_rate
+        self.tables = {}
+        self._random = random.Random(0)
+
+    def Table(self, name):
+        if name not in self.tables:
+            self.tables[name] = FakeTable(latency=self.latency, item_latency=self.item_latency,
+                                          page_size=self.page_size)
+        return self.tables[name]
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        unprocessed = {}
+        count = 0
+        for name, write_requests in RequestItems.items():
+            if len(write_requests) > 25:
+                raise ValueError('BatchWriteItem accepts at most 25 requests')
+            fake = self.Table(name)
+            with fake._lock:
+                for write_request in write_requests:
+                    if self._random.random() < self.unprocessed_rate:
+                        unprocessed.setdefault(name, []).append(write_request)
+                    elif 'PutRequest' in write_request:
+                        reject_floats(write_request['PutRequest']['Item'])
+                        fake._put(dict(write_request['PutRequest']['Item']))
+                        count += 1
+                    else:
+                        fake._delete(write_request['DeleteRequest']['Key'][fake.key])
+                        count += 1
+        self.Table(next(iter(RequestItems)))._sleep(count)
+        return {'UnprocessedItems': unprocessed}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        unprocessed = {}
+        count = 0
+        for name, keys_and_attributes in RequestItems.items():
+            keys = keys_and_attributes['Keys']
+            if len(keys) > 100:
+                raise ValueError('BatchGetItem accepts at most 100 keys')
+            fake = self.Table(name)
+            if len({key[fake.key] for key in keys}) != len(keys):
+                raise ValueError('Provided list of item keys contains duplicates')
+            responses[name] = []
+            with fake._lock:
+                for key in keys:
+                    if self._random.random() < self.unprocessed_rate:
+                        unprocessed.setdefault(name, {'Keys': []})['Keys'].append(key)
+                    elif key[fake.key] in fake.items:
+                        responses[name].append(dict(fake.items[key[fake.key]]))
+                        count += 1
+        self.Table(next(iter(RequestItems)))._sleep(count)
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+
+class FakeRedis:
+    # Redis(redis.Redis)のインメモリ代替。RedisCacheが使うコマンド(GET/SET/MGET/DELETE/INCRとpipeline)と、
+    # RedisEventBusが使うpub/sub(PUBLISHとpubsub)だけを持つ。
+    # 1コマンド(pipelineは1回のexecute)ごとに latency 秒の遅延を入れる。複数のbackendで1つを共有できる。
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.data = {}
+        self.channels = {}
+        self.commands = 0
+        self._lock = threading.Lock()
+
+    def _sleep(self):
+        with self._lock:
+            self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _set(self, key, value, px=None, ex=None, nx=False):
+        if nx and self._get(key) is not None:
+            return None
+        ttl = px / 1000 if px is not None else ex
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif isinstance(value, int):
+            value = str(value).encode('ascii')
+        self.data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        return True
+
+    def get(self, key):
+        self._sleep()
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, px=None, ex=None, nx=False):
+        self._sleep()
+        with self._lock:
+            return self._set(key, value, px=px, ex=ex, nx=nx)
+
+    def mget(self, keys):
+        self._sleep()
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def delete(self, *keys):
+        self._sleep()
+        with self._lock:
+            return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def incr(self, key):
+        self._sleep()
+        with self._lock:
+            value = int(self._get(key) or 0) + 1
+            entry = self.data.get(key)
+            self.data[key] = (str(value).encode('ascii'), entry[1] if entry else None)
+            return value
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def publish(self, channel, message):
+        self._sleep()
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        with self._lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub.messages.put({'type': 'message', 'channel': channel, 'data': message})
+        return len(subscribers)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+
+    def __init__(self, client):
+        self.client = client
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self.client._lock:
+            for channel in channels:
+                self.client.channels.setdefault(channel, set()).add(self)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.client._lock:
+            for subscribers in self.client.channels.values():
+                subscribers.discard(self)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, key, value, px=None, ex=None, nx=False):
+        self.commands.append((key, value, px, ex, nx))
+        return self
+
+    def execute(self):
+        self.client._sleep()
+        with self.client._lock:
+            results = [self.client._set(key, value, px=px, ex=ex, nx=nx) for key, value, px, ex, nx in self.commands]
+        self.commands = []
+        return results
@@ -0,0 +1,68 @@
+# frontendのメッセージ一覧の描画キャッシュ(FRAGMENT_CACHE_SIZE)の比較
+#
+#   python -m benchmarks.fragment_cache
+#   python -m benchmarks.fragment_cache --page-size 100 --views 2000
+#
+# 同じページを繰り返し表示したときの、1回あたりのCPU時間(process_time)を計測する。
+#   cpu_ms_per_view:      リクエスト全体(テストクライアント・Flask・CSRFトークンの生成を含む)
+#   view_cpu_ms_per_view: home_page()の中だけ(一覧とフォームの描画)
+# バックエンドは常に同じETagと一覧を返すスタブに置き換え、frontendの描画だけを計測する。
+import argparse
+import json
+import time
+
+from benchmarks.apps import load_app
+
+
+class StubBackend:
+
+    def __init__(self, page_size):
+        self.page = {
+            'items': [{'uuid': f'{i:08d}', 'message': f'メッセージ {i} <b>escaped</b>'} for i in range(page_size)],
+            'next_cursor': 'eyJ1dWlkIjogIjAwMDAwMDk5In0'
+        }
+
+    def get_versioned_json(self, url, params=None):
+        return '"stub-etag"', self.page
+
+
+def measure(cache_size, page_size, views):
+    frontend = load_app('frontend', FRAGMENT_CACHE_SIZE=cache_size, PAGE_SIZE=page_size)
+    frontend.backend = StubBackend(page_size)
+    view = frontend.app.view_functions['home_page']
+    view_cpu = [0.0]
+
+    def timed_view(*args, **kwargs):
+        started_view = time.process_time()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            view_cpu[0] += time.process_time() - started_view
+
+    frontend.app.view_functions['home_page'] = timed_view
+    client = frontend.app.test_client()
+    client.get('/')  # テンプレートの読み込み
+    view_cpu[0] = 0.0
+
+    started_cpu, started = time.process_time(), time.perf_counter()
+    for _ in range(views):
+        response = client.get('/?cursor=eyJ1dWlkIjogIjAwMDAwMDE5In0')
+        assert response.status_code == 200
+    cpu, elapsed = time.process_time() - started_cpu, time.perf_counter() - started
+    return {'fragment_cache_size': cache_size, 'page_size': page_size, 'views': views,
+            'cpu_ms_per_view': round(cpu / views * 1000, 3),
+            'view_cpu_ms_per_view': round(view_cpu[0] / views * 1000, 3), 'views_per_second': round(views / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fragment cache benchmark')
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--views', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = [measure(cache_size, args.page_size, args.views) for cache_size in (0, 256)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# JSONの変換(JSON_PROVIDER)とレスポンス圧縮(COMPRESS_*)の比較
+#
+#   python -m benchmarks.json_compression
+#   python -m benchmarks.json_compression --items 10000 --runs 20
+#
+# DecimalとマルチバイトのメッセージでできたN件の一覧(GET /messages?limit=N)を
+#   before:    JSON_PROVIDER=default, 圧縮なし
+#   fast-json: JSON_PROVIDER=fast,    圧縮なし
+#   after:     JSON_PROVIDER=fast,    gzip
+# で返し、JSONの変換時間・レスポンスの大きさ・HTTP経由で受け取るまでの時間を計測する。
+# DynamoDBはインメモリのFakeTable、一覧のキャッシュは無効にする(変換と圧縮を毎回行う)。
+# ループバックで通信するので、request_msには転送量の削減による効果はほとんど表れない。
+import argparse
+import decimal
+import json
+import logging
+import statistics
+import threading
+import time
+import uuid
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeTable
+
+CONFIGS = {
+    'before': {'JSON_PROVIDER': 'default', 'COMPRESS_ENABLED': 'false'},
+    'fast-json': {'JSON_PROVIDER': 'fast', 'COMPRESS_ENABLED': 'false'},
+    'after': {'JSON_PROVIDER': 'fast', 'COMPRESS_ENABLED': 'true'},
+}
+
+
+def make_items(count):
+    return [{
+        'uuid': str(uuid.uuid4()),
+        'message': f'メッセージ {i} ' + 'lorem ipsum ' * 4,
+        'version': decimal.Decimal(i % 7 + 1),
+        'score': decimal.Decimal(i) / 8
+    } for i in range(count)]
+
+
+def timed(func, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return round(statistics.median(samples) * 1000, 2)
+
+
+def measure(name, environ, items, runs):
+    backend = load_app('backend', LOG_LEVEL='ERROR', CACHE_ENABLED='false',
+                       MESSAGES_MAX_PAGE_LIMIT=len(items), **environ)
+    table = FakeTable(page_size=len(items))
+    table.load(dict(item, **backend.store.created_attributes(item['uuid'], i)) for i, item in enumerate(items))
+    backend.store.table = table
+    backend.store.segment_table = lambda: table
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, backend.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/messages'
+    session = requests.Session()
+    params = {'limit': len(items)}
+    try:
+        body = backend.store.list_page(len(items))
+        with backend.app.app_context():
+            serialize_ms = timed(lambda: backend.app.json.response(body).get_data(), runs)
+
+        r = session.get(url, params=params, stream=True)
+        wire_bytes = len(r.raw.read(decode_content=False))
+        assert len(session.get(url, params=params).json()['items']) == len(items)
+        request_ms = timed(lambda: session.get(url, params=params).content, runs)
+        return {'mode': name, 'items': len(items), 'json_provider': environ['JSON_PROVIDER'],
+                'content_encoding': r.headers.get('Content-Encoding', 'identity'),
+                'serialize_ms': serialize_ms, 'response_bytes': wire_bytes, 'request_ms': request_ms}
+    finally:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON provider and compression benchmark')
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    items = make_items(args.items)
+    results = [measure(name, environ, items, args.runs) for name, environ in CONFIGS.items()]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# 新しい順のN件(GET /messages の1ページ目)を読むコストの比較
+#
+#   python -m benchmarks.latest_messages
+#   python -m benchmarks.latest_messages --sizes 1000 10000 100000 --limit 20
+#
+#   scan:  テーブル全件をScanして作成日時でソートする(created-index以前に新しい順を得る唯一の方法)
+#   query: created-indexの全バケットを新しい順にlimit件ずつQueryしてマージする(store.query_page)
+# 読み出したアイテム数(DynamoDBの消費RCUに比例する)と、1回あたりの時間を計測する。
+# DynamoDBはFakeTable(1回の呼び出しごとに --latency 秒、1件ごとに --item-latency 秒)に置き換える。
+import argparse
+import json
+import time
+import uuid
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeTable
+
+
+class CountingTable:
+    # 読み出したアイテム数を数える
+    def __init__(self, table):
+        self.table = table
+        self.items_read = 0
+
+    def scan(self, **kwargs):
+        db_response = self.table.scan(**kwargs)
+        self.items_read += db_response['Count']
+        return db_response
+
+    def query(self, **kwargs):
+        db_response = self.table.query(**kwargs)
+        self.items_read += db_response['Count']
+        return db_response
+
+
+def latest_by_scan(store, limit):
+    items = [item for page in store.scan_pages(store.get_table()) for item in page]
+    items.sort(key=lambda item: item['created_sort'], reverse=True)
+    return items[:limit]
+
+
+def measure(size, limit, runs, latency, item_latency):
+    backend = load_app('backend', LOG_LEVEL='ERROR', CACHE_ENABLED='false')
+    store = backend.store
+    fake = FakeTable(latency=latency, item_latency=item_latency, page_size=1000)
+    started_at = int(time.time() * 1000) - size
+    message_uuids = [str(uuid.uuid4()) for _ in range(size)]
+    fake.load(dict({'uuid': u, 'message': f'message {i}'}, **store.created_attributes(u, started_at + i))
+              for i, u in enumerate(message_uuids))
+    table = CountingTable(fake)
+    store.table = table
+    store.segment_table = lambda: table
+
+    results = []
+    for mode, func in (('scan', lambda: latest_by_scan(store, limit)),
+                       ('query', lambda: store.query_page(limit)['items'])):
+        table.items_read = 0
+        started = time.perf_counter()
+        for _ in range(runs):
+            items = func()
+        elapsed = time.perf_counter() - started
+        assert [item['uuid'] for item in items] == message_uuids[::-1][:limit]
+        results.append({'mode': mode, 'table_items': size, 'limit': limit,
+                        'items_read': table.items_read // runs, 'ms': round(elapsed / runs * 1000, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='latest N messages: Scan vs Query')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per DynamoDB call')
+    parser.add_argument('--item-latency', type=float, default=1e-05, help='seconds per read item')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results.extend(measure(size, args.limit, args.runs, args.latency, args.item_latency))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+# frontend/backend を通したE2E負荷試験(list/get/create/update/delete の混合)
+#
+#   python -m benchmarks.loadtest
+#   python -m benchmarks.loadtest --concurrency 1 8 32 --duration 10 --mix list=50 get=30 create=10 update=5 delete=5
+#   python -m benchmarks.loadtest --save-baseline benchmarks/baseline.json   # ベースラインを取る(変更前のコードで)
+#   python -m benchmarks.loadtest --baseline benchmarks/baseline.json         # 劣化していれば終了コード1
+#   python -m benchmarks.loadtest --frontend-url http://localhost:8080 --backend-url http://localhost:5050/messages
+#
+# URLを指定しない場合はfrontend/backendをプロセス内でwerkzeugのサーバーとして起動し、
+# DynamoDBはインメモリのFakeDynamoDB(呼び出しごとに遅延を入れる)に置き換える。
+# 負荷をかける側も同じプロセスで動くので、ベースラインは同じマシン・同じ引数で取ったものと比較する。
+# レイテンシの絶対値はマシンで大きく変わるため、ベースラインはリポジトリに含めない(.gitignore)。
+# 変更前のコードでその場で取り、変更後と比べる。引数・マシン(CPU数・アーキテクチャ・Python)が違う
+# ベースラインとは比較せずにエラーにする。
+#
+#   list:   GET  frontend /               (frontend -> GET /messages?limit=...)
+#   get:    GET  backend  /messages/<uuid>
+#   create: POST frontend /               (フォーム送信。frontend -> POST /messages)
+#   update: PUT  backend  /messages/<uuid>
+#   delete: DELETE backend /messages/<uuid>
+#
+# レスポンスのServer-Timingヘッダー(frontend: render / backend / backend-dynamodb など、backend: dynamodb)は
+# 操作ごとに server_timing としてp50/p95を出力する(どの区間で時間がかかったかを見る)。
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeDynamoDB
+
+OPERATIONS = ('list', 'get', 'create', 'update', 'delete')
+PERCENTILES = (50, 95, 99)
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def parse_mix(values):
+    mix = {}
+    for value in values:
+        name, _, weight = value.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'unknown operation: {name}')
+        mix[name] = float(weight)
+    return mix
+
+
+def serve(app):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # アクセスログで計測結果の出力を汚さない
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_apps(latency, item_latency):
+    backend = load_app('backend', LOG_LEVEL='ERROR')
+    fake = FakeDynamoDB(latency=latency, item_latency=item_latency)
+    backend.store.db, backend.store.table = fake, fake.Table(backend.store.table_name)
+    backend.store.segment_table = lambda: backend.store.table
+    backend_server = serve(backend.app)
+    backend_url = f'http://127.0.0.1:{backend_server.server_port}/messages'
+
+    frontend = load_app('frontend', BACKEND_URL=backend_url)
+    frontend_server = serve(frontend.app)
+    frontend_url = f'http://127.0.0.1:{frontend_server.server_port}'
+    return frontend_url, backend_url, [backend_server, frontend_server]
+
+
+def seed(backend_url, count):
+    uuids = []
+    for start in range(0, count, 500):
+        body = ''.join(json.dumps({'message': f'seed {i}'}) + '\n' for i in range(start, min(start + 500, count)))
+        r = requests.post(backend_url + '/batch', data=body, headers={'Content-Type': 'application/x-ndjson'})
+        r.raise_for_status()
+        uuids.extend(item['uuid'] for item in r.json()['items'] if item['status'] == 'created')
+    return uuids
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def parse_server_timing(header):
+    # 'render;dur=1.2, backend;dur=3.4' -> {'render': 1.2, 'backend': 3.4}(ミリ秒)
+    timings = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if name and key == 'dur':
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+def summarize_timings(timings):
+    summary = {}
+    for name, values in sorted(timings.items()):
+        values = sorted(values)
+        summary[name] = {f'p{p}_ms': round(percentile(values, p), 2) for p in PERCENTILES[:2]}
+    return summary
+
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    summary = {'requests': len(values), 'errors': errors}
+    if elapsed:
+        summary['throughput'] = round(len(values) / elapsed, 1)
+    for p in PERCENTILES:
+        value = percentile(values, p)
+        summary[f'p{p}_ms'] = round(value * 1000, 2) if value is not None else None
+    return summary
+
+
+class Worker:
+
+    def __init__(self, frontend_url, backend_url, pool, pool_lock):
+        self.frontend_url = frontend_url
+        self.backend_url = backend_url
+        self.pool = pool
+        self.pool_lock = pool_lock
+        self.session = requests.Session()
+        self.session.hooks['response'].append(self.keep_server_timing)
+        self.csrf_token = None
+        self.server_timing = {}
+
+    def keep_server_timing(self, r, *args, **kwargs):
+        self.server_timing = parse_server_timing(r.headers.get('Server-Timing'))
+
+    def pick(self):
+        return random.choice(self.pool['stable'])
+
+    def take(self):
+        with self.pool_lock:
+            disposable = self.pool['disposable']
+            return disposable.pop() if disposable else None
+
+    def list(self):
+        r = self.session.get(self.frontend_url + '/')
+        match = CSRF_TOKEN.search(r.text)
+        if match:
+            self.csrf_token = match.group(1)
+        return r.status_code
+
+    def get(self):
+        message_uuid = self.pick()
+        return self.session.get(f'{self.backend_url}/{message_uuid}').status_code
+
+    def create(self):
+        if self.csrf_token is None:
+            self.list()
+        form = {'message': 'load test', 'csrf_token': self.csrf_token or ''}
+        r = self.session.post(self.frontend_url + '/', data=form, allow_redirects=False)
+        return 200 if r.status_code == 302 else r.status_code
+
+    def update(self):
+        message_uuid = self.pick()
+        return self.session.put(f'{self.backend_url}/{message_uuid}', json={'message': 'updated'}).status_code
+
+    def delete(self):
+        message_uuid = self.take()
+        if message_uuid is None:
+            return self.get()
+        return self.session.delete(f'{self.backend_url}/{message_uuid}').status_code
+
+
+def run_level(concurrency, duration, warmup, mix, frontend_url, backend_url, pool):
+    operations, weights = zip(*mix.items())
+    pool_lock = threading.Lock()
+    latencies = {name: [] for name in operations}
+    errors = {name: 0 for name in operations}
+    timings = {name: {} for name in operations}
+    record_from = time.perf_counter() + warmup
+    stop_at = record_from + duration
+
+    def loop():
+        worker = Worker(frontend_url, backend_url, pool, pool_lock)
+        rng = random.Random()
+        local = {name: [] for name in operations}
+        local_errors = {name: 0 for name in operations}
+        local_timings = {name: {} for name in operations}
+        while True:
+            name = rng.choices(operations, weights)[0]
+            started = time.perf_counter()
+            if started >= stop_at:
+                break
+            worker.server_timing = {}
+            try:
+                ok = getattr(worker, name)() < 400
+            except requests.RequestException:
+                ok = False
+            if started < record_from:
+                continue
+            local[name].append(time.perf_counter() - started)
+            if not ok:
+                local_errors[name] += 1
+            for metric, value in worker.server_timing.items():
+                local_timings[name].setdefault(metric, []).append(value)
+        return local, local_errors, local_timings
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: loop(), range(concurrency)))
+    for local, local_errors, local_timings in results:
+        for name in operations:
+            latencies[name].extend(local[name])
+            errors[name] += local_errors[name]
+            for metric, values in local_timings[name].items():
+                timings[name].setdefault(metric, []).extend(values)
+
+    every = [value for name in operations for value in latencies[name]]
+    result = {'concurrency': concurrency, 'duration': duration}
+    result.update(summarize(every, sum(errors.values()), duration))
+    result['operations'] = {name: summarize(latencies[name], errors[name], duration) for name in operations}
+    for name in operations:
+        if timings[name]:
+            result['operations'][name]['server_timing'] = summarize_timings(timings[name])
+    return result
+
+
+def machine():
+    return {'machine': platform.machine(), 'cpus': os.cpu_count(), 'python': platform.python_version()}
+
+
+def incomparable(settings, baseline_settings):
+    # ベースラインと引数・マシンが違えば、違う項目の名前を返す(レイテンシを比べても意味がない)
+    return sorted(key for key in set(settings) | set(baseline_settings)
+                  if settings.get(key) != baseline_settings.get(key))
+
+
+def check_regressions(results, baseline, tolerance):
+    # ベースラインと同じ並列度・操作の p50/p95/p99 が (1 + tolerance) 倍を超えたら劣化とみなす
+    regressions = []
+    baseline_levels = {level['concurrency']: level for level in baseline['results']}
+    for level in results:
+        base = baseline_levels.get(level['concurrency'])
+        if base is None:
+            continue
+        pairs = [('all', level, base)]
+        pairs += [(name, level['operations'][name], base['operations'][name])
+                  for name in level['operations'] if name in base.get('operations', {})]
+        for name, current, previous in pairs:
+            for p in PERCENTILES:
+                key = f'p{p}_ms'
+                if current.get(key) is None or previous.get(key) is None:
+                    continue
+                if current[key] > previous[key] * (1 + tolerance):
+                    regressions.append({'concurrency': level['concurrency'], 'operation': name, 'metric': key,
+                                        'baseline': previous[key], 'current': current[key]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end load test')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds measured per concurrency level')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds excluded from the results')
+    parser.add_argument('--mix', nargs='+', default=['list=50', 'get=30', 'create=10', 'update=5', 'delete=5'])
+    parser.add_argument('--seed-items', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per DynamoDB call')
+    parser.add_argument('--item-latency', type=float, default=0.00001, help='seconds per scanned/written item')
+    parser.add_argument('--frontend-url', help='use a running frontend instead of starting one')
+    parser.add_argument('--backend-url', help='use a running backend (…/messages) instead of starting one')
+    parser.add_argument('--baseline', help='fail when latency regresses past this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed latency increase over the baseline')
+    parser.add_argument('--save-baseline', help='write the results to this file')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if bool(args.frontend_url) != bool(args.backend_url):
+        parser.error('--frontend-url and --backend-url must be given together')
+
+    servers = []
+    if args.frontend_url:
+        frontend_url, backend_url = args.frontend_url.rstrip('/'), args.backend_url.rstrip('/')
+    else:
+        frontend_url, backend_url, servers = start_apps(args.latency, args.item_latency)
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            # get/update は stable から、delete は disposable から取り出すので、削除済みのメッセージを読み書きしない
+            uuids = seed(backend_url, args.seed_items)
+            pool = {'stable': uuids[:len(uuids) // 2], 'disposable': uuids[len(uuids) // 2:]}
+            results.append(run_level(concurrency, args.duration, args.warmup, mix, frontend_url, backend_url, pool))
+    finally:
+        for server in servers:
+            server.shutdown()
+
+    report = {
+        'settings': {'mix': mix, 'duration': args.duration, 'seed_items': args.seed_items,
+                     'latency': args.latency, 'item_latency': args.item_latency,
+                     'target': 'external' if args.frontend_url else 'in-process', 'host': machine()},
+        'results': results
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        differences = incomparable(report['settings'], baseline.get('settings', {}))
+        if differences:
+            sys.exit('{} was recorded with different settings ({}); re-record it with --save-baseline '
+                     'on this machine'.format(args.baseline, ', '.join(differences)))
+        report['regressions'] = check_regressions(results, baseline, args.tolerance)
+
+    print(json.dumps(report, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# 並列Scan(Segment/TotalSegments)のベンチマーク
+#
+#   python -m benchmarks.parallel_scan
+#   python -m benchmarks.parallel_scan --items 50000 --segments 1 4 16
+#   python -m benchmarks.parallel_scan --endpoint-url http://localhost:8000  # DynamoDB Local
+#
+# GET /messages?format=ndjson による全件エクスポートの所要時間をセグメント数ごとに計測する。
+# --endpoint-url を指定しない場合はインメモリのFakeTable(呼び出しごとに遅延を入れる)を使う。
+import argparse
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeTable
+
+
+def make_items(count):
+    return [{'uuid': str(uuid.uuid4()), 'message': f'message {i}'} for i in range(count)]
+
+
+def prepare_dynamodb_local(endpoint_url, table_name, items):
+    import boto3
+
+    db = boto3.resource('dynamodb', endpoint_url=endpoint_url)
+    existing = [t.name for t in db.tables.all()]
+    if table_name in existing:
+        db.Table(table_name).delete()
+        db.Table(table_name).wait_until_not_exists()
+    table = db.create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': 'uuid', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'uuid', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.wait_until_exists()
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='parallel scan benchmark')
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--endpoint-url', default=None)
+    parser.add_argument('--table-name', default='messages-bench')
+    parser.add_argument('--latency', type=float, default=0.005, help='FakeTable: seconds per call')
+    parser.add_argument('--item-latency', type=float, default=0.00002, help='FakeTable: seconds per item')
+    parser.add_argument('--page-size', type=int, default=1000, help='FakeTable: items per scan page')
+    args = parser.parse_args()
+
+    environ = {'DYNAMODB_TABLE_NAME': args.table_name}
+    if args.endpoint_url:
+        environ['DYNAMODB_ENDPOINT_URL'] = args.endpoint_url
+    backend = load_app('backend', **environ)
+
+    items = make_items(args.items)
+    if args.endpoint_url:
+        prepare_dynamodb_local(args.endpoint_url, args.table_name, items)
+    else:
+        fake = FakeTable(latency=args.latency, item_latency=args.item_latency, page_size=args.page_size)
+        fake.load(items)
+        backend.store.table = fake
+        backend.store.segment_table = lambda: fake
+
+    client = backend.app.test_client()
+    results = []
+    for segments in args.segments:
+        backend.store.scan_segments = segments
+        backend.store.scan_executor = ThreadPoolExecutor(max_workers=segments, thread_name_prefix='scan')
+        started = time.perf_counter()
+        response = client.get('/messages?format=ndjson')
+        count = sum(1 for line in response.response if line.strip())
+        elapsed = time.perf_counter() - started
+        backend.store.scan_executor.shutdown()
+        results.append({
+            'segments': segments,
+            'items': count,
+            'seconds': round(elapsed, 3),
+            'items_per_second': round(count / elapsed, 1)
+        })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
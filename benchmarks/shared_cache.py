@@ -0,0 +1,135 @@
+# backendを複数レプリカで動かしたときのキャッシュの比較: memory(Podごと) と redis(Pod間で共有)
+#
+#   python -m benchmarks.shared_cache
+#   python -m benchmarks.shared_cache --replicas 4 --requests 5000 --latency 0.005 --redis-latency 0.0003
+#
+# 同じプロセスにbackendを --replicas 個読み込み(それぞれ別のstore・キャッシュを持つ)、
+# DynamoDBは全レプリカで共有するFakeTable、RedisはFakeRedis(インメモリのスタンドイン)に置き換える。
+#   hot:       少数のメッセージへのGETをレプリカに振り分け、DynamoDBのGetItem回数とレイテンシを計測する。
+#              5%はPUTで、直後に別のレプリカから読んで古い値が返った回数(stale_reads)も数える
+#   stampede:  キャッシュに無い1件へ --stampede 件のGETを同時に送り、GetItemが何回呼ばれたかを数える
+import argparse
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeRedis, FakeTable
+from benchmarks.loadtest import percentile
+
+
+class CountingTable:
+    # GetItemの回数を数える
+    def __init__(self, table):
+        self.table = table
+        self.get_items = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+    def get_item(self, **kwargs):
+        with self._lock:
+            self.get_items += 1
+        return self.table.get_item(**kwargs)
+
+
+def start_replicas(mode, replicas, table, redis_client, ttl):
+    backends = []
+    for _ in range(replicas):
+        backend = load_app('backend', LOG_LEVEL='ERROR', CACHE_TTL_SECONDS=ttl)
+        backend.store.table = table
+        backend.store.segment_table = lambda: table
+        if mode == 'redis':
+            backend.store.cache = backend.store.RedisCache(redis_client, ttl=ttl, prefix='bench')
+        backends.append(backend)
+    return backends
+
+
+def hot(mode, args):
+    fake = FakeTable(latency=args.latency)
+    message_uuids = [str(uuid.uuid4()) for _ in range(args.hot_items)]
+    fake.load({'uuid': u, 'message': 'v0'} for u in message_uuids)
+    table = CountingTable(fake)
+    redis_client = FakeRedis(latency=args.redis_latency)
+    backends = start_replicas(mode, args.replicas, table, redis_client, args.ttl)
+    clients = [backend.app.test_client() for backend in backends]
+    rng = random.Random(0)
+    operations = [(rng.choice(message_uuids), rng.random() < 0.05, i % args.replicas) for i in range(args.requests)]
+    stale = [0]
+    counter = itertools.count()
+    # 同じメッセージへのPUTと確認の読み出しが重ならないようにする
+    item_locks = {u: threading.Lock() for u in message_uuids}
+
+    def request(operation):
+        message_uuid, write, replica = operation
+        started = time.perf_counter()
+        if write:
+            with item_locks[message_uuid]:
+                value = f'v{next(counter)}'
+                r = clients[replica].put(f'/messages/{message_uuid}', json={'message': value})
+                assert r.status_code == 200, r.status_code
+                # 別のレプリカから読む
+                other = clients[(replica + 1) % args.replicas].get(f'/messages/{message_uuid}')
+                if other.get_json()['message'] != value:
+                    stale[0] += 1
+        else:
+            assert clients[replica].get(f'/messages/{message_uuid}').status_code == 200
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = sorted(executor.map(request, operations))
+    elapsed = time.perf_counter() - started
+    return {'scenario': 'hot', 'mode': mode, 'replicas': args.replicas, 'requests': args.requests,
+            'get_item_calls': table.get_items, 'stale_reads': stale[0],
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'requests_per_second': round(args.requests / elapsed, 1)}
+
+
+def stampede(mode, args):
+    fake = FakeTable(latency=args.latency)
+    fake.load([{'uuid': 'cold', 'message': 'hello'}])
+    table = CountingTable(fake)
+    redis_client = FakeRedis(latency=args.redis_latency)
+    backends = start_replicas(mode, args.replicas, table, redis_client, args.ttl)
+    clients = [backend.app.test_client() for backend in backends]
+    barrier = threading.Barrier(args.stampede)
+
+    def request(i):
+        barrier.wait()
+        assert clients[i % args.replicas].get('/messages/cold').status_code == 200
+
+    with ThreadPoolExecutor(max_workers=args.stampede) as executor:
+        list(executor.map(request, range(args.stampede)))
+    return {'scenario': 'stampede', 'mode': mode, 'replicas': args.replicas, 'concurrent_requests': args.stampede,
+            'get_item_calls': table.get_items}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='shared cache benchmark')
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--hot-items', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--stampede', type=int, default=48)
+    parser.add_argument('--ttl', type=float, default=30)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per DynamoDB call')
+    parser.add_argument('--redis-latency', type=float, default=0.0003, help='seconds per Redis command')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    results = []
+    for mode in ('memory', 'redis'):
+        results.append(hot(mode, args))
+        results.append(stampede(mode, args))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
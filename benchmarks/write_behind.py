@@ -0,0 +1,73 @@
+# frontendのフォーム投稿(POST /)の比較: 同期(1件ずつ POST /messages) と write-behind(WRITE_BEHIND=true)
+#
+#   python -m benchmarks.write_behind
+#   python -m benchmarks.write_behind --messages 2000 --concurrency 32 --latency 0.01
+#
+# backendはプロセス内のwerkzeugサーバー(DynamoDBはFakeDynamoDB)で動かし、
+# 投稿のレイテンシ(p50/p99)と、全件がDynamoDBに書き込まれるまでの時間を計測する。
+# write-behindではstop()でキューを送り切り、書き込まれた件数が投稿数と一致することを確認する。
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeDynamoDB
+from benchmarks.loadtest import percentile
+
+
+def measure(mode, messages, concurrency, latency):
+    backend = load_app('backend', LOG_LEVEL='ERROR')
+    fake = FakeDynamoDB(latency=latency)
+    backend.store.db, backend.store.table = fake, fake.Table(backend.store.table_name)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, backend.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    frontend = load_app('frontend', BACKEND_URL=f'http://127.0.0.1:{server.server_port}/messages',
+                        WRITE_BEHIND='true' if mode == 'write-behind' else 'false',
+                        WRITE_BEHIND_QUEUE_SIZE=messages)
+    frontend.app.config['WTF_CSRF_ENABLED'] = False
+
+    def post(i):
+        client = frontend.app.test_client()
+        started = time.perf_counter()
+        response = client.post('/', data={'message': f'message {i}'})
+        assert response.status_code == 302, response.status_code
+        return time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(post, range(messages)))
+        submitted = time.perf_counter() - started
+        if frontend.write_behind is not None:
+            frontend.write_behind.stop(timeout=30)
+        persisted = time.perf_counter() - started
+    finally:
+        server.shutdown()
+
+    written = len(fake.Table(backend.store.table_name).items)
+    assert written == messages, (written, messages)
+    return {'mode': mode, 'messages': messages, 'concurrency': concurrency,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2), 'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'submit_seconds': round(submitted, 3), 'persisted_seconds': round(persisted, 3), 'written': written}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write-behind benchmark')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per DynamoDB call')
+    args = parser.parse_args()
+
+    results = [measure(mode, args.messages, args.concurrency, args.latency) for mode in ('sync', 'write-behind')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import pytest
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeDynamoDB
+from benchmarks.loadtest import serve
+
+
+# アプリの設定はimport時に環境変数から読むので、テストごとにモジュールを読み込み直す。
+# DynamoDBはインメモリのFakeDynamoDBに置き換える(benchmarks/fakes.py)
+@pytest.fixture
+def load_backend(monkeypatch, tmp_path):
+    def load(module='app', **environ):
+        monkeypatch.setenv('LOG_LEVEL', 'ERROR')
+        monkeypatch.setenv('DRAIN_FILE', str(tmp_path / 'draining'))
+        monkeypatch.setenv('EVENTS_SOCKET_DIR', str(tmp_path / 'events'))
+        for key, value in environ.items():
+            monkeypatch.setenv(key, str(value))
+        backend = load_app('backend', module=module)
+        fake = FakeDynamoDB()
+        backend.store.db, backend.store.table = fake, fake.Table(backend.store.table_name)
+        backend.store.segment_table = lambda: backend.store.table
+        return backend
+    return load
+
+
+@pytest.fixture
+def backend(load_backend):
+    return load_backend()
+
+
+@pytest.fixture
+def client(backend):
+    return backend.app.test_client()
+
+
+@pytest.fixture
+def backend_url(backend):
+    # frontendのテスト用に、backendをwerkzeugのサーバーとして起動する
+    server = serve(backend.app)
+    yield f'http://127.0.0.1:{server.server_port}/messages'
+    server.shutdown()
+
+
+@pytest.fixture
+def load_frontend(monkeypatch, tmp_path, backend_url):
+    def load(**environ):
+        monkeypatch.setenv('BACKEND_URL', backend_url)
+        monkeypatch.setenv('DRAIN_FILE', str(tmp_path / 'draining'))
+        for key, value in environ.items():
+            monkeypatch.setenv(key, str(value))
+        frontend = load_app('frontend')
+        frontend.app.config['WTF_CSRF_ENABLED'] = False
+        return frontend
+    return load
+
+
+@pytest.fixture
+def frontend(load_frontend):
+    return load_frontend()
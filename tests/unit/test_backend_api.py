@@ -0,0 +1,413 @@
+import asyncio
+import base64
+import decimal
+import gzip
+import json
+import multiprocessing
+import os
+import time
+import zlib
+
+import pytest
+
+
+def create(client, message='hello'):
+    r = client.post('/messages', json={'message': message})
+    assert r.status_code == 200
+    return r.get_json()['message'].split()[0]
+
+
+def test_create_and_get(client):
+    message_uuid = create(client, 'こんにちは')
+    r = client.get(f'/messages/{message_uuid}')
+    assert r.status_code == 200
+    item = r.get_json()
+    assert item['message'] == 'こんにちは'
+    assert item['created_sort'] == '{:013d}#{}'.format(item['created_at'], message_uuid)
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'text', 3])
+def test_create_rejects_non_object(client, body):
+    assert client.post('/messages', json=body).status_code == 400
+    assert client.post('/messages', data='not json', content_type='application/json').status_code == 400
+
+
+def test_get_missing(client):
+    r = client.get('/messages/nope')
+    assert r.status_code == 404
+    assert r.get_json() == {'message': 'nope not found.'}
+
+
+def test_conditional_get(client):
+    message_uuid = create(client)
+    r = client.get(f'/messages/{message_uuid}')
+    etag = r.headers['ETag']
+    assert client.get(f'/messages/{message_uuid}', headers={'If-None-Match': etag}).status_code == 304
+    client.put(f'/messages/{message_uuid}', json={'message': 'changed'})
+    assert client.get(f'/messages/{message_uuid}', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_list_pages_forward_and_back(client):
+    for i in range(25):
+        create(client, f'm{i}')
+    pages = [client.get('/messages?limit=10').get_json()]
+    assert pages[0]['prev_cursor'] is None
+    while pages[-1]['next_cursor']:
+        pages.append(client.get('/messages?limit=10&cursor=' + pages[-1]['next_cursor']).get_json())
+    assert [len(page['items']) for page in pages] == [10, 10, 5]
+    listed = [item['created_sort'] for page in pages for item in page['items']]
+    assert listed == sorted(listed, reverse=True) and len(set(listed)) == 25
+
+    # prev_cursorを辿ると同じページに戻り、1ページ目ではprev_cursorがNoneになる
+    page = pages[-1]
+    for expected in reversed(pages[:-1]):
+        page = client.get('/messages?limit=10&cursor=' + page['prev_cursor']).get_json()
+        assert page['items'] == expected['items']
+    assert page['prev_cursor'] is None
+
+
+@pytest.mark.parametrize('query', ['limit=abc', 'limit=0', 'limit=101', 'cursor=abc', 'cursor=e30'])
+def test_list_rejects_bad_parameters(client, query):
+    assert client.get('/messages?' + query).status_code == 400
+
+
+def test_scan_mode_pages_and_rejects_foreign_cursors(load_backend):
+    client = load_backend(MESSAGES_LIST_MODE='scan').app.test_client()
+    for i in range(5):
+        create(client, f'm{i}')
+    page = client.get('/messages?limit=3').get_json()
+    rest = client.get('/messages?limit=3&cursor=' + page['next_cursor']).get_json()
+    assert len({item['uuid'] for item in page['items'] + rest['items']}) == 5
+    # テーブルのキー({'uuid': 文字列})でないカーソルはDynamoDBに渡さない
+    for start_key in ({'foo': 1}, {'uuid': 1}, {'uuid': 'a', 'foo': 'b'}):
+        cursor = base64.urlsafe_b64encode(json.dumps(start_key).encode()).decode()
+        assert client.get('/messages?cursor=' + cursor).status_code == 400
+
+
+def test_list_conditional_get(client):
+    create(client)
+    r = client.get('/messages')
+    assert client.get('/messages', headers={'If-None-Match': r.headers['ETag']}).status_code == 304
+    create(client, 'new')
+    assert client.get('/messages', headers={'If-None-Match': r.headers['ETag']}).status_code == 200
+
+
+def test_ndjson_export(client):
+    for i in range(150):
+        create(client, f'm{i}')
+    r = client.get('/messages?format=ndjson')
+    assert r.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert sorted(line['message'] for line in lines) == sorted(f'm{i}' for i in range(150))
+
+
+def test_batch_create(client):
+    r = client.post('/messages/batch', json=[{'message': 'a'}, {'message': 'b'}])
+    assert r.status_code == 200
+    body = r.get_json()
+    assert (body['created'], body['failed'], body['invalid']) == (2, 0, 0)
+    assert client.get(f'/messages/{body["items"][1]["uuid"]}').get_json()['message'] == 'b'
+
+
+def test_batch_ndjson_with_invalid_lines(client):
+    r = client.post('/messages/batch', data='{"message": "a"}\nnot json\n[1]\n',
+                    content_type='application/x-ndjson')
+    assert r.status_code == 207
+    assert [item['status'] for item in r.get_json()['items']] == ['created', 'invalid', 'invalid']
+
+
+def test_batch_rejects_bad_bodies(load_backend):
+    client = load_backend(MESSAGES_BATCH_MAX_ITEMS=2).app.test_client()
+    assert client.post('/messages/batch', json={'message': 'a'}).status_code == 400
+    assert client.post('/messages/batch', json=[{'message': 'a'}] * 3).status_code == 413
+
+
+def test_multi_get(client):
+    a, b = create(client, 'a'), create(client, 'b')
+    r = client.get(f'/messages?ids={b},missing,{a},{b}')
+    assert r.status_code == 200
+    body = r.get_json()
+    assert [item['message'] for item in body['items']] == ['b', 'a']
+    assert body['missing'] == ['missing']
+    assert client.post('/messages/_mget', json={'ids': [a]}).get_json()['items'][0]['uuid'] == a
+
+
+def test_multi_get_errors(load_backend):
+    client = load_backend(MESSAGES_MGET_MAX_IDS=2).app.test_client()
+    assert client.post('/messages/_mget', json={'ids': 'a'}).status_code == 400
+    assert client.post('/messages/_mget', json=['a']).status_code == 400
+    assert client.get('/messages?ids=a,b,c').status_code == 413
+
+
+def test_put_replaces_message(client):
+    message_uuid = create(client)
+    created = client.get(f'/messages/{message_uuid}').get_json()
+    r = client.put(f'/messages/{message_uuid}', json={'message': 'replaced'})
+    assert r.status_code == 200
+    item = client.get(f'/messages/{message_uuid}').get_json()
+    assert item['message'] == 'replaced'
+    # 作成日時(一覧の位置)は引き継ぐ
+    assert item['created_sort'] == created['created_sort']
+
+
+def test_put_and_patch_reject_bad_bodies(client):
+    message_uuid = create(client)
+    assert client.put(f'/messages/{message_uuid}', json=['x']).status_code == 400
+    assert client.put(f'/messages/{message_uuid}', json={'message': 'x', 'version': -1}).status_code == 400
+    assert client.patch(f'/messages/{message_uuid}', json=['x']).status_code == 400
+    assert client.patch(f'/messages/{message_uuid}', json={'uuid': 'other'}).status_code == 400
+
+
+def test_delete(client):
+    message_uuid = create(client)
+    assert client.delete(f'/messages/{message_uuid}').status_code == 200
+    assert client.get(f'/messages/{message_uuid}').status_code == 404
+
+
+def test_reads_are_cached(backend, client):
+    message_uuid = create(client)
+    backend.store.cache.delete(('message', message_uuid))
+    client.get(f'/messages/{message_uuid}')
+    client.get(f'/messages/{message_uuid}')
+    stats = client.get('/cache/stats').get_json()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+def test_cache_disabled(load_backend):
+    client = load_backend(CACHE_ENABLED='false').app.test_client()
+    assert client.get('/cache/stats').get_json() == {'enabled': False}
+
+
+def test_compression(client):
+    client.post('/messages/batch', json=[{'message': 'x' * 100} for _ in range(20)])
+    r = client.get('/messages', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['ETag'].startswith('W/')
+    assert len(json.loads(gzip.decompress(r.get_data()))['items']) == 20
+    # 小さいレスポンスは圧縮しない
+    r = client.get('/messages/nope', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in r.headers
+
+
+def test_compressed_export_is_sent_page_by_page(backend, client):
+    # 圧縮したNDJSONエクスポートも、Scanの1ページ目を最後のページより前に送る
+    for i in range(150):
+        backend.store.table.put_item(Item={'uuid': f'{i:03d}', 'message': f'm{i}'})
+    r = client.get('/messages?format=ndjson', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+    assert r.headers['Content-Encoding'] == 'gzip'
+    chunks = list(r.response)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert len(decompressor.decompress(chunks[0]).decode().splitlines()) == 100
+    rest = b''.join(decompressor.decompress(chunk) for chunk in chunks[1:]) + decompressor.flush()
+    assert len(rest.decode().splitlines()) == 50
+
+
+class AsyncBody:
+    # QuartのResponseのbody(async with で開いて async for で読む)
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def test_async_compressor_flushes_each_chunk(backend):
+    async def first_chunk():
+        stream = backend.compression.compress_async_stream(AsyncBody(['a\n' * 100, 'b\n']), 'gzip', 1)
+        return await stream.__anext__()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(asyncio.run(first_chunk())) == b'a\n' * 100
+
+
+def test_probes(backend, client):
+    assert client.get('/livez').status_code == 200
+    assert client.get('/healthz').status_code == 200
+    backend.health.start_draining()
+    r = client.get('/readyz')
+    assert (r.status_code, r.get_json()) == (503, {'message': 'draining'})
+    backend.health.reset_draining()
+
+
+def test_metrics(client):
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert b'http_requests_total' in r.get_data()
+
+
+def test_asgi_api(load_backend):
+    app = load_backend(module='asgi').app
+
+    async def run():
+        client = app.test_client()
+        r = await client.post('/messages', json={'message': 'asgi'})
+        assert r.status_code == 200
+        message_uuid = (await r.get_json())['message'].split()[0]
+        r = await client.get(f'/messages/{message_uuid}')
+        assert (await r.get_json())['message'] == 'asgi'
+        assert (await client.get(f'/messages/{message_uuid}',
+                                 headers={'If-None-Match': r.headers['ETag']})).status_code == 304
+        assert (await client.post('/messages', json=[1])).status_code == 400
+        assert (await client.get('/messages?limit=abc')).status_code == 400
+        assert (await client.get('/messages/nope')).status_code == 404
+        r = await client.get('/messages?limit=1')
+        assert [item['message'] for item in (await r.get_json())['items']] == ['asgi']
+        assert (await client.delete(f'/messages/{message_uuid}')).status_code == 200
+
+    asyncio.run(run())
+
+
+def test_batch_with_client_uuids_is_idempotent(backend, client):
+    message_uuid = '6b1f7c4e-2a4b-4d9e-8f3a-0c5d2e1b9a77'
+    body = [{'uuid': message_uuid, 'message': 'once'}, {'message': 'fresh'}]
+    first = client.post('/messages/batch', json=body).get_json()
+    # 応答が失われたクライアントが同じbatchを再送しても、二重に登録しない
+    second = client.post('/messages/batch', json=[dict(item) for item in body]).get_json()
+    assert first['items'][0]['uuid'] == second['items'][0]['uuid'] == message_uuid
+    assert (second['created'], second['failed']) == (2, 0)
+    messages = [item['message'] for item in backend.store.table.items.values()]
+    assert sorted(messages) == ['fresh', 'fresh', 'once']
+
+
+def test_batch_rejects_bad_client_uuids(client):
+    message_uuid = '6b1f7c4e-2a4b-4d9e-8f3a-0c5d2e1b9a77'
+    r = client.post('/messages/batch', json=[{'uuid': 'abc'}, {'uuid': 1}, {'uuid': message_uuid},
+                                             {'uuid': message_uuid}])
+    assert r.status_code == 207
+    assert [item['status'] for item in r.get_json()['items']] == ['invalid', 'invalid', 'created', 'invalid']
+
+
+def test_versioned_writes_conflict_with_current_version(client):
+    message_uuid = create(client)
+    assert client.put(f'/messages/{message_uuid}', json={'message': 'a', 'version': 0}).get_json()['version'] == 1
+    r = client.put(f'/messages/{message_uuid}', json={'message': 'b', 'version': 0})
+    assert (r.status_code, r.get_json()['version']) == (409, 1)
+    r = client.patch(f'/messages/{message_uuid}', json={'message': 'b', 'version': 5})
+    assert (r.status_code, r.get_json()['version']) == (409, 1)
+    assert client.get(f'/messages/{message_uuid}').get_json()['message'] == 'a'
+
+
+def test_versioned_writes_to_missing_item(client):
+    assert client.put('/messages/missing', json={'message': 'a', 'version': 1}).status_code == 404
+    assert client.patch('/messages/missing', json={'message': 'a'}).status_code == 404
+    assert client.patch('/messages/missing', json={'message': 'a', 'version': 1}).status_code == 404
+
+
+def test_versions_increase_across_put_and_patch(client):
+    message_uuid = create(client)
+    versions = [
+        client.put(f'/messages/{message_uuid}', json={'message': 'a'}).get_json()['version'],
+        client.patch(f'/messages/{message_uuid}', json={'message': 'b'}).get_json()['version'],
+        client.put(f'/messages/{message_uuid}', json={'message': 'c'}).get_json()['version'],
+        client.patch(f'/messages/{message_uuid}', json={'message': 'd'}).get_json()['version']
+    ]
+    assert versions == [1, 2, 3, 4]
+    # 無条件のPUTを挟んでも、古いversionを指定した書き込みは通らない
+    assert client.put(f'/messages/{message_uuid}', json={'message': 'e', 'version': 2}).status_code == 409
+
+
+def test_put_keeps_created_and_removes_stale_attributes_in_one_write(backend, client):
+    message_uuid = create(client)
+    client.patch(f'/messages/{message_uuid}', json={'extra': 'x'})
+    created_sort = client.get(f'/messages/{message_uuid}').get_json()['created_sort']
+    update_item = backend.store.table.update_item
+    calls = []
+    backend.store.table.update_item = lambda **kwargs: calls.append(kwargs) or update_item(**kwargs)
+    assert client.put(f'/messages/{message_uuid}', json={'message': 'replaced'}).status_code == 200
+    assert len(calls) == 1
+    item = backend.store.table.items[message_uuid]
+    assert 'extra' not in item
+    assert (item['message'], item['created_sort'], item['version']) == ('replaced', created_sort, 2)
+
+
+@pytest.mark.parametrize('version', [None, 1])
+def test_put_retries_when_written_concurrently(backend, client, version):
+    # GetItemとUpdateItemの間に他の書き込みがあった場合、versionを送らないPUTは読み直して書き直す
+    message_uuid = create(client)
+    client.patch(f'/messages/{message_uuid}', json={'extra': 'x'})
+    update_item = backend.store.table.update_item
+    concurrent = [{'other': 'y'}]
+
+    def racing_update_item(**kwargs):
+        if concurrent:
+            update_item(Key={'uuid': message_uuid}, UpdateExpression='SET #o = :o ADD #version :one',
+                        ExpressionAttributeNames={'#o': 'other', '#version': 'version'},
+                        ExpressionAttributeValues={':o': concurrent.pop()['other'], ':one': 1})
+        return update_item(**kwargs)
+    backend.store.table.update_item = racing_update_item
+    body = {'message': 'replaced'} if version is None else {'message': 'replaced', 'version': version}
+    r = client.put(f'/messages/{message_uuid}', json=body)
+    item = backend.store.table.items[message_uuid]
+    if version is None:
+        assert (r.status_code, r.get_json()['version']) == (200, 3)
+        assert ('extra' in item, 'other' in item, item['message']) == (False, False, 'replaced')
+    else:
+        assert (r.status_code, r.get_json()['version']) == (409, 2)
+        assert (item['extra'], item['other']) == ('x', 'y')
+
+
+@pytest.mark.parametrize('json_provider', ['fast', 'default'])
+def test_floats_are_stored_as_decimal(load_backend, json_provider):
+    backend = load_backend(JSON_PROVIDER=json_provider)
+    client = backend.app.test_client()
+    message_uuid = client.post('/messages', json={'message': 'a', 'score': 1.5}).get_json()['message'].split()[0]
+    assert client.put(f'/messages/{message_uuid}', json={'message': 'b', 'score': 2.25}).status_code == 200
+    assert client.patch(f'/messages/{message_uuid}', json={'score': 0.1}).status_code == 200
+    r = client.post('/messages/batch', data='{"message": "c", "score": 3.5}\n', content_type='application/x-ndjson')
+    assert r.status_code == 200
+    assert backend.store.table.items[message_uuid]['score'] == decimal.Decimal('0.1')
+
+
+def test_event_stream_limit(load_backend):
+    client = load_backend(GUNICORN_THREADS=3).app.test_client()
+    # 既定の上限はスレッド数 - 2。超えた接続は503
+    first = client.get('/messages/events', buffered=False)
+    assert first.status_code == 200
+    assert client.get('/messages/events', buffered=False).status_code == 503
+    first.close()
+    second = client.get('/messages/events', buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+
+def test_event_stream_resends_and_resets(load_backend):
+    client = load_backend(EVENTS_BUFFER_SIZE=2).app.test_client()
+    sorts = []
+    for message in ('first', 'second'):
+        time.sleep(0.002)  # イベントのid(created_sort)はミリ秒単位
+        sorts.append(client.get(f'/messages/{create(client, message)}').get_json()['created_sort'])
+    # Last-Event-ID以降のイベントを送り直す
+    r = client.get('/messages/events', headers={'Last-Event-ID': sorts[0]}, buffered=False)
+    stream = iter(r.response)
+    assert next(stream) == b'retry: 2000\n\n'
+    assert next(stream).startswith(f'id: {sorts[1]}\n'.encode())
+    r.close()
+    # バッファから溢れたイベントより前から再開する場合は reset を送って閉じる
+    time.sleep(0.002)
+    create(client, 'third')
+    r = client.get('/messages/events', headers={'Last-Event-ID': sorts[0]}, buffered=False)
+    assert list(r.response) == [b'retry: 2000\n\n', b'event: reset\ndata: {}\n\n']
+    r.close()
+
+
+def test_events_are_delivered_between_workers(backend):
+    # EVENTS_BACKEND=memoryでも、別のworker(fork後のプロセス)で作成されたメッセージが届く
+    bus = backend.store.message_events
+    subscription = bus.subscribe()
+    bus.max_datagram = 50  # 1件ずつのdatagramに分かれる
+    events = [(f'{i:013d}#m', json.dumps({'message': f'm{i}'})) for i in range(3)]
+    worker = multiprocessing.get_context('fork').Process(target=bus.publish, args=(events,))
+    worker.start()
+    worker.join()
+    assert [event for _ in events for event in subscription.get(timeout=1)] == events
+    # 終了したworkerのソケットは次に送るときに削除する
+    bus.publish(events[:1])
+    assert os.listdir(bus.directory) == [f'{os.getpid()}.sock']
+    subscription.close()
@@ -0,0 +1,171 @@
+import decimal
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from benchmarks.apps import load_app
+from benchmarks.fakes import FakeRedis
+
+
+@pytest.fixture(scope='module')
+def cache():
+    return load_app('backend', module='cache')
+
+
+def test_ttl_expiry(cache):
+    c = cache.TTLCache(ttl=0.05)
+    c.set('a', 1)
+    assert c.get('a') == 1
+    time.sleep(0.06)
+    assert c.get('a') is None
+    assert c.stats()['expirations'] == 1
+
+
+def test_lru_eviction(cache):
+    c = cache.TTLCache(max_entries=2)
+    c.set('a', 1)
+    c.set('b', 2)
+    c.get('a')
+    c.set('c', 3)
+    assert c.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+    assert c.stats()['evictions'] == 1
+
+
+def test_generation_invalidates_entries(cache):
+    c = cache.TTLCache()
+    c.set('a', 1)
+    c.bump_generation()
+    assert c.get('a') is None
+    assert c.stats()['invalidations'] == 1
+
+
+def _bump(c):
+    c.bump_generation()
+
+
+def test_generation_is_shared_with_forked_workers(cache):
+    # gunicorn(preload_app)と同じく、fork前に作ったキャッシュの世代は子プロセスの書き込みで進む
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('fork is not available')
+    c = cache.TTLCache()
+    c.set('a', 1)
+    worker = multiprocessing.get_context('fork').Process(target=_bump, args=(c,))
+    worker.start()
+    worker.join()
+    assert c.generation() == 1
+    assert c.get('a') is None
+
+
+def test_value_loaded_across_a_write_is_not_reused(cache):
+    c = cache.TTLCache()
+
+    def loader():
+        c.bump_generation()
+        return 'stale'
+    assert c.get_or_load('a', loader) == 'stale'
+    assert c.get('a') is None
+
+
+def test_get_or_load_coalesces_concurrent_loads(cache):
+    c = cache.TTLCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(1)
+        return 'value'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(c.get_or_load('a', loader))) for _ in range(4)]
+    threads[0].start()
+    started.wait(1)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ['value'] * 4
+    assert len(calls) == 1
+
+
+# --------------------------------------------------------------
+# RedisCache(RedisはFakeRedisで代替する。2つのRedisCacheで2つのPodを表す)
+# --------------------------------------------------------------
+class BrokenRedis:
+    # 接続できないRedis: すべてのコマンドが失敗する
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError('redis is down')
+        return fail
+
+
+def test_redis_ttl_expiry(cache):
+    c = cache.RedisCache(FakeRedis(), ttl=0.05)
+    c.set('a', {'n': decimal.Decimal('1.5')})
+    assert c.get('a') == {'n': decimal.Decimal('1.5')}
+    time.sleep(0.06)
+    assert c.get('a') is None
+
+
+def test_redis_generation_is_shared_between_pods(cache):
+    redis = FakeRedis()
+    pod_a, pod_b = cache.RedisCache(redis), cache.RedisCache(redis)
+    key = ('page', pod_b.generation())
+    pod_b.set(key, ['old page'])
+    pod_a.bump_generation()
+    # 世代はキーに含めるので、他のPodの書き込みの後は前の世代のページを読まない
+    assert pod_b.generation() == key[1] + 1
+    assert pod_b.get(('page', pod_b.generation())) is None
+
+
+def test_redis_value_loaded_across_a_write_is_not_reused(cache):
+    redis = FakeRedis()
+    pod_a, pod_b = cache.RedisCache(redis), cache.RedisCache(redis)
+
+    def loader():
+        # pod_aがDynamoDBから読んだ後、保存する前にpod_bが書き込む
+        pod_b.bump_generation()
+        pod_b.set('a', 'new')
+        return 'stale'
+    assert pod_a.get_or_load('a', loader) == 'stale'
+    assert pod_a.get('a') == 'new'
+
+
+def test_redis_lock_coalesces_loads_across_pods(cache):
+    redis = FakeRedis()
+    pod_a = cache.RedisCache(redis, lock_timeout=1.0, poll_interval=0.005)
+    pod_b = cache.RedisCache(redis, lock_timeout=1.0, poll_interval=0.005)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_loader():
+        calls.append('a')
+        started.set()
+        release.wait(1)
+        return 'value'
+    loading = threading.Thread(target=lambda: pod_a.get_or_load('a', slow_loader))
+    loading.start()
+    started.wait(1)
+    threading.Timer(0.05, release.set).start()
+    # pod_bはロック(SET NX)を取れないので、pod_aが書き込むのを待って読む
+    assert pod_b.get_or_load('a', lambda: calls.append('b') or 'other') == 'value'
+    loading.join()
+    assert calls == ['a']
+    assert pod_b.stats()['lock_waits'] == 1
+
+
+def test_redis_failure_falls_back_to_loader(cache):
+    c = cache.RedisCache(BrokenRedis())
+    c.set('a', 1)
+    assert c.get('a') is None
+    assert c.get_many(['a']) == {}
+    assert c.get_or_load('a', lambda: 'loaded') == 'loaded'
+    c.bump_generation()
+    c.delete('a')
+    # 世代が分からない間は毎回違う値にして、一覧ページを使い回さない
+    assert c.generation() != c.generation()
+    assert c.stats()['errors'] >= 7
@@ -1,15 +1,308 @@
+import json
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
+import pytest
+
+from _stacks.eks import (EksStack, compute_profiles, frontend_event_streams, gunicorn_workers, performance_profiles,
+                         request_threads, shared_cache_defaults, termination_grace_period_seconds)
+
+env = core.Environment(account='123456789012', region='ap-northeast-1')
+
+
+def synth(context=None, **kwargs):
+    app = core.App(context=context)
+    stack = EksStack(app, 'EksStack', env=env, **kwargs)
+    return assertions.Template.from_stack(stack)
+
+
+def manifests(template, kind):
+    # add_manifestのManifest(JSON文字列。トークンを含む場合はFn::Join)から、指定したkindのものを返す
+    found = []
+    for resource in template.find_resources('Custom::AWSCDK-EKS-KubernetesResource').values():
+        manifest = resource['Properties']['Manifest']
+        if isinstance(manifest, dict):
+            manifest = ''.join(part if isinstance(part, str) else 'TOKEN' for part in manifest['Fn::Join'][1])
+        found.extend(m for m in json.loads(manifest) if m['kind'] == kind)
+    return {m['metadata']['name']: m for m in found}
+
+
+# EksStackのsynthは時間がかかるので、プロファイルごとにモジュールで1回だけ行う
+@pytest.fixture(scope='module')
+def template():
+    return synth()
+
+
+@pytest.fixture(scope='module')
+def production():
+    return synth(performance_profile='production')
+
+
+def test_dynamodb_created_index(template):
+    template.has_resource_properties('AWS::DynamoDB::Table', {
+        'KeySchema': [{'AttributeName': 'uuid', 'KeyType': 'HASH'}],
+        'AttributeDefinitions': assertions.Match.array_with([
+            {'AttributeName': 'created_bucket', 'AttributeType': 'S'},
+            {'AttributeName': 'created_sort', 'AttributeType': 'S'}
+        ]),
+        'GlobalSecondaryIndexes': [{
+            'IndexName': 'created-index',
+            'KeySchema': [
+                {'AttributeName': 'created_bucket', 'KeyType': 'HASH'},
+                {'AttributeName': 'created_sort', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': assertions.Match.any_value()
+        }]
+    })
+
+
+def test_backend_can_query_indexes(template):
+    table_arn = {'Fn::GetAtt': [assertions.Match.string_like_regexp('DynamoDbTable'), 'Arn']}
+    template.has_resource_properties('AWS::IAM::Policy', {
+        'PolicyDocument': {
+            'Statement': assertions.Match.array_with([
+                assertions.Match.object_like({
+                    'Action': assertions.Match.array_with(['dynamodb:Query']),
+                    'Resource': [
+                        table_arn,
+                        {'Fn::Join': ['', [table_arn, '/index/*']]}
+                    ]
+                })
+            ])
+        }
+    })
+
+
+@pytest.fixture(scope='module')
+def graviton():
+    return synth(compute_profile='graviton')
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        EksStack(core.App(), 'EksStack', env=env, performance_profile='unknown')
+    with pytest.raises(ValueError):
+        EksStack(core.App(), 'EksStack', env=env, compute_profile='unknown')
+
+
+@pytest.mark.parametrize('profile_name', ['workshop', 'production'])
+def test_autoscaling_per_profile(template, production, profile_name):
+    profile = performance_profiles[profile_name]
+    synthesized = template if profile_name == 'workshop' else production
+
+    synthesized.has_resource_properties('Custom::AWSCDK-EKS-HelmChart', {
+        'Chart': 'metrics-server',
+        'Namespace': 'kube-system'
+    })
+
+    deployments = manifests(synthesized, 'Deployment')
+    autoscalers = manifests(synthesized, 'HorizontalPodAutoscaler')
+    for name in ('frontend', 'backend'):
+        scaling = profile[name]
+        # replicasはHPAに任せる
+        assert 'replicas' not in deployments[name]['spec']
+        container = deployments[name]['spec']['template']['spec']['containers'][0]
+        assert container['resources'] == scaling['resources']
+
+        hpa = autoscalers[name]['spec']
+        assert hpa['scaleTargetRef'] == {'apiVersion': 'apps/v1', 'kind': 'Deployment', 'name': name}
+        assert (hpa['minReplicas'], hpa['maxReplicas']) == (scaling['min_replicas'], scaling['max_replicas'])
+        assert hpa['metrics'][0]['resource']['target'] == {
+            'type': 'Utilization', 'averageUtilization': scaling['target_cpu_utilization']
+        }
+
+
+def test_workshop_dynamodb_autoscaling(template):
+    profile = performance_profiles['workshop']
+    template.has_resource_properties('AWS::DynamoDB::Table', {
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': profile['dynamodb_min_capacity'],
+            'WriteCapacityUnits': profile['dynamodb_min_capacity']
+        }
+    })
+    # テーブルとcreated-indexの読み込み・書き込み容量
+    template.resource_count_is('AWS::ApplicationAutoScaling::ScalableTarget', 4)
+    for dimension in ('table:ReadCapacityUnits', 'table:WriteCapacityUnits',
+                      'index:ReadCapacityUnits', 'index:WriteCapacityUnits'):
+        template.has_resource_properties('AWS::ApplicationAutoScaling::ScalableTarget', {
+            'ScalableDimension': f'dynamodb:{dimension}',
+            'MinCapacity': profile['dynamodb_min_capacity'],
+            'MaxCapacity': profile['dynamodb_max_capacity']
+        })
+    template.has_resource_properties('AWS::ApplicationAutoScaling::ScalingPolicy', {
+        'PolicyType': 'TargetTrackingScaling',
+        'TargetTrackingScalingPolicyConfiguration': assertions.Match.object_like({
+            'TargetValue': profile['dynamodb_target_utilization']
+        })
+    })
+
+
+def test_production_dynamodb_on_demand(production):
+    production.has_resource_properties('AWS::DynamoDB::Table', {
+        'BillingMode': 'PAY_PER_REQUEST',
+        'ProvisionedThroughput': assertions.Match.absent(),
+        'GlobalSecondaryIndexes': [assertions.Match.object_like({
+            'IndexName': 'created-index',
+            'ProvisionedThroughput': assertions.Match.absent()
+        })]
+    })
+    production.resource_count_is('AWS::ApplicationAutoScaling::ScalableTarget', 0)
+
+
+@pytest.fixture(scope='module')
+def workshop_with_cache():
+    return synth(context={'shared_cache': 'true'})
+
+
+def container_env(synthesized, name):
+    container = manifests(synthesized, 'Deployment')[name]['spec']['template']['spec']['containers'][0]
+    return {e['name']: e['value'] for e in container['env']}
+
+
+def backend_env(synthesized):
+    return container_env(synthesized, 'backend')
+
+
+@pytest.mark.parametrize('profile_name', ['workshop', 'production'])
+def test_shared_cache(workshop_with_cache, production, profile_name):
+    # workshopはプロファイルでは作らず、-c shared_cache=true で作る
+    settings = performance_profiles[profile_name]['shared_cache'] or shared_cache_defaults
+    synthesized = workshop_with_cache if profile_name == 'workshop' else production
+
+    synthesized.has_resource_properties('AWS::ElastiCache::ReplicationGroup', {
+        'Engine': 'redis',
+        'CacheNodeType': settings['node_type'],
+        'NumCacheClusters': 1 + settings['replicas'],
+        'AutomaticFailoverEnabled': settings['replicas'] > 0
+    })
+    # DataStore(isolated)サブネットに配置する
+    subnet_group = next(iter(synthesized.find_resources('AWS::ElastiCache::SubnetGroup').values()))
+    subnet_ids = [subnet['Ref'] for subnet in subnet_group['Properties']['SubnetIds']]
+    assert subnet_ids and all(subnet_id.startswith('VpcDataStoreSubnet') for subnet_id in subnet_ids)
+    synthesized.has_resource_properties('AWS::EC2::SecurityGroupIngress', {
+        'FromPort': 6379,
+        'ToPort': 6379,
+        'SourceSecurityGroupId': {'Fn::GetAtt': [assertions.Match.string_like_regexp('EksAppCluster'),
+                                                 'ClusterSecurityGroupId']}
+    })
+
+    env = backend_env(synthesized)
+    assert env['CACHE_BACKEND'] == 'redis'
+    assert env['CACHE_REDIS_URL'] == 'redis://TOKEN:TOKEN/0'
+
+
+@pytest.mark.parametrize('profile_name', ['workshop', 'production'])
+def test_without_shared_cache(template, profile_name):
+    # workshopの既定と、-c shared_cache=false(productionでも作らない)
+    synthesized = template if profile_name == 'workshop' else synth(performance_profile='production',
+                                                                     shared_cache=False)
+    for resource_type in ('AWS::ElastiCache::ReplicationGroup', 'AWS::ElastiCache::SubnetGroup'):
+        synthesized.resource_count_is(resource_type, 0)
+    env = backend_env(synthesized)
+    assert 'CACHE_BACKEND' not in env and 'CACHE_REDIS_URL' not in env
+
+
+@pytest.mark.parametrize('profile_name', ['workshop', 'production'])
+def test_backend_event_streams(template, production, profile_name):
+    # frontendが最大までスケールしても、最小の台数のbackendで全workerのストリームを受けられる
+    profile = performance_profiles[profile_name]
+    synthesized = template if profile_name == 'workshop' else production
+    env = backend_env(synthesized)
+    streams = int(env['EVENTS_MAX_STREAMS'])
+    frontend_streams = profile['frontend']['max_replicas'] * gunicorn_workers(profile['frontend']['resources'])
+    backend_workers = profile['backend']['min_replicas'] * gunicorn_workers(profile['backend']['resources'])
+    assert streams * backend_workers >= 2 * frontend_streams
+    assert int(env['GUNICORN_THREADS']) == streams + request_threads
+
+
+def test_frontend_event_streams(template):
+    # frontendもストリーム数 + リクエスト用のスレッド数にする
+    env = container_env(template, 'frontend')
+    assert int(env['EVENTS_MAX_STREAMS']) == frontend_event_streams
+    assert int(env['GUNICORN_THREADS']) == frontend_event_streams + request_threads
+
+
+def test_gunicorn_workers():
+    assert gunicorn_workers({'limits': {'cpu': '500m'}}) == 3
+    assert gunicorn_workers({'limits': {'cpu': '1'}}) == 3
+    assert gunicorn_workers({'limits': {'cpu': '1500m'}}) == 5
+
+
+@pytest.mark.parametrize('profile_name', ['workshop', 'production', 'graviton'])
+def test_compute_profile(template, production, graviton, profile_name):
+    compute = compute_profiles[profile_name]
+    synthesized = {'workshop': template, 'production': production, 'graviton': graviton}[profile_name]
+
+    synthesized.has_resource_properties('Custom::AWSCDK-EKS-Cluster', {
+        'Config': assertions.Match.object_like({'version': compute['kubernetes_version']})
+    })
+    synthesized.resource_count_is('AWS::EKS::Nodegroup', len(compute['node_groups']))
+    for node_group in compute['node_groups']:
+        synthesized.has_resource_properties('AWS::EKS::Nodegroup', {
+            'InstanceTypes': node_group['instance_types'],
+            'AmiType': 'AL2_ARM_64' if node_group['arch'] == 'arm64' else 'AL2_x86_64',
+            'CapacityType': 'SPOT' if node_group['capacity'] == 'spot' else 'ON_DEMAND',
+            'ScalingConfig': {
+                'MinSize': node_group['min_size'],
+                'DesiredSize': node_group['desired_size'],
+                'MaxSize': node_group['max_size']
+            }
+        })
+
+    # cluster-autoscaler(IRSA)
+    synthesized.has_resource_properties('Custom::AWSCDK-EKS-HelmChart', {
+        'Chart': 'cluster-autoscaler',
+        'Namespace': 'kube-system',
+        'Values': assertions.Match.object_like({'Fn::Join': assertions.Match.any_value()})
+    })
+    chart = next(resource['Properties'] for resource in
+                 synthesized.find_resources('Custom::AWSCDK-EKS-HelmChart').values()
+                 if resource['Properties']['Chart'] == 'cluster-autoscaler')
+    values = json.loads(''.join(part if isinstance(part, str) else 'TOKEN' for part in chart['Values']['Fn::Join'][1]))
+    assert values['image']['tag'] == compute['cluster_autoscaler_image_tag']
+    assert values['rbac']['serviceAccount'] == {'name': 'cluster-autoscaler', 'create': False}
+    assert manifests(synthesized, 'ServiceAccount')['cluster-autoscaler']['metadata']['annotations'] == {
+        'eks.amazonaws.com/role-arn': 'TOKEN'
+    }
+    synthesized.has_resource_properties('AWS::IAM::Policy', {
+        'PolicyDocument': {
+            'Statement': assertions.Match.array_with([
+                assertions.Match.object_like({
+                    'Action': ['autoscaling:SetDesiredCapacity', 'autoscaling:TerminateInstanceInAutoScalingGroup'],
+                    'Condition': {'StringEquals': {'aws:ResourceTag/k8s.io/cluster-autoscaler/enabled': 'true'}}
+                })
+            ])
+        }
+    })
+
+    deployments = manifests(synthesized, 'Deployment')
+    for name in ('frontend', 'backend'):
+        assert deployments[name]['spec']['template']['spec']['topologySpreadConstraints'] == [{
+            'maxSkew': 1,
+            'topologyKey': 'topology.kubernetes.io/zone',
+            'whenUnsatisfiable': compute['zone_spread'],
+            'labelSelector': {'matchLabels': {'app': name}}
+        }]
 
-from _stacks.flask_eks_workshop_extend_stack import FlaskEksWorkshopExtendStack
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in flask_eks_workshop_extend/flask_eks_workshop_extend_stack.py
-def test_sqs_queue_created():
-    app = core.App()
-    stack = FlaskEksWorkshopExtendStack(app, "flask-eks-workshop-extend")
-    template = assertions.Template.from_stack(stack)
+def test_rolling_update(template):
+    deployments = manifests(template, 'Deployment')
+    for name in ('frontend', 'backend'):
+        spec = deployments[name]['spec']
+        assert spec['strategy'] == {'type': 'RollingUpdate', 'rollingUpdate': {'maxSurge': '25%', 'maxUnavailable': 0}}
+        pod = spec['template']['spec']
+        container = pod['containers'][0]
+        assert container['livenessProbe']['httpGet'] == {'path': '/livez', 'port': 5000}
+        assert container['readinessProbe']['httpGet'] == {'path': '/readyz', 'port': 5000}
+        # preStopで待つ時間 + gunicornのgraceful_timeout(25秒)より長く待ってから強制終了する
+        command = container['lifecycle']['preStop']['exec']['command']
+        assert command[:2] == ['/bin/sh', '-c'] and 'touch /tmp/draining' in command[2]
+        drain_seconds = int(command[2].rsplit('sleep ', 1)[1])
+        assert pod['terminationGracePeriodSeconds'] == termination_grace_period_seconds > drain_seconds + 25
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+    annotations = manifests(template, 'Ingress')['frontend']['metadata']['annotations']
+    assert annotations['alb.ingress.kubernetes.io/healthcheck-path'] == '/readyz'
+    assert annotations['alb.ingress.kubernetes.io/target-group-attributes'] == 'deregistration_delay.timeout_seconds=30'
+    namespace = manifests(template, 'Namespace')['frontend']
+    assert namespace['metadata']['labels']['elbv2.k8s.aws/pod-readiness-gate-inject'] == 'enabled'
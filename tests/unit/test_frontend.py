@@ -0,0 +1,154 @@
+import time
+
+import requests
+
+
+def seed(backend_url, count):
+    # 作成日時を指定してPUTし、一覧の順序(新しい順)を固定する
+    for i in range(count):
+        r = requests.put(f'{backend_url}/m{i}', json={'message': f'message {i}', 'created_at': 1000 + i})
+        r.raise_for_status()
+
+
+def test_home_page_lists_newest_messages(backend_url, frontend):
+    seed(backend_url, 3)
+    r = frontend.app.test_client().get('/')
+    assert r.status_code == 200
+    html = r.get_data(as_text=True)
+    assert html.index('message 2') < html.index('message 1') < html.index('message 0')
+    assert 'data-live="true"' in html
+    assert r.headers['Server-Timing'].startswith('backend')
+
+
+def test_home_page_pagination(backend_url, load_frontend):
+    seed(backend_url, 5)
+    client = load_frontend(PAGE_SIZE=2).app.test_client()
+    html = client.get('/').get_data(as_text=True)
+    assert 'Previous' not in html
+    next_url = html.split('<a href="')[1].split('"')[0].replace('&amp;', '&')
+    assert next_url.count('cursor=') == 1 and 'prev=' not in next_url
+
+    html = client.get(next_url).get_data(as_text=True)
+    assert 'message 2' in html and 'message 1' in html
+    assert 'data-live' not in html
+    prev_url = html.split('<a href="')[1].split('"')[0].replace('&amp;', '&')
+    html = client.get(prev_url).get_data(as_text=True)
+    assert 'message 4' in html and 'message 3' in html and 'Previous' not in html
+
+
+def test_post_message_redirects(backend_url, frontend):
+    client = frontend.app.test_client()
+    r = client.post('/', data={'message': 'from form'})
+    assert r.status_code == 302
+    assert 'from form' in client.get('/').get_data(as_text=True)
+
+
+def test_post_message_json(frontend):
+    client = frontend.app.test_client()
+    r = client.post('/', data={'message': 'from script'}, headers={'Accept': 'application/json'})
+    assert (r.status_code, r.get_json()['message']) == (201, 'created')
+    # 投稿したメッセージ(uuid付き)を返し、ページのスクリプトが一覧に追加する
+    item = r.get_json()['item']
+    assert client.get('/').get_data(as_text=True).count(f'<li id="message-{item["uuid"]}">from script</li>') == 1
+    r = client.post('/', data={'message': ''}, headers={'Accept': 'application/json'})
+    assert r.status_code == 400
+    assert 'message' in r.get_json()['errors']
+
+
+def test_post_message_invalid_form(frontend):
+    r = frontend.app.test_client().post('/', data={'message': ''})
+    assert r.status_code == 200
+    assert '<form' in r.get_data(as_text=True)
+
+
+def test_export(backend_url, frontend):
+    seed(backend_url, 3)
+    r = frontend.app.test_client().get('/export')
+    assert r.mimetype == 'application/x-ndjson'
+    assert len(r.get_data(as_text=True).splitlines()) == 3
+
+
+def test_readiness(backend, frontend):
+    client = frontend.app.test_client()
+    assert client.get('/livez').status_code == 200
+    # バックエンドの /readyz が503(DynamoDBのwarm-up前)の間はfrontendも503
+    backend.store._warm.set()
+    backend.store.check_dynamodb = lambda: None
+    assert client.get('/readyz').status_code == 200
+    frontend.health.start_draining()
+    assert client.get('/readyz').status_code == 503
+    frontend.health.reset_draining()
+
+
+class LosesFirstResponse:
+    # バックエンドには届いたが応答が失われた(接続が切れた)状況を再現する
+    def __init__(self):
+        self.posts = 0
+
+    def post(self, url, **kwargs):
+        self.posts += 1
+        r = requests.post(url, **kwargs)
+        if self.posts == 1:
+            raise requests.ConnectionError('connection reset')
+        return r
+
+
+def test_write_behind_retry_does_not_duplicate(backend, backend_url, frontend):
+    queue = frontend.WriteBehindQueue(LosesFirstResponse(), backend_url + '/batch', flush_interval=0.01,
+                                      backoff=0.01)
+    assert queue.submit({'message': 'once'})
+    queue.stop(timeout=5)
+    assert queue.client.posts == 2
+    assert [item['message'] for item in backend.store.table.items.values()] == ['once']
+
+
+def test_write_behind_falls_back_to_synchronous_post_after_stop(backend, load_frontend):
+    frontend = load_frontend(WRITE_BEHIND='true')
+    client = frontend.app.test_client()
+    r = client.post('/', data={'message': 'queued'}, headers={'Accept': 'application/json'})
+    assert r.status_code == 202
+    queued_uuid = r.get_json()['item']['uuid']
+    frontend.write_behind.stop(timeout=5)
+    assert not frontend.write_behind.submit({'message': 'late'})
+    r = client.post('/', data={'message': 'after stop'}, headers={'Accept': 'application/json'})
+    assert r.status_code == 201
+    messages = sorted(item['message'] for item in backend.store.table.items.values())
+    assert messages == ['after stop', 'queued']
+    assert backend.store.table.items[queued_uuid]['message'] == 'queued'
+
+
+def test_event_stream_limit(load_frontend):
+    client = load_frontend(EVENTS_MAX_STREAMS=1).app.test_client()
+    first = client.get('/events', buffered=False)
+    assert first.status_code == 200
+    r = client.get('/events', buffered=False)
+    assert (r.status_code, r.headers['Retry-After']) == (503, '5')
+    first.close()
+
+
+def test_backend_reset_is_forwarded_to_browsers(backend, backend_url, frontend):
+    # backendのバッファから溢れた位置から再開しようとすると、backendは reset を送る
+    backend.store.message_events = backend.store.EventHub(buffer_size=1)
+    uuids = []
+    for i in range(2):
+        time.sleep(0.002)
+        uuids.append(requests.post(backend_url, json={'message': f'm{i}'}).json()['message'].split()[0])
+    feed = frontend.message_events
+    feed.backoff = 0.01
+    feed.last_event_id = requests.get(f'{backend_url}/{uuids[0]}').json()['created_sort']
+    subscription = feed.subscribe()
+    assert subscription.get(timeout=5) == frontend.events.RESET
+    subscription.close()
+
+    # reset の後は今から後のイベントを読み直す(resetを繰り返さない)。
+    # feedがbackendに再接続するまでに作ったメッセージは届かないので、届くまで作り直す
+    subscription = feed.subscribe()
+    received = []
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        requests.post(backend_url, json={'message': 'after reset'})
+        events = subscription.get(timeout=0.2)
+        if events is not None:
+            received.append(events)
+    assert received[0] != frontend.events.RESET and '"after reset"' in received[0][0][1]
+    subscription.close()
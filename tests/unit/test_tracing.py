@@ -0,0 +1,56 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.apps import load_app
+
+
+@pytest.fixture
+def tracing():
+    return load_app('common', module='tracing')
+
+
+def timings(header):
+    return {name: float(dur[4:]) for name, _, dur in (entry.partition(';') for entry in header.split(', '))}
+
+
+def test_sequential_spans_are_summed(tracing):
+    request_span = tracing.start_request_span('GET /')
+    for _ in range(2):
+        with tracing.span('query', timing='dynamodb'):
+            time.sleep(0.02)
+    header = timings(tracing.server_timing(request_span.trace, 0.1))
+    assert 40 <= header['dynamodb'] < 60
+
+
+def test_concurrent_spans_count_wall_clock_time(tracing):
+    # 並列に実行した呼び出し(DynamoDBの並列Scanなど)は重なった時間を1回だけ数える
+    request_span = tracing.start_request_span('GET /')
+    started = time.perf_counter()
+    barrier = threading.Barrier(4)
+
+    def query():
+        with tracing.span('query', timing='dynamodb'):
+            barrier.wait()
+            time.sleep(0.05)
+    threads = [threading.Thread(target=tracing.propagate(query)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.perf_counter() - started
+    header = timings(tracing.server_timing(request_span.trace, total))
+    assert 50 <= header['dynamodb'] <= header['total']
+
+
+def test_add_server_timing(tracing):
+    request_span = tracing.start_request_span('GET /')
+    tracing.add_server_timing('dynamodb;dur=3.5, total;dur=5, cache;desc="hit"', 'backend-')
+    # 続けて呼び出した(前のレスポンスを受け取った後に始まった)呼び出しの時間は合計する
+    time.sleep(0.01)
+    tracing.add_server_timing('dynamodb;dur=2', 'backend-')
+    header = timings(tracing.server_timing(request_span.trace, 0.02))
+    assert header['backend-dynamodb'] == pytest.approx(5.5, abs=0.1)
+    assert header['backend-total'] == pytest.approx(5.0, abs=0.1)
+    assert 'backend-cache' not in header